@@ -0,0 +1,48 @@
+"""
+Compare finding Remy whiskers by walking the protobuf whisker tree against
+looking them up in the compiled, flattened tree.
+
+    python contrib/benchmarks/remywhiskers.py [--lookups 100000] [--seed 0]
+"""
+
+import argparse
+import random
+import timeit
+
+from spiral.curvecp._pynacl.remy import (
+    CompiledWhiskers, defaultWhiskersPath, loadWhiskerTree, walkWhiskerTree)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lookups', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    # Roughly what a connection sees: inter-ack times of a few milliseconds
+    # and RTT ratios just above 1.
+    memories = [
+        (rng.expovariate(1 / 0.005), rng.expovariate(1 / 0.005), 1 + rng.expovariate(4))
+        for x in xrange(args.lookups)]
+    tree = loadWhiskerTree(defaultWhiskersPath)
+    compiled = CompiledWhiskers(tree)
+
+    def walk():
+        for memory in memories:
+            walkWhiskerTree(tree, *memory)
+
+    def lookup():
+        for memory in memories:
+            compiled.find(*memory)
+
+    for label, f in [('protobuf walk', walk), ('compiled lookup', lookup)]:
+        elapsed = min(timeit.repeat(f, number=1, repeat=3))
+        print '%-16s %8.3f us/lookup' % (label, elapsed / args.lookups * 1e6)
+
+    load = min(timeit.repeat(lambda: loadWhiskerTree(defaultWhiskersPath), number=100, repeat=3))
+    print '%-16s %8.3f us/connection' % ('parsing the tree', load / 100 * 1e6)
+
+
+if __name__ == '__main__':
+    main()
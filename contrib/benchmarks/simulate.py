@@ -0,0 +1,76 @@
+"""
+Send data between a CurveCP client and server over a simulated path and
+report goodput, retransmits, round trip times and processor time per MB.
+
+Runs are deterministic: the same arguments and seed always give the same
+virtual-time results.
+
+    python contrib/benchmarks/simulate.py [--size 1000000] [--bandwidth 10]
+        [--delay 20] [--jitter 0] [--loss 0] [--reorder 0] [--queue 0]
+        [--timer-resolution 0]
+        [--seed 0] [--runs 1] [--congestion chicago] [--trace PATH]
+
+With --trace, the client's congestion controller state over the last run is
+dumped to PATH, to be read with ``spiral.curvecp._pynacl.trace.loadTrace``.
+"""
+
+from __future__ import division
+
+import argparse
+
+from spiral.curvecp._pynacl.congestion import controllerNamed, controllerNames
+from spiral.curvecp._pynacl.simulator import Simulation
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=1000000,
+                        help='bytes to send')
+    parser.add_argument('--bandwidth', type=float, default=10,
+                        help='link bandwidth in Mbit/s; 0 for unlimited')
+    parser.add_argument('--delay', type=float, default=20,
+                        help='one-way delay in milliseconds')
+    parser.add_argument('--jitter', type=float, default=0,
+                        help='most extra delay in milliseconds')
+    parser.add_argument('--loss', type=float, default=0,
+                        help='percentage of packets lost')
+    parser.add_argument('--reorder', type=float, default=0,
+                        help='percentage of packets held back')
+    parser.add_argument('--queue', type=int, default=0,
+                        help='bottleneck queue size in bytes; 0 for unlimited')
+    parser.add_argument('--timer-resolution', type=float, default=0,
+                        help='timer granularity in milliseconds')
+    parser.add_argument('--time-limit', type=float, default=600,
+                        help='virtual seconds to give up after')
+    parser.add_argument('--congestion', choices=controllerNames, default='chicago')
+    parser.add_argument('--trace', metavar='PATH',
+                        help='dump the last run\'s client trace here')
+    parser.add_argument('--trace-size', type=int, default=65536,
+                        help='how many trace records to keep')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--runs', type=int, default=1,
+                        help='how many seeds to run, starting from --seed')
+    args = parser.parse_args()
+
+    simulation = Simulation(
+        congestion=controllerNamed(args.congestion),
+        traceSize=args.trace_size if args.trace else 0,
+        timerResolution=args.timer_resolution / 1000,
+        bandwidth=args.bandwidth * 125000 or None,
+        delay=args.delay / 1000,
+        jitter=args.jitter / 1000,
+        loss=args.loss / 100,
+        reorder=args.reorder / 100,
+        queueSize=args.queue or None)
+    for seed in xrange(args.seed, args.seed + args.runs):
+        result = simulation.run(args.size, seed=seed, timeLimit=args.time_limit)
+        print 'seed %d:' % (seed,)
+        for line in result.summary().splitlines():
+            print '    ' + line
+    if args.trace:
+        with open(args.trace, 'wb') as outfile:
+            result.trace.dump(outfile)
+
+
+if __name__ == '__main__':
+    main()
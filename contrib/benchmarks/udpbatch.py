@@ -0,0 +1,118 @@
+"""
+Measure how many datagrams per second a Twisted UDP port receives and sends
+over loopback when handling one datagram at a time, and when batching with
+recvmmsg and sendmmsg.
+
+Each round fills the receiving socket's buffer with a burst of datagrams and
+then times the reactor draining it, so the numbers only reflect the receive
+path and don't depend on having a spare core for the sender. Sending is timed
+the same way: each round writes a burst to the port and iterates the reactor
+until it's flushed.
+
+    python contrib/benchmarks/udpbatch.py [--rounds 50] [--burst 2000]
+        [--size 192] [--batch-size 64]
+"""
+
+import argparse
+import socket
+import time
+
+from twisted.internet import reactor
+from twisted.internet.protocol import DatagramProtocol
+
+from spiral.curvecp._pynacl import udp
+
+
+class CountingProtocol(DatagramProtocol):
+    count = 0
+
+    def datagramReceived(self, data, host_port):
+        self.count += 1
+
+    def datagramsReceived(self, datagrams):
+        self.count += len(datagrams)
+
+
+def listen(batchSize, protocol):
+    if not batchSize:
+        port = reactor.listenUDP(0, protocol, interface='127.0.0.1')
+    else:
+        port = udp.BatchedPort(
+            0, protocol, interface='127.0.0.1', maxPacketSize=2048, reactor=reactor)
+        port.batchSize = batchSize
+        port.startListening()
+    port.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 16 * 1024 * 1024)
+    return port
+
+
+def measure(batchSize, rounds, burst, size):
+    protocol = CountingProtocol()
+    port = listen(batchSize, protocol)
+    address = '127.0.0.1', port.getHost().port
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    data = '\0' * size
+    elapsed = 0
+    received = 0
+    for x in xrange(rounds):
+        for y in xrange(burst):
+            sender.sendto(data, address)
+        protocol.count = 0
+        start = time.time()
+        while True:
+            before = protocol.count
+            reactor.iterate(0)
+            if protocol.count == before:
+                break
+        elapsed += time.time() - start
+        received += protocol.count
+    port.stopListening()
+    sender.close()
+    return received / elapsed, received / float(rounds * burst)
+
+
+def measureSend(batchSize, rounds, burst, size):
+    port = listen(batchSize, DatagramProtocol())
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 16 * 1024 * 1024)
+    receiver.bind(('127.0.0.1', 0))
+    receiver.setblocking(False)
+    address = receiver.getsockname()
+    data = '\0' * size
+    elapsed = 0
+    received = 0
+    for x in xrange(rounds):
+        start = time.time()
+        for y in xrange(burst):
+            port.write(data, address)
+        reactor.iterate(0)
+        elapsed += time.time() - start
+        while True:
+            try:
+                receiver.recv(2048)
+            except socket.error:
+                break
+            received += 1
+    port.stopListening()
+    receiver.close()
+    return received / elapsed, received / float(rounds * burst)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rounds', type=int, default=50)
+    parser.add_argument('--burst', type=int, default=2000)
+    parser.add_argument('--size', type=int, default=192)
+    parser.add_argument('--batch-size', type=int, default=64)
+    args = parser.parse_args()
+    modes = [('recvfrom', measure, 0), ('sendto', measureSend, 0)]
+    if udp.available:
+        modes[1:1] = [('recvmmsg x%d' % (args.batch_size,), measure, args.batch_size)]
+        modes.append(('sendmmsg x%d' % (args.batch_size,), measureSend, args.batch_size))
+    for label, function, batchSize in modes:
+        rate, delivered = function(batchSize, args.rounds, args.burst, args.size)
+        print '%-16s %12.0f datagrams/s (%.1f%% delivered)' % (
+            label, rate, delivered * 100)
+
+
+if __name__ == '__main__':
+    main()
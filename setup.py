@@ -22,8 +22,13 @@ setup(
     install_requires=[
         'Twisted',
         'interval',
-        'pynacl',
+        # PacketBuilder uses Box.shared_key, new in 1.2, and the private
+        # nacl._sodium bindings to encrypt in place.
+        'pynacl>=1.2,<1.5',
     ],
+    extras_require={
+        'remy': ['protobuf'],
+    },
     entry_points={
         'console_scripts': [
             'curvecpmserver = spiral.scripts.curvecpmserver:main',
@@ -32,5 +37,6 @@ setup(
     },
 
     packages=find_packages(),
+    package_data={'spiral.curvecp._pynacl': ['remy.out.0']},
     zip_safe=False,
 )
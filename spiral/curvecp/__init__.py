@@ -1,4 +1,17 @@
+from spiral.curvecp._pynacl.admission import AdmissionControl
+from spiral.curvecp._pynacl.congestion import ICongestionController, controllerNamed
 from spiral.curvecp._pynacl.endpoints import CurveCPClientEndpoint, CurveCPServerEndpoint
+from spiral.curvecp._pynacl.keycache import SharedKeyCache
+from spiral.curvecp._pynacl.keypool import KeyPool
+from spiral.curvecp._pynacl.metrics import (
+    CurveCPMetrics, MetricsRegistry, MetricsResource, defaultMetrics)
+from spiral.curvecp._pynacl.server import CookieKeys
+from spiral.curvecp._pynacl.sessions import SessionTable
 
 
-__all__ = ['CurveCPClientEndpoint', 'CurveCPServerEndpoint']
+__all__ = [
+    'AdmissionControl', 'CookieKeys', 'CurveCPClientEndpoint', 'CurveCPMetrics',
+    'CurveCPServerEndpoint', 'ICongestionController', 'KeyPool',
+    'MetricsRegistry', 'MetricsResource', 'SessionTable', 'SharedKeyCache',
+    'controllerNamed', 'defaultMetrics',
+]
@@ -1,6 +1,13 @@
+import os
+import signal
 import sys
 
 from twisted.python import log
+from twisted.web.server import Site
+
+from spiral.curvecp import MetricsResource, defaultMetrics
+from spiral.curvecp._pynacl.congestion import controllerNames
+from spiral.curvecp._pynacl.trace import dumpTraces
 
 
 def addLogArguments(parser):
@@ -33,3 +40,43 @@ def getLogObserver(verbosity):
 
 def startLogging(verbosity):
     log.startLoggingWithObserver(getLogObserver(verbosity))
+
+
+def addMetricsArguments(parser):
+    parser.add_argument(
+        '--metrics-port', type=int,
+        help='serve Prometheus metrics over HTTP on this local port')
+
+
+def addCongestionArguments(parser):
+    parser.add_argument(
+        '--congestion', choices=controllerNames, default='chicago',
+        help='the congestion controller to use (remy needs protobuf)')
+
+
+def addTraceArguments(parser):
+    parser.add_argument(
+        '--trace-size', type=int, default=0,
+        help='keep this many records of congestion controller state per '
+        'connection, dumped to --trace-dir on SIGUSR1')
+    parser.add_argument(
+        '--trace-dir', default=os.curdir,
+        help='the directory to dump traces into')
+
+
+def startTracing(reactor, size, directory):
+    if not size:
+        return
+
+    def dump():
+        paths = dumpTraces(defaultMetrics.transports(), directory)
+        log.msg('dumped %d traces to %s' % (len(paths), directory), category='success')
+
+    signal.signal(signal.SIGUSR1, lambda signum, frame: reactor.callFromThread(dump))
+
+
+def startMetrics(reactor, port):
+    if port is None:
+        return
+    reactor.listenTCP(
+        port, Site(MetricsResource(defaultMetrics.registry)), interface='127.0.0.1')
@@ -0,0 +1,151 @@
+import collections
+import socket
+
+from spiral.curvecp._pynacl.metrics import defaultMetrics
+
+
+class TokenBucket(object):
+    """
+    A token bucket refilling at *rate* tokens per second, holding at most
+    *burst* tokens. It starts out full.
+    """
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updatedAt = now
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updatedAt) * self.rate)
+        self.updatedAt = now
+
+    def isFull(self, now):
+        self._refill(now)
+        return self.tokens >= self.burst
+
+    def take(self, now):
+        """
+        Take a token if one is available.
+
+        :returns: True if a token was taken.
+        """
+        self._refill(now)
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+def sourcePrefix(host):
+    """
+    Return the prefix *host* is grouped under for rate limiting: its /24 for
+    IPv4 addresses and its /64 for IPv6 addresses.
+    """
+    try:
+        if ':' in host:
+            return socket.inet_pton(socket.AF_INET6, host)[:8]
+        return socket.inet_aton(host)[:3]
+    except socket.error:
+        return host
+
+
+class AdmissionControl(object):
+    """
+    Decides which handshake packets a server dispatcher does the expensive
+    Curve25519 work for.
+
+    Every Hello has to get a token from the bucket for its source prefix and
+    then from the global bucket. Lag in the event loop is measured by
+    scheduling a call every ``lagCheckInterval`` seconds and seeing how late it
+    runs; while the loop is lagging, Hellos are dropped first, then new
+    Initiates. Packets for established sessions are never dropped here.
+
+    The number of packets dropped for each reason is kept in ``dropped`` and
+    exported as ``curvecp_admission_dropped_total``.
+
+    :param reactor: An `IReactorTime`_ provider.
+    :param metrics: The ``CurveCPMetrics`` to count drops in. Defaults to
+        ``defaultMetrics``.
+
+    .. _IReactorTime: http://twistedmatrix.com/documents/current/api/twisted.internet.interfaces.IReactorTime.html
+    """
+
+    helloRate = 1000
+    helloBurst = 1000
+    prefixRate = 20
+    prefixBurst = 40
+    helloLagThreshold = 0.05
+    initiateLagThreshold = 0.25
+    lagCheckInterval = 0.1
+
+    def __init__(self, reactor, metrics=None):
+        self.reactor = reactor
+        if metrics is None:
+            metrics = defaultMetrics
+        self.metrics = metrics
+        self.lag = 0
+        self.dropped = collections.Counter()
+        self._helloBucket = TokenBucket(self.helloRate, self.helloBurst, reactor.seconds())
+        self._prefixBuckets = {}
+        self._lagCall = None
+
+    def start(self):
+        if self._lagCall is None:
+            self._scheduleLagCheck()
+
+    def stop(self):
+        if self._lagCall is not None:
+            self._lagCall.cancel()
+            self._lagCall = None
+
+    def drop(self, reason):
+        """
+        Count a handshake packet dropped for *reason*.
+        """
+        self.dropped[reason] += 1
+        self.metrics.admissionDrops.inc(reason)
+
+    def _scheduleLagCheck(self):
+        self._lagCall = self.reactor.callLater(
+            self.lagCheckInterval, self._checkLag,
+            self.reactor.seconds() + self.lagCheckInterval)
+
+    def _checkLag(self, expectedAt):
+        now = self.reactor.seconds()
+        self.lag = max(0, now - expectedAt)
+        for prefix, bucket in self._prefixBuckets.items():
+            if bucket.isFull(now):
+                del self._prefixBuckets[prefix]
+        self._scheduleLagCheck()
+
+    def admitHello(self, host):
+        """
+        Decide whether to answer a Hello from *host*.
+        """
+        if self.lag > self.helloLagThreshold:
+            self.drop('helloLag')
+            return False
+        now = self.reactor.seconds()
+        prefix = sourcePrefix(host)
+        bucket = self._prefixBuckets.get(prefix)
+        if bucket is None:
+            bucket = self._prefixBuckets[prefix] = TokenBucket(
+                self.prefixRate, self.prefixBurst, now)
+        if not bucket.take(now):
+            self.drop('helloPrefix')
+            return False
+        if not self._helloBucket.take(now):
+            self.drop('helloGlobal')
+            return False
+        return True
+
+    def admitInitiate(self, host):
+        """
+        Decide whether to check an Initiate from *host* that doesn't belong to
+        an established session.
+        """
+        if self.lag > self.initiateLagThreshold:
+            self.drop('initiateLag')
+            return False
+        return True
@@ -1,13 +1,33 @@
 from __future__ import division
 
 import random
-import time
 
+from zope.interface import implementer
 
+from spiral.curvecp._pynacl.congestion import ICongestionController
+
+
+_nan = float('nan')
+
+@implementer(ICongestionController)
 class Chicago(object):
-    def __init__(self):
+    """
+    The congestion control algorithm from ``curvecpmessage``.
+
+    :param clock: An `IReactorTime`_ provider, used for the initial time.
+    :param random: Optionally, a ``random.Random`` to jitter the send rate
+        with. Defaults to the ``random`` module's shared generator.
+
+    .. _IReactorTime: http://twistedmatrix.com/documents/current/api/twisted.internet.interfaces.IReactorTime.html
+    """
+
+    trace = None
+
+    def __init__(self, clock, random=random):
+        self._random = random
         self.rttAverage = 0
-        self.rttLastSpeedAdjustment = time.time()
+        self.rttHighwater = self.rttLowwater = _nan
+        self.rttLastSpeedAdjustment = clock.seconds()
         self.rttLastEdge = self.rttLastDoubling = 0
         self.rttTimeout = 1
         self.rttPhase = 0
@@ -23,6 +43,13 @@ class Chicago(object):
                                    self.rttAverage, self.rttHighwater, self.rttLowwater))
 
     def processDelta(self, now, rtt):
+        self._processDelta(now, rtt)
+        if self.trace is not None:
+            self.trace.record(
+                now, rtt, self.rttTimeout, self.secPerMessage, self.rttHighwater,
+                self.rttLowwater, _nan)
+
+    def _processDelta(self, now, rtt):
         if not self.rttAverage:
             self.secPerMessage = rtt
             self.rttAverage = rtt
@@ -51,7 +78,7 @@ class Chicago(object):
             return
 
         if now - self.rttLastSpeedAdjustment > 10:
-            self.secPerMessage = 1 + random.random() * .125
+            self.secPerMessage = 1 + self._random.random() * .125
         if self.secPerMessage >= 0.000131072:
             t = self.secPerMessage
             if self.secPerMessage < 0.016777216:
@@ -64,7 +91,7 @@ class Chicago(object):
             if self.rttSeenOlderHigh:
                 self.rttPhase = 1
                 self.rttLastEdge = now
-                self.secPerMessage += self.secPerMessage * random.random() * 0.25
+                self.secPerMessage += self.secPerMessage * self._random.random() * 0.25
             elif self.rttSeenOlderLow:
                 self.rttPhase = 0
 
@@ -105,3 +132,7 @@ class Chicago(object):
             self.secPerMessage *= 2
             self.rttLastPanic = now
             self.rttLastEdge = now
+        if self.trace is not None:
+            self.trace.record(
+                now, _nan, self.rttTimeout, self.secPerMessage, self.rttHighwater,
+                self.rttLowwater, _nan)
@@ -0,0 +1,62 @@
+from zope.interface import Attribute, Interface
+
+
+class ICongestionController(Interface):
+    """
+    Decides how fast a CurveCP transport sends blocks, and when it gives up
+    on an unacknowledged block and sends it again.
+
+    Every connection gets its own controller, made by calling the controller
+    class with the connection's `IReactorTime`_ provider. A ``random.Random``
+    to make any random choices with may also be passed as *random*.
+
+    .. _IReactorTime: http://twistedmatrix.com/documents/current/api/twisted.internet.interfaces.IReactorTime.html
+    """
+
+    window = Attribute(
+        "The most blocks to have outstanding at once, or None for no limit.")
+    lastSentAt = Attribute(
+        "When the transport last sent a block. Set by the transport.")
+    trace = Attribute(
+        "A ``TraceBuffer`` to record the controller's state in whenever a "
+        "block is acknowledged or times out, or None. Set by the transport.")
+
+    def processDelta(now, rtt):
+        """
+        Take note of a block being acknowledged *rtt* seconds after it was
+        sent.
+        """
+
+    def timedOut(now):
+        """
+        Take note of a block being sent again because it wasn't acknowledged
+        in time.
+        """
+
+    def nextMessageIn(now):
+        """
+        Return how many seconds to wait before sending the next block.
+        """
+
+    def nextTimeoutIn(now, qd):
+        """
+        Return how many seconds to wait for the block *qd* to be acknowledged
+        before sending it again. ``qd.sentAt`` lists the times it's been sent.
+        """
+
+
+controllerNames = 'chicago', 'remy'
+
+def controllerNamed(name):
+    """
+    Return the congestion controller class called *name*: ``chicago`` for the
+    algorithm from ``curvecpmessage``, or ``remy`` for a Remy whisker tree.
+    Remy needs ``protobuf`` to be installed.
+    """
+    if name == 'chicago':
+        from spiral.curvecp._pynacl.chicago import Chicago
+        return Chicago
+    elif name == 'remy':
+        from spiral.curvecp._pynacl.remy import Remy
+        return Remy
+    raise ValueError('unknown congestion controller %r' % (name,))
@@ -1,10 +1,20 @@
+import socket
+
 from twisted.internet import defer, interfaces
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
 from zope.interface import implementer
 
+from spiral.curvecp._pynacl import udp
+from spiral.curvecp._pynacl.keycache import SharedKeyCache
 from spiral.curvecp._pynacl.server import CurveCPServerDispatcher
 from spiral.curvecp._pynacl.transport import CurveCPClientTransport
 
 
+# The largest CurveCP packet is 1184 bytes.
+_maxPacketSize = 2048
+
+
 @implementer(interfaces.IStreamClientEndpoint)
 class CurveCPClientEndpoint(object):
     """
@@ -21,14 +31,36 @@ class CurveCPClientEndpoint(object):
         client the on every new connection.
     :param clientExtension: Optionally, the 16-byte client extension. Defaults
         to all null bytes.
+    :param keyCache: Optionally, the ``SharedKeyCache`` to get the box between
+        the client's and server's long-term keys from. Endpoints given a
+        *clientKey* default to a cache of their own; otherwise nothing is
+        cached, since every connection has a new key.
+    :param keyPool: Optionally, a running ``KeyPool`` to take each
+        connection's short-term key from.
+    :param metrics: Optionally, the ``CurveCPMetrics`` to count into. Defaults
+        to ``defaultMetrics``.
+    :param batchSize: Optionally, the most datagrams to send with one
+        ``sendmmsg`` call, or to read with one ``recvmmsg`` call. Datagrams
+        sent during one reactor iteration are sent together. By default
+        datagrams are sent and read one at a time. Batching is only available
+        on Linux, and needs the reactor to also provide `IReactorFDSet`_.
+    :param congestion: Optionally, the congestion controller class to make an
+        |ICongestionController| provider for the connection with. Defaults to
+        ``controllerNamed('chicago')``.
+    :param traceSize: Optionally, how many records of the congestion
+        controller's state to keep in the connection transport's ``trace``, a
+        ``TraceBuffer``. By default nothing is traced.
 
     .. _IStreamClientEndpoint: http://twistedmatrix.com/documents/current/api/twisted.internet.interfaces.IStreamClientEndpoint.html
     .. _IReactorUDP: http://twistedmatrix.com/documents/current/api/twisted.internet.interfaces.IReactorUDP.html
     .. _IReactorTime: http://twistedmatrix.com/documents/current/api/twisted.internet.interfaces.IReactorTime.html
+    .. _IReactorFDSet: http://twistedmatrix.com/documents/current/api/twisted.internet.interfaces.IReactorFDSet.html
     """
 
     def __init__(self, reactor, host, port, serverKey, serverExtension='\x00' * 16,
-                 clientKey=None, clientExtension='\x00' * 16):
+                 clientKey=None, clientExtension='\x00' * 16, keyCache=None,
+                 keyPool=None, metrics=None, batchSize=0, congestion=None,
+                 traceSize=0):
         self.reactor = reactor
         self.host = host
         self.port = port
@@ -36,6 +68,14 @@ class CurveCPClientEndpoint(object):
         self.serverExtension = serverExtension
         self.clientKey = clientKey
         self.clientExtension = clientExtension
+        if keyCache is None and clientKey is not None:
+            keyCache = SharedKeyCache(metrics=metrics)
+        self.keyCache = keyCache
+        self.keyPool = keyPool
+        self.metrics = metrics
+        self.batchSize = batchSize
+        self.congestion = congestion
+        self.traceSize = traceSize
 
     def connect(self, fac):
         """
@@ -47,10 +87,21 @@ class CurveCPClientEndpoint(object):
         .. _IProtocolFactory: http://twistedmatrix.com/documents/current/api/twisted.internet.interfaces.IProtocolFactory.html
         .. _IHalfCloseableProtocol: http://twistedmatrix.com/documents/current/api/twisted.internet.interfaces.IHalfCloseableProtocol.html
         """
+        if self.batchSize and not udp.available:
+            return defer.fail(NotImplementedError(
+                'batching needs sendmmsg, which is not available'))
         transport = CurveCPClientTransport(
             self.reactor, self.serverKey, fac, self.host, self.port,
-            self.serverExtension, self.clientKey, self.clientExtension)
-        listeningPort = self.reactor.listenUDP(0, transport)
+            self.serverExtension, self.clientKey, self.clientExtension,
+            self.keyCache, self.keyPool, self.metrics, self.congestion,
+            self.traceSize)
+        if self.batchSize:
+            listeningPort = udp.BatchedPort(
+                0, transport, maxPacketSize=_maxPacketSize, reactor=self.reactor)
+            listeningPort.batchSize = self.batchSize
+            listeningPort.startListening()
+        else:
+            listeningPort = self.reactor.listenUDP(0, transport)
         transport.notifyFinish().addCallback(self._clientFinished, listeningPort)
         return transport._deferred
 
@@ -71,16 +122,67 @@ class CurveCPServerEndpoint(object):
     :param port: The port to listen on.
     :param serverKey: An |IKeyAndNonceScheme| provider representing the
         server's private key.
+    :param reusePort: Optionally, True to bind the port with ``SO_REUSEPORT``
+        so that several processes can listen on it at once. This requires the
+        reactor to also provide `IReactorSocket`_.
+    :param cookieKeys: Optionally, the ``CookieKeys`` to make and check cookies
+        with. Processes sharing a port should share these, since the Initiate
+        following a cookie can arrive at any of them. Defaults to a fresh,
+        random key.
+    :param admission: Optionally, the ``AdmissionControl`` deciding which
+        handshake packets get answered. Defaults to one with the default
+        limits.
+    :param keyCache: Optionally, the ``SharedKeyCache`` to get boxes between
+        the server's and clients' long-term keys from. Defaults to a new cache.
+    :param keyPool: Optionally, the ``KeyPool`` to take short-term keys from.
+        Defaults to a new pool, which is refilled in the handshake thread pool
+        if there is one.
+    :param sessions: Optionally, the ``SessionTable`` to keep established
+        sessions in. Defaults to one with the default limits.
+    :param metrics: Optionally, the ``CurveCPMetrics`` to count into. Defaults
+        to ``defaultMetrics``.
+    :param batchSize: Optionally, how many datagrams to read from the socket
+        at once with ``recvmmsg``. Datagrams sent during one reactor iteration
+        are then also sent together with ``sendmmsg``. By default datagrams
+        are read and sent one at a time. Batching is only available on Linux,
+        and needs the reactor to also provide `IReactorFDSet`_.
+    :param handshakeThreads: Optionally, the maximum number of threads to run
+        handshake cryptography in. By default it runs on the reactor thread.
+        Threads need the reactor to also provide `IReactorThreads`_. They're
+        stopped when the port stops listening or the reactor shuts down.
+    :param congestion: Optionally, the congestion controller class to make an
+        |ICongestionController| provider for each connection with. Defaults to
+        ``controllerNamed('chicago')``.
+    :param traceSize: Optionally, how many records of the congestion
+        controller's state to keep in each connection transport's ``trace``,
+        a ``TraceBuffer``. By default nothing is traced.
 
     .. _IStreamServerEndpoint: http://twistedmatrix.com/documents/current/api/twisted.internet.interfaces.IStreamServerEndpoint.html
     .. _IReactorUDP: http://twistedmatrix.com/documents/current/api/twisted.internet.interfaces.IReactorUDP.html
     .. _IReactorTime: http://twistedmatrix.com/documents/current/api/twisted.internet.interfaces.IReactorTime.html
+    .. _IReactorSocket: http://twistedmatrix.com/documents/current/api/twisted.internet.interfaces.IReactorSocket.html
+    .. _IReactorFDSet: http://twistedmatrix.com/documents/current/api/twisted.internet.interfaces.IReactorFDSet.html
+    .. _IReactorThreads: http://twistedmatrix.com/documents/current/api/twisted.internet.interfaces.IReactorThreads.html
     """
 
-    def __init__(self, reactor, port, serverKey):
+    def __init__(self, reactor, port, serverKey, reusePort=False, cookieKeys=None,
+                 admission=None, keyCache=None, keyPool=None,
+                 sessions=None, metrics=None, batchSize=0,
+                 handshakeThreads=0, congestion=None, traceSize=0):
         self.reactor = reactor
         self.port = port
         self.serverKey = serverKey
+        self.reusePort = reusePort
+        self.cookieKeys = cookieKeys
+        self.admission = admission
+        self.keyCache = keyCache
+        self.keyPool = keyPool
+        self.sessions = sessions
+        self.metrics = metrics
+        self.batchSize = batchSize
+        self.handshakeThreads = handshakeThreads
+        self.congestion = congestion
+        self.traceSize = traceSize
 
     def listen(self, fac):
         """
@@ -92,5 +194,50 @@ class CurveCPServerEndpoint(object):
         .. _IProtocolFactory: http://twistedmatrix.com/documents/current/api/twisted.internet.interfaces.IProtocolFactory.html
         .. _IHalfCloseableProtocol: http://twistedmatrix.com/documents/current/api/twisted.internet.interfaces.IHalfCloseableProtocol.html
         """
-        dispatcher = CurveCPServerDispatcher(self.reactor, self.serverKey, fac)
-        return defer.succeed(self.reactor.listenUDP(self.port, dispatcher))
+        if self.batchSize and not udp.available:
+            return defer.fail(NotImplementedError(
+                'batching needs recvmmsg, which is not available'))
+        threadPool = None
+        if self.handshakeThreads:
+            threadPool = ThreadPool(1, self.handshakeThreads, 'curvecp-handshake')
+            threadPool.start()
+        dispatcher = CurveCPServerDispatcher(
+            self.reactor, self.serverKey, fac, self.cookieKeys, self.admission,
+            threadPool, self.keyCache, self.keyPool, self.sessions, self.metrics,
+            self.congestion, self.traceSize)
+        if threadPool is not None:
+            dispatcher.ownThreadPool()
+        try:
+            if self.reusePort:
+                listeningPort = self._adoptReusedPort(dispatcher)
+            elif self.batchSize:
+                listeningPort = udp.BatchedPort(
+                    self.port, dispatcher, maxPacketSize=_maxPacketSize,
+                    reactor=self.reactor)
+                listeningPort.batchSize = self.batchSize
+                listeningPort.startListening()
+            else:
+                listeningPort = self.reactor.listenUDP(self.port, dispatcher)
+        except Exception:
+            failure = Failure()
+            dispatcher.releaseThreadPool()
+            return defer.fail(failure)
+        return defer.succeed(listeningPort)
+
+    def _adoptReusedPort(self, dispatcher):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock.bind(('', self.port))
+            sock.setblocking(False)
+            if not self.batchSize:
+                return self.reactor.adoptDatagramPort(
+                    sock.fileno(), socket.AF_INET, dispatcher)
+            listeningPort = udp.BatchedPort._fromListeningDescriptor(
+                self.reactor, sock.fileno(), socket.AF_INET, dispatcher,
+                maxPacketSize=_maxPacketSize)
+            listeningPort.batchSize = self.batchSize
+            listeningPort.startListening()
+            return listeningPort
+        finally:
+            sock.close()
@@ -0,0 +1,48 @@
+import bisect
+
+
+class InFlightIndex(object):
+    """
+    The blocks that have been sent but not yet fully acknowledged, kept sorted
+    by the stream offset at which each block starts.
+
+    Blocks never overlap, so the blocks touched by an acknowledged range can be
+    found with two bisections instead of a scan over everything in flight.
+    """
+
+    def __init__(self):
+        self._offsets = []
+        self._blocks = []
+
+    def __len__(self):
+        return len(self._blocks)
+
+    def __iter__(self):
+        return iter(list(self._blocks))
+
+    def __contains__(self, block):
+        i = bisect.bisect_left(self._offsets, block.lowerBound)
+        return i < len(self._blocks) and self._blocks[i] is block
+
+    def add(self, block):
+        i = bisect.bisect_left(self._offsets, block.lowerBound)
+        if i < len(self._blocks) and self._blocks[i] is block:
+            return
+        self._offsets.insert(i, block.lowerBound)
+        self._blocks.insert(i, block)
+
+    def discard(self, block):
+        i = bisect.bisect_left(self._offsets, block.lowerBound)
+        if i < len(self._blocks) and self._blocks[i] is block:
+            del self._offsets[i]
+            del self._blocks[i]
+
+    def overlapping(self, lower, upper):
+        """
+        Return the blocks which might overlap the half-open range [lower,
+        upper), in stream order. Only the first block returned can start before
+        *lower*; callers still have to check it against its own interval.
+        """
+        start = max(bisect.bisect_right(self._offsets, lower) - 1, 0)
+        end = bisect.bisect_left(self._offsets, upper)
+        return self._blocks[start:end]
@@ -0,0 +1,55 @@
+import collections
+import threading
+
+from nacl.public import Box
+
+from spiral.curvecp._pynacl.metrics import defaultMetrics
+
+
+class SharedKeyCache(object):
+    """
+    A bounded cache of ``Box``\ es between long-term keys, so that a peer which
+    connects over and over doesn't cost a scalar multiplication every time.
+
+    The least recently used box is thrown away once more than *maxSize* are
+    held. It's safe to use from several threads at once. Hits and misses are
+    counted in ``hits`` and ``misses`` and exported through *metrics*.
+
+    :param maxSize: The most boxes to keep.
+    :param metrics: The ``CurveCPMetrics`` to count hits and misses in.
+        Defaults to ``defaultMetrics``.
+    """
+
+    def __init__(self, maxSize=1024, metrics=None):
+        self.maxSize = maxSize
+        if metrics is None:
+            metrics = defaultMetrics
+        self.metrics = metrics
+        self.hits = 0
+        self.misses = 0
+        self._boxes = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._boxes)
+
+    def box(self, privateKey, publicKey):
+        """
+        Return a ``Box`` between *privateKey* and *publicKey*.
+        """
+        key = str(privateKey.public_key), str(publicKey)
+        with self._lock:
+            box = self._boxes.pop(key, None)
+            if box is not None:
+                self.hits += 1
+                self.metrics.keyCacheHits.inc()
+                self._boxes[key] = box
+                return box
+            self.misses += 1
+            self.metrics.keyCacheMisses.inc()
+        box = Box(privateKey, publicKey)
+        with self._lock:
+            self._boxes[key] = box
+            while len(self._boxes) > self.maxSize:
+                self._boxes.popitem(last=False)
+        return box
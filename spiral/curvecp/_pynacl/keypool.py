@@ -0,0 +1,109 @@
+from nacl.public import PrivateKey
+from twisted.internet import threads
+from twisted.python import log
+
+from spiral.curvecp._pynacl.metrics import defaultMetrics
+
+
+def generateKeys(count):
+    return [PrivateKey.generate() for x in xrange(count)]
+
+
+class KeyPool(object):
+    """
+    A pool of short-term keypairs generated ahead of time.
+
+    Once the pool drops below *lowWater* keys, it's refilled up to *highWater*
+    keys. Without a thread pool, keys are generated ``batchSize`` at a time in
+    calls scheduled on the reactor, so that packets can be handled in between;
+    with one, they're all generated in a thread. Taking a key from an empty
+    pool generates one on the spot.
+
+    Keys are only generated in the background while the pool is running; a
+    dispatcher starts and stops its own pool, but pools passed to client
+    endpoints have to be started by whoever made them. Keys taken from the
+    pool and keys generated because it was empty are counted in ``hits`` and
+    ``misses`` and exported through *metrics*.
+
+    :param reactor: An `IReactorTime`_ provider.
+    :param lowWater: The size to refill the pool at.
+    :param highWater: The size to refill the pool to.
+    :param threadPool: Optionally, a ``ThreadPool`` to generate keys in.
+    :param metrics: The ``CurveCPMetrics`` to count hits and misses in.
+        Defaults to ``defaultMetrics``.
+
+    .. _IReactorTime: http://twistedmatrix.com/documents/current/api/twisted.internet.interfaces.IReactorTime.html
+    """
+
+    batchSize = 8
+
+    def __init__(self, reactor, lowWater=64, highWater=256, threadPool=None,
+                 metrics=None):
+        self.reactor = reactor
+        self.lowWater = lowWater
+        self.highWater = highWater
+        self.threadPool = threadPool
+        if metrics is None:
+            metrics = defaultMetrics
+        self.metrics = metrics
+        self.hits = 0
+        self.misses = 0
+        self.running = False
+        self._keys = []
+        self._refillCall = None
+        self._refilling = False
+
+    def __len__(self):
+        return len(self._keys)
+
+    def start(self):
+        self.running = True
+        self._refill()
+
+    def stop(self):
+        self.running = False
+        if self._refillCall is not None:
+            self._refillCall.cancel()
+            self._refillCall = None
+            self._refilling = False
+
+    def get(self):
+        """
+        Take a key from the pool.
+
+        :returns: A ``PrivateKey``.
+        """
+        if len(self._keys) <= self.lowWater:
+            self._refill()
+        if self._keys:
+            self.hits += 1
+            self.metrics.keyPoolHits.inc()
+            return self._keys.pop()
+        self.misses += 1
+        self.metrics.keyPoolMisses.inc()
+        return PrivateKey.generate()
+
+    def _refill(self):
+        if not self.running or self._refilling or len(self._keys) >= self.highWater:
+            return
+        self._refilling = True
+        if self.threadPool is None:
+            self._refillCall = self.reactor.callLater(0, self._generateBatch)
+            return
+        d = threads.deferToThreadPool(
+            self.reactor, self.threadPool, generateKeys,
+            self.highWater - len(self._keys))
+        d.addCallbacks(self._gotKeys, self._refillFailed)
+
+    def _generateBatch(self):
+        self._refillCall = None
+        self._gotKeys(generateKeys(min(self.batchSize, self.highWater - len(self._keys))))
+
+    def _gotKeys(self, keys):
+        self._refilling = False
+        self._keys.extend(keys)
+        self._refill()
+
+    def _refillFailed(self, reason):
+        self._refilling = False
+        log.err(reason, 'error generating keys')
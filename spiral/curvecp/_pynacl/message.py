@@ -1,5 +1,4 @@
 import collections
-import itertools
 import struct
 
 from spiral.curvecp._pynacl.interval import halfOpen
@@ -10,71 +9,88 @@ _uint32 = struct.Struct('<I')
 _uint64 = struct.Struct('<Q')
 _maxima = {s: s.unpack('\xff' * s.size)[0] for s in [_uint16, _uint32, _uint64]}
 
-def packInto(s, val, target):
+_rangeStruct = struct.Struct('<QI9H')
+
+def clampInto(s, val, target):
     maximum = _maxima[s]
     if val > maximum:
-        target.append('\xff' * s.size)
+        target.append(maximum)
         return val - maximum
     else:
-        target.append(s.pack(val)),
+        target.append(val)
         return 0
 
 
+sizes = [192, 320, 576, 1024]
+resolutions = {'success': 0x800, 'failure': 0x1000}
+
+def paddedSize(length):
+    for size in sizes:
+        if length <= size:
+            return size
+    raise ValueError(
+        'data is %d bytes when the limit is %d' % (length, size))
+
+
+rangePackers = [
+    (None, _uint64),
+    (_uint32, _uint16),
+    (_uint16, _uint16),
+    (_uint16, _uint16),
+    (_uint16, _uint16),
+    (_uint16, _uint16),
+]
+
+def rangeFields(ranges):
+    """
+    Turn up to six half-open intervals into the eleven integers of a message's
+    acknowledgement section, spilling spans and gaps which are too large for
+    their field into the following fields.
+    """
+    ret = []
+    prev = 0
+    if ranges and ranges[0].lower_bound != 0:
+        ranges = [halfOpen(0, 0)] + ranges[:5]
+    rangeIter = iter(ranges)
+    remainingDelta = remainingSpan = None
+    for deltaPack, spanPack in rangePackers:
+        if not (remainingSpan or remainingDelta):
+            i = next(rangeIter, None) or halfOpen(prev, prev)
+            if not i.lower_closed or i.upper_closed:
+                raise ValueError('every interval must be half-open')
+            if deltaPack is None and i.lower_bound != 0:
+                raise ValueError('first interval must start at 0')
+            remainingDelta = i.lower_bound - prev
+            remainingSpan = i.upper_bound - i.lower_bound
+            prev = i.upper_bound
+        if deltaPack is not None:
+            remainingDelta = clampInto(deltaPack, remainingDelta, ret)
+        if not remainingDelta:
+            remainingSpan = clampInto(spanPack, remainingSpan, ret)
+        else:
+            clampInto(spanPack, 0, ret)
+    return ret
+
+
 _MessageBase = collections.namedtuple('_Message', [
     'id', 'previousID', 'ranges', 'resolution', 'dataPos', 'data',
 ])
 
 
 class Message(_MessageBase):
-    sizes = [192, 320, 576, 1024]
-    resolutions = {'success': 0x800, 'failure': 0x1000}
+    sizes = sizes
+    resolutions = resolutions
+
+    def status(self):
+        return self.resolutions.get(self.resolution, 0) | len(self.data)
 
     def pack_data(self):
-        for size in self.sizes:
-            if len(self.data) > size:
-                continue
-            data = self.data.rjust(size, '\x00')
-            status = (
-                self.resolutions.get(self.resolution, 0)
-                | len(self.data))
-            return _uint16.pack(status) + _uint64.pack(self.dataPos) + data
-        raise ValueError(
-            'data is %d bytes when the limit is %d' % (len(self.data), size))
-
-    rangePackers = [
-        (None, _uint64),
-        (_uint32, _uint16),
-        (_uint16, _uint16),
-        (_uint16, _uint16),
-        (_uint16, _uint16),
-        (_uint16, _uint16),
-    ]
+        size = paddedSize(len(self.data))
+        data = self.data.rjust(size, '\x00')
+        return _uint16.pack(self.status()) + _uint64.pack(self.dataPos) + data
 
     def pack_ranges(self):
-        ret = []
-        prev = 0
-        ranges = self.ranges
-        if ranges and ranges[0].lower_bound != 0:
-            ranges = [halfOpen(0, 0)] + ranges[:5]
-        rangeIter = iter(ranges)
-        remainingDelta = remainingSpan = None
-        for deltaPack, spanPack in self.rangePackers:
-            if not (remainingSpan or remainingDelta):
-                i = next(rangeIter, None) or halfOpen(prev, prev)
-                if not i.lower_closed or i.upper_closed:
-                    raise ValueError('every interval must be half-open')
-                if deltaPack is None and i.lower_bound != 0:
-                    raise ValueError('first interval must start at 0')
-                remainingDelta = i.lower_bound - prev
-                remainingSpan = i.upper_bound - i.lower_bound
-                prev = i.upper_bound
-            if deltaPack is not None:
-                remainingDelta = packInto(deltaPack, remainingDelta, ret)
-            if not remainingDelta:
-                remainingSpan = packInto(spanPack, remainingSpan, ret)
-            else:
-                packInto(spanPack, 0, ret)
-        return ''.join(ret)
+        return _rangeStruct.pack(*rangeFields(self.ranges))
 
     def pack(self):
         return (
@@ -84,18 +100,6 @@ class Message(_MessageBase):
             + self.pack_data())
 
 
-def _makeIntervals(ranges):
-    end = 0
-    ret = []
-    for delta, span in ranges:
-        start = end + delta
-        end = start + span
-        if start == end:
-            continue
-        ret.append(halfOpen(start, end))
-    return ret
-
-
 # 0. 4 bytes: a message ID chosen by the sender.
 # 1. 4 bytes: if nonzero, a message ID received by the sender immediately
 #             before this message was sent.
@@ -137,18 +141,43 @@ def _makeIntervals(ranges):
 #              total number of bytes in the stream.
 
 messageStruct = struct.Struct('<IIQI10HQ')
+
+
+class MessageView(object):
+    """
+    A received message, decoded only as far as the transport needs it.
+
+    The acknowledged ranges are left packed until ``iterRanges`` is called,
+    and come out as plain ``(start, end)`` integer pairs rather than intervals.
+    """
+
+    __slots__ = ['id', 'previousID', 'resolution', 'dataPos', 'data', '_fields']
+
+    def __init__(self, s):
+        fields = self._fields = messageStruct.unpack_from(s)
+        self.id = fields[0]
+        self.previousID = fields[1]
+        rawStatus = fields[13]
+        length = rawStatus & 0x7ff
+        self.resolution = 'success' if rawStatus & 0x800 else 'failure' if rawStatus & 0x1000 else None
+        self.dataPos = fields[14]
+        self.data = s[-length:] if length else ''
+
+    def iterRanges(self):
+        fields = self._fields
+        start = end = 0
+        for i in xrange(2, 13, 2):
+            if i > 2:
+                start = end + fields[i - 1]
+            end = start + fields[i]
+            if start != end:
+                yield start, end
+
+
 def parseMessage(s):
-    unpacked = messageStruct.unpack_from(s)
-    rawRanges = unpacked[2:13]
-    it = itertools.chain([0], rawRanges)
-    intervals = _makeIntervals(zip(it, it))
-    rawStatus = unpacked[13]
-    length = rawStatus & 0x7ff
-    resolution = 'success' if rawStatus & 0x800 else 'failure' if rawStatus & 0x1000 else None
-    if not length:
-        data = ''
-    else:
-        data = s[-length:]
+    view = MessageView(s)
     return Message(
-        unpacked[0], unpacked[1], intervals, resolution, unpacked[14], data,
+        view.id, view.previousID,
+        [halfOpen(start, end) for start, end in view.iterRanges()],
+        view.resolution, view.dataPos, view.data,
     )
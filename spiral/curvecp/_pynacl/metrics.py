@@ -0,0 +1,247 @@
+import bisect
+import weakref
+
+from twisted.web.resource import Resource
+
+
+def formatValue(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class Counter(object):
+    """
+    A number that only goes up.
+    """
+
+    type = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        yield self.name, self.value
+
+
+class LabelledCounter(object):
+    """
+    A counter for each value of the label *label*. Values only appear once
+    they've been counted.
+    """
+
+    type = 'counter'
+
+    def __init__(self, name, help, label):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = {}
+
+    def inc(self, labelValue, amount=1):
+        self.values[labelValue] = self.values.get(labelValue, 0) + amount
+
+    def samples(self):
+        for labelValue, value in sorted(self.values.items()):
+            yield '%s{%s="%s"}' % (self.name, self.label, labelValue), value
+
+
+class Gauge(object):
+    """
+    A number that goes up and down. If *function* is given, it's called to get
+    the value whenever the gauge is collected, instead of the gauge being set.
+    """
+
+    type = 'gauge'
+
+    def __init__(self, name, help, function=None):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.function = function
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def samples(self):
+        if self.function is not None:
+            yield self.name, self.function()
+        else:
+            yield self.name, self.value
+
+
+class Histogram(object):
+    """
+    Counts of observed values, bucketed by the upper bounds in *buckets*.
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = sorted(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield '%s_bucket{le="%s"}' % (self.name, formatValue(bound)), total
+        yield '%s_bucket{le="+Inf"}' % (self.name,), self.count
+        yield self.name + '_sum', self.sum
+        yield self.name + '_count', self.count
+
+
+class MetricsRegistry(object):
+    """
+    A collection of metrics which can be rendered in the Prometheus text
+    exposition format.
+    """
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help):
+        return self.register(Counter(name, help))
+
+    def labelledCounter(self, name, help, label):
+        return self.register(LabelledCounter(name, help, label))
+
+    def gauge(self, name, help, function=None):
+        return self.register(Gauge(name, help, function))
+
+    def histogram(self, name, help, buckets):
+        return self.register(Histogram(name, help, buckets))
+
+    def exposition(self):
+        """
+        Render every metric in the Prometheus text format.
+        """
+        lines = []
+        for metric in self._metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.type))
+            for name, value in metric.samples():
+                lines.append('%s %s' % (name, formatValue(value)))
+        lines.append('')
+        return '\n'.join(lines)
+
+
+timeBuckets = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class CurveCPMetrics(object):
+    """
+    The metrics kept by CurveCP dispatchers and transports.
+
+    Everything on the packet path is a plain counter or histogram update;
+    gauges describing the state of transports are only computed when the
+    registry is collected.
+
+    :param registry: The ``MetricsRegistry`` to register the metrics with.
+    """
+
+    def __init__(self, registry):
+        self.registry = registry
+        self._transports = weakref.WeakSet()
+        c = registry.counter
+        self.hellos = c('curvecp_hellos_total', 'Hello packets received.')
+        self.cookies = c('curvecp_cookies_total', 'Cookie packets sent.')
+        self.initiates = c('curvecp_initiates_total', 'Initiate packets received.')
+        self.decryptFailures = c(
+            'curvecp_decrypt_failures_total', 'Packets which failed to decrypt.')
+        self.nonceRejects = c(
+            'curvecp_nonce_rejects_total', 'Packets rejected for a replayed or stale nonce.')
+        self.latePackets = c(
+            'curvecp_late_packets_total', 'Packets accepted after a higher nonce.')
+        self.retransmits = c('curvecp_retransmits_total', 'Blocks retransmitted.')
+        self.fastRetransmits = c(
+            'curvecp_fast_retransmits_total',
+            'Blocks queued to be retransmitted because later data was '
+            'acknowledged.')
+        self.duplicateRetransmits = c(
+            'curvecp_duplicate_retransmits_total',
+            'Block timeouts ignored because the block was already queued to be resent.')
+        self.packetsIn = c('curvecp_packets_in_total', 'Packets received.')
+        self.packetsOut = c('curvecp_packets_out_total', 'Packets sent.')
+        self.bytesIn = c('curvecp_bytes_in_total', 'Bytes received, including headers.')
+        self.bytesOut = c('curvecp_bytes_out_total', 'Bytes sent, including headers.')
+        self.admissionDrops = registry.labelledCounter(
+            'curvecp_admission_dropped_total', 'Handshake packets dropped by admission control.',
+            'reason')
+        self.evictions = registry.labelledCounter(
+            'curvecp_sessions_evicted_total', 'Established sessions evicted.', 'reason')
+        self.keyCacheHits = c(
+            'curvecp_key_cache_hits_total', 'Long-term key boxes found in the cache.')
+        self.keyCacheMisses = c(
+            'curvecp_key_cache_misses_total', 'Long-term key boxes computed.')
+        self.keyPoolHits = c(
+            'curvecp_key_pool_hits_total', 'Short-term keys taken from the key pool.')
+        self.keyPoolMisses = c(
+            'curvecp_key_pool_misses_total',
+            'Short-term keys generated because the key pool was empty.')
+        g = registry.gauge
+        g('curvecp_active_sessions', 'Established connections.',
+          lambda: len(self._transports))
+        g('curvecp_bytes_in_flight', 'Bytes written but not yet acknowledged.',
+          lambda: sum(t._unackedBytes() for t in self._transports))
+        g('curvecp_queue_depth', 'Blocks waiting to be sent or resent.',
+          lambda: sum(len(t._messageQueue) for t in self._transports))
+        h = registry.histogram
+        self.rtt = h('curvecp_rtt_seconds', 'Measured round trip times.', timeBuckets)
+        self.handshakeTime = h(
+            'curvecp_handshake_seconds',
+            'Time from a client sending its Hello, or a server receiving an '
+            'Initiate, to the connection being established.', timeBuckets)
+
+    def track(self, transport):
+        self._transports.add(transport)
+
+    def untrack(self, transport):
+        self._transports.discard(transport)
+
+    def transports(self):
+        """
+        Return the established transports counting into these metrics.
+        """
+        return list(self._transports)
+
+
+defaultMetrics = CurveCPMetrics(MetricsRegistry())
+
+
+class MetricsResource(Resource):
+    """
+    A web resource serving a ``MetricsRegistry`` for Prometheus to scrape.
+    """
+
+    isLeaf = True
+
+    def __init__(self, registry):
+        Resource.__init__(self)
+        self.registry = registry
+
+    def render_GET(self, request):
+        request.setHeader('content-type', 'text/plain; version=0.0.4')
+        return self.registry.exposition()
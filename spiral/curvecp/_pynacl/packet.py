@@ -0,0 +1,81 @@
+from __future__ import absolute_import
+
+import struct
+
+# The private cffi bindings let packets be encrypted in place; setup.py pins
+# PyNaCl to the versions they're known to work with.
+from nacl._sodium import ffi, lib
+
+from spiral.curvecp._pynacl.message import (
+    messageStruct, paddedSize, rangeFields, resolutions, sizes)
+
+
+_nonceStruct = struct.Struct('<Q')
+_zeroBytes = 32
+_boxZeroBytes = 16
+_maxBody = messageStruct.size + sizes[-1]
+_zeros = memoryview('\0' * sizes[-1])
+
+
+class PacketBuilder(object):
+    """
+    Serializes and encrypts outgoing messages for one connection.
+
+    The packet header, the nonce prefix, and the buffers that messages are
+    packed and encrypted in are all set up once, when the builder is created.
+    Building a packet packs the message straight into the plaintext buffer with
+    a single struct and encrypts it in place behind the header, so the only
+    string allocated is the finished packet.
+
+    :param header: Everything in the packet before the nonce.
+    :param noncePrefix: The 16-byte prefix of the encryption nonce.
+    :param box: The ``Box`` to encrypt with.
+    """
+
+    def __init__(self, header, noncePrefix, box):
+        self._key = box.shared_key()
+        self._headerTail = header[-8:]
+        self._headerLength = len(header) + _nonceStruct.size
+        self._plain = ffi.new('unsigned char[]', _zeroBytes + _maxBody)
+        self._plainBuffer = ffi.buffer(self._plain)
+        self._nonce = ffi.new('unsigned char[]', noncePrefix + '\0' * _nonceStruct.size)
+        self._nonceBuffer = ffi.buffer(self._nonce, 24)
+        self._packet = ffi.new(
+            'unsigned char[]', self._headerLength + _maxBody + _boxZeroBytes)
+        self._packetBuffer = ffi.buffer(self._packet)
+        self._packetBuffer[:len(header)] = header
+        # crypto_box writes _boxZeroBytes of zeros ahead of the ciphertext,
+        # which land on the end of the header and the nonce; those get
+        # rewritten after every encryption.
+        self._ciphertext = self._packet + (self._headerLength - _boxZeroBytes)
+
+    def build(self, nonce, message):
+        """
+        Serialize and encrypt *message* using the 64-bit counter *nonce*.
+
+        :returns: The complete packet, as a string.
+        """
+        data = message.data
+        bodyLength = messageStruct.size + paddedSize(len(data))
+        plain = self._plainBuffer
+        messageStruct.pack_into(
+            plain, _zeroBytes, message.id, message.previousID,
+            *(rangeFields(message.ranges) + [
+                resolutions.get(message.resolution, 0) | len(data),
+                message.dataPos]))
+        paddingStart = _zeroBytes + messageStruct.size
+        dataStart = _zeroBytes + bodyLength - len(data)
+        plain[paddingStart:dataStart] = _zeros[:dataStart - paddingStart]
+        plain[dataStart:dataStart + len(data)] = data
+
+        _nonceStruct.pack_into(self._nonceBuffer, 16, nonce)
+        rc = lib.crypto_box_afternm(
+            self._ciphertext, self._plain, _zeroBytes + bodyLength, self._nonce,
+            self._key)
+        if rc != 0:
+            raise RuntimeError('crypto_box_afternm failed')
+        packet = self._packetBuffer
+        headerLength = self._headerLength
+        packet[headerLength - 16:headerLength - 8] = self._headerTail
+        _nonceStruct.pack_into(packet, headerLength - 8, nonce)
+        return packet[:headerLength + bodyLength + _boxZeroBytes]
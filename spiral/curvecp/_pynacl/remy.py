@@ -2,19 +2,162 @@ from __future__ import division
 
 import os
 
-from spiral.curvecp.pynacl._dna_pb2 import WhiskerTree, Memory
+from zope.interface import implementer
+
+from spiral.curvecp._pynacl._dna_pb2 import Memory, WhiskerTree
+from spiral.curvecp._pynacl.congestion import ICongestionController
 
 
 ALPHA = 1 / 8
 SLOW_ALPHA = 1 / 256
+_nan = float('nan')
 HERE = os.path.dirname(os.path.abspath(__file__))
+defaultWhiskersPath = os.path.join(HERE, 'remy.out.0')
+
+
+def loadWhiskerTree(path):
+    tree = WhiskerTree()
+    with open(path, 'rb') as infile:
+        tree.ParseFromString(infile.read())
+    return tree
+
+
+def _memoryRange(mr):
+    return (mr.lower.rec_rec_ewma, mr.upper.rec_rec_ewma,
+            mr.lower.slow_rec_rec_ewma, mr.upper.slow_rec_rec_ewma,
+            mr.lower.rtt_ratio, mr.upper.rtt_ratio)
+
+
+def _contains(bounds, recEWMA, slowRecEWMA, rttRatio):
+    lr, ur, ls, us, lt, ut = bounds
+    return lr <= recEWMA <= ur and ls <= slowRecEWMA <= us and lt <= rttRatio <= ut
+
+
+def _memoryContainedBy(m, mr):
+    return (mr.lower.rec_rec_ewma <= m.rec_rec_ewma <= mr.upper.rec_rec_ewma
+            and mr.lower.slow_rec_rec_ewma <= m.slow_rec_rec_ewma <= mr.upper.slow_rec_rec_ewma
+            and mr.lower.rtt_ratio <= m.rtt_ratio <= mr.upper.rtt_ratio)
+
+
+def walkWhiskerTree(tree, recEWMA, slowRecEWMA, rttRatio):
+    """
+    Find the whisker for a memory by walking the protobuf *tree* directly.
+    This is what ``CompiledWhiskers`` compiles away; it's kept as the
+    reference for testing and benchmarking against.
+
+    :returns: The protobuf ``Whisker``.
+    """
+    memory = Memory(
+        rec_rec_ewma=recEWMA, slow_rec_rec_ewma=slowRecEWMA,
+        rec_send_ewma=0, rtt_ratio=rttRatio)
+    node = tree
+    while True:
+        if node.HasField('leaf') and _memoryContainedBy(memory, node.leaf.domain):
+            return node.leaf
+        for child in node.children:
+            if _memoryContainedBy(memory, child.domain):
+                node = child
+                break
+        else:
+            raise ValueError('no nodes found for %s' % (memory,))
+
+
+class CompiledWhiskers(object):
+    """
+    A whisker tree flattened into tuples of plain floats.
+
+    Node *n*'s children are ``children[n]``, a tuple of ``(lowerRec,
+    upperRec, lowerSlowRec, upperSlowRec, lowerRatio, upperRatio, node,
+    whisker)`` entries in the tree's order. Children which are only a leaf
+    covering their whole domain have their ``(windowIncrement,
+    windowMultiple, intersend)`` inlined as *whisker*, so most lookups never
+    leave their parent. Lookups pick the same whisker as walking the protobuf
+    tree does.
+
+    :param tree: The protobuf ``WhiskerTree`` to compile.
+    """
+
+    def __init__(self, tree):
+        self.leaves = []
+        self.children = []
+        self._compile(tree)
+
+    def _compile(self, node):
+        index = len(self.children)
+        self.leaves.append(None)
+        self.children.append(None)
+        if node.HasField('leaf'):
+            leaf = node.leaf
+            self.leaves[index] = _memoryRange(leaf.domain), (
+                leaf.window_increment, leaf.window_multiple, leaf.intersend)
+        children = []
+        for child in node.children:
+            bounds = _memoryRange(child.domain)
+            whisker = None
+            if not child.children and child.HasField('leaf') and (
+                    _memoryRange(child.leaf.domain) == bounds):
+                leaf = child.leaf
+                whisker = leaf.window_increment, leaf.window_multiple, leaf.intersend
+            children.append(bounds + (self._compile(child), whisker))
+        self.children[index] = tuple(children)
+        return index
 
+    def find(self, recEWMA, slowRecEWMA, rttRatio):
+        """
+        Find the whisker for a memory.
 
+        :returns: A ``(windowIncrement, windowMultiple, intersend)`` tuple.
+        """
+        node = 0
+        leaves = self.leaves
+        children = self.children
+        while True:
+            leaf = leaves[node]
+            if leaf is not None and _contains(leaf[0], recEWMA, slowRecEWMA, rttRatio):
+                return leaf[1]
+            for lr, ur, ls, us, lt, ut, child, whisker in children[node]:
+                if (lr <= recEWMA <= ur and ls <= slowRecEWMA <= us
+                        and lt <= rttRatio <= ut):
+                    if whisker is not None:
+                        return whisker
+                    node = child
+                    break
+            else:
+                raise ValueError('no nodes found for %r' % (
+                    (recEWMA, slowRecEWMA, rttRatio),))
+
+
+_compiledWhiskers = {}
+
+def compiledWhiskers(path=defaultWhiskersPath):
+    """
+    Return the ``CompiledWhiskers`` for the tree in the file at *path*,
+    compiling it the first time it's asked for in this process.
+    """
+    whiskers = _compiledWhiskers.get(path)
+    if whiskers is None:
+        whiskers = _compiledWhiskers[path] = CompiledWhiskers(loadWhiskerTree(path))
+    return whiskers
+
+
+@implementer(ICongestionController)
 class Remy(object):
-    def __init__(self):
-        self.tree = WhiskerTree()
-        with open(os.path.join(HERE, 'remy.out.0')) as infile:
-            self.tree.ParseFromString(infile.read())
+    """
+    A congestion controller following the whisker tree in ``remy.out.0``,
+    generated by Remy. The tree is compiled once per process and shared by
+    every connection.
+
+    :param clock: An `IReactorTime`_ provider. Unused; Remy only needs the
+        times it's given.
+    :param random: Unused; Remy is deterministic.
+
+    .. _IReactorTime: http://twistedmatrix.com/documents/current/api/twisted.internet.interfaces.IReactorTime.html
+    """
+
+    trace = None
+
+    def __init__(self, clock, random=None):
+        self._whiskers = compiledWhiskers()
         self.lastReceivedAt = None
         self.rttMin = None
         self.recEWMA = 0
@@ -33,39 +176,29 @@ class Remy(object):
             self.slowRecEWMA = (1 - SLOW_ALPHA) * self.slowRecEWMA + SLOW_ALPHA * delta
             self.rttMin = min(rtt, self.rttMin)
         ratio = rtt / self.rttMin if self.rttMin else 1
-        whisker = self._findWhisker(self.recEWMA, self.slowRecEWMA, ratio)
-        self.window = whisker.window_increment + self.window * whisker.window_multiple
-        self.secPerMessage = whisker.intersend / 1000
-        self.rttTimeout = self.secPerMessage * self.window
+        windowIncrement, windowMultiple, intersend = self._whiskers.find(
+            self.recEWMA, self.slowRecEWMA, ratio)
+        self.window = windowIncrement + self.window * windowMultiple
+        self.secPerMessage = intersend / 1000
+        # Remy itself never times out; don't resend blocks that can't have
+        # been acked yet.
+        self.rttTimeout = max(self.secPerMessage * self.window, 2 * self.rttMin)
         self.lastReceivedAt = now
+        if self.trace is not None:
+            self.trace.record(
+                now, rtt, self.rttTimeout, self.secPerMessage, _nan, _nan,
+                self.window)
 
     def writerow(self, now, fobj):
         import csv
         csv.writer(fobj).writerow(
             (now, self.recEWMA, self.slowRecEWMA, self.rttMin, self.window, self.secPerMessage, self.rttTimeout))
 
-    def _memoryContainedBy(self, m, mr):
-        return (mr.lower.rec_rec_ewma <= m.rec_rec_ewma <= mr.upper.rec_rec_ewma
-                and mr.lower.slow_rec_rec_ewma <= m.slow_rec_rec_ewma <= mr.upper.slow_rec_rec_ewma
-                and mr.lower.rtt_ratio <= m.rtt_ratio <= mr.upper.rtt_ratio)
-
-    def _findWhisker(self, recEWMA, slowRecEWMA, rttRatio):
-        memory = Memory(
-            rec_rec_ewma=recEWMA, slow_rec_rec_ewma=slowRecEWMA,
-            rec_send_ewma=0, rtt_ratio=rttRatio)
-        node = self.tree
-        while True:
-            if node.HasField('leaf') and self._memoryContainedBy(memory, node.leaf.domain):
-                return node.leaf
-            for child in node.children:
-                if self._memoryContainedBy(memory, child.domain):
-                    node = child
-                    break
-            else:
-                raise ValueError('no nodes found for %s' % (memory,))
-
     def timedOut(self, now):
-        pass
+        if self.trace is not None:
+            self.trace.record(
+                now, _nan, self.rttTimeout, self.secPerMessage, _nan, _nan,
+                self.window)
 
     def nextMessageIn(self, now):
         return max(self.lastSentAt + self.secPerMessage - now, 0)
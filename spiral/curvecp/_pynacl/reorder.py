@@ -0,0 +1,92 @@
+from __future__ import absolute_import
+
+from interval import IntervalSet
+
+from spiral.curvecp._pynacl.interval import halfOpen
+
+
+class ReorderBuffer(object):
+    """
+    A fixed-size ring of bytes for stream data that arrived ahead of a gap.
+
+    Stream offset ``n`` is stored at ``n % maximum`` in the ring. Only the
+    *maximum* bytes starting at ``base``, the first byte not yet handed to the
+    application, can be held; anything past that is refused so that the peer
+    has to send it again later. The ring isn't allocated until something
+    actually needs to be buffered.
+    """
+
+    def __init__(self, maximum):
+        self.maximum = maximum
+        self.base = 0
+        self._ring = None
+        self._held = IntervalSet()
+
+    def __nonzero__(self):
+        return bool(self._held)
+
+    def __len__(self):
+        return sum(i.upper_bound - i.lower_bound for i in self._held)
+
+    def allocated(self):
+        """
+        Return how many bytes the ring takes up.
+        """
+        return 0 if self._ring is None else self.maximum
+
+    def accept(self, offset, data):
+        """
+        Store whatever part of *data*, starting at stream offset *offset*, fits
+        in the window.
+
+        :returns: The half-open interval that was stored, or ``None`` if none
+            of *data* fit.
+        """
+        lower = max(offset, self.base)
+        upper = min(offset + len(data), self.base + self.maximum)
+        if lower >= upper:
+            return None
+        if self._ring is None:
+            self._ring = bytearray(self.maximum)
+        view = memoryview(data)[lower - offset:upper - offset]
+        start = lower % self.maximum
+        first = min(len(view), self.maximum - start)
+        self._ring[start:start + first] = view[:first]
+        if first < len(view):
+            self._ring[:len(view) - first] = view[first:]
+        i = halfOpen(lower, upper)
+        self._held.add(i)
+        return i
+
+    def contiguous(self):
+        """
+        Return how many bytes are held starting exactly at ``base``.
+        """
+        if not self._held or self._held.lower_bound() != self.base:
+            return 0
+        return self._held[0].upper_bound - self.base
+
+    def read(self):
+        """
+        Remove and return every byte held contiguously from ``base``.
+        """
+        length = self.contiguous()
+        if not length:
+            return ''
+        start = self.base % self.maximum
+        end = start + length
+        if end <= self.maximum:
+            ret = str(self._ring[start:end])
+        else:
+            ret = str(self._ring[start:]) + str(self._ring[:end - self.maximum])
+        del self._held[0]
+        self.base += length
+        return ret
+
+    def skip(self, length):
+        """
+        Advance ``base`` past *length* bytes that were delivered without being
+        buffered.
+        """
+        self.base += length
+        self._held.difference_update([halfOpen(0, self.base)])
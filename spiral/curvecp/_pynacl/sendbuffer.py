@@ -0,0 +1,47 @@
+import collections
+
+
+class SendBuffer(object):
+    """
+    Bytes written to a transport that haven't been cut into blocks yet.
+
+    Writes are kept as the strings they were written as. Blocks are only cut
+    from the front once the transport is ready to send them, so every written
+    byte is copied at most once no matter how large the write was.
+    """
+
+    def __init__(self):
+        self._chunks = collections.deque()
+        self._chunkPos = 0
+        self.offset = 0
+        self.end = 0
+
+    def __len__(self):
+        return self.end - self.offset
+
+    def append(self, data):
+        self._chunks.append(data)
+        self.end += len(data)
+
+    def cut(self, size):
+        """
+        Remove up to *size* bytes from the front of the buffer.
+
+        :returns: A ``(offset, data)`` tuple, where *offset* is the stream
+            offset of the first byte of *data*.
+        """
+        offset = self.offset
+        pieces = []
+        wanted = size
+        while wanted and self._chunks:
+            chunk = self._chunks[0]
+            piece = chunk[self._chunkPos:self._chunkPos + wanted]
+            pieces.append(piece)
+            wanted -= len(piece)
+            self._chunkPos += len(piece)
+            if self._chunkPos == len(chunk):
+                self._chunks.popleft()
+                self._chunkPos = 0
+        data = pieces[0] if len(pieces) == 1 else ''.join(pieces)
+        self.offset += len(data)
+        return offset, data
@@ -1,12 +1,19 @@
+import collections
 import os
 import struct
 
 from nacl.exceptions import CryptoError
 from nacl.public import Box, PrivateKey, PublicKey
 from nacl.secret import SecretBox
+from twisted.internet import defer, threads
 from twisted.internet.protocol import DatagramProtocol
 from twisted.python import log
 
+from spiral.curvecp._pynacl.admission import AdmissionControl
+from spiral.curvecp._pynacl.keycache import SharedKeyCache
+from spiral.curvecp._pynacl.keypool import KeyPool
+from spiral.curvecp._pynacl.metrics import defaultMetrics
+from spiral.curvecp._pynacl.sessions import SessionTable
 from spiral.curvecp._pynacl.transport import CurveCPServerTransport
 from spiral.curvecp.util import dnsToName
 
@@ -17,89 +24,288 @@ _initiateStruct = struct.Struct('<8x16x16x32x16s80s8s')
 _initiateInnerStruct = struct.Struct('<32s16s48s256s')
 
 
+def _validLength(length):
+    return 80 <= length <= 1184 and not length & 0xf
+
+
+class CookieKeys(object):
+    """
+    The secret keys that cookies are encrypted under.
+
+    After a rotation, cookies made with the previous key are still accepted,
+    so rotating never invalidates a cookie that was just handed out. Several
+    dispatchers, possibly in different processes, can share keys so that an
+    Initiate is accepted no matter which of them made its cookie.
+
+    :param key: Optionally, the initial 32-byte key. Defaults to a random key.
+    """
+
+    def __init__(self, key=None):
+        self._current = self._makeBox(key)
+        self._previous = None
+
+    def _makeBox(self, key):
+        if key is None:
+            key = os.urandom(SecretBox.KEY_SIZE)
+        return SecretBox(key)
+
+    def rotate(self, key=None):
+        self._previous = self._current
+        self._current = self._makeBox(key)
+
+    def encrypt(self, plaintext, nonce):
+        return self._current.encrypt(plaintext, nonce).ciphertext
+
+    def decrypt(self, ciphertext, nonce):
+        try:
+            return self._current.decrypt(ciphertext, nonce)
+        except CryptoError:
+            if self._previous is None:
+                raise
+            return self._previous.decrypt(ciphertext, nonce)
+
+
 class CurveCPServerDispatcher(DatagramProtocol):
-    def __init__(self, reactor, serverKey, factory):
+    maxPendingHandshakes = 256
+
+    def __init__(self, reactor, serverKey, factory, cookieKeys=None, admission=None,
+                 threadPool=None, keyCache=None, keyPool=None, sessions=None,
+                 metrics=None, congestion=None, traceSize=0):
         self.reactor = reactor
         self.serverKey = serverKey
         self.factory = factory
-        self.transports = {}
-        self._secretBox = SecretBox(os.urandom(SecretBox.KEY_SIZE))
+        if metrics is None:
+            metrics = defaultMetrics
+        self.metrics = metrics
+        if cookieKeys is None:
+            cookieKeys = CookieKeys()
+        self.cookieKeys = cookieKeys
+        self.threadPool = threadPool
+        if keyCache is None:
+            keyCache = SharedKeyCache(metrics=metrics)
+        self.keyCache = keyCache
+        if keyPool is None:
+            keyPool = KeyPool(reactor, threadPool=threadPool, metrics=metrics)
+        self.keyPool = keyPool
+        if sessions is None:
+            sessions = SessionTable(reactor, metrics)
+        self.transports = sessions
+        if admission is None:
+            admission = AdmissionControl(reactor, metrics)
+        self.admission = admission
+        self.congestion = congestion
+        self.traceSize = traceSize
+        self._pendingHellos = 0
+        self._pendingInitiates = set()
+        self._threadPoolTrigger = None
 
-    def _replyWithCookie(self, data, host_port):
-        if len(data) != _helloStruct.size:
-            return
+    def startProtocol(self):
+        self.admission.start()
+        self.keyPool.start()
+        self.transports.start()
+
+    def stopProtocol(self):
+        self.admission.stop()
+        self.keyPool.stop()
+        self.transports.stop()
+        self.releaseThreadPool()
+
+    def ownThreadPool(self):
+        """
+        Take charge of stopping ``threadPool``: it's stopped when this
+        dispatcher stops listening, or when the reactor shuts down, whichever
+        comes first.
+        """
+        self._threadPoolTrigger = self.reactor.addSystemEventTrigger(
+            'during', 'shutdown', self._stopThreadPool)
+
+    def releaseThreadPool(self):
+        """
+        Stop ``threadPool`` now if this dispatcher owns it and it's still
+        running.
+        """
+        if self._threadPoolTrigger is not None:
+            self.reactor.removeSystemEventTrigger(self._threadPoolTrigger)
+            self._stopThreadPool()
+
+    def _stopThreadPool(self):
+        self._threadPoolTrigger = None
+        self.threadPool.stop()
+
+    def _pendingHandshakes(self):
+        return self._pendingHellos + len(self._pendingInitiates)
+
+    def _runCrypto(self, f, *args):
+        if self.threadPool is None:
+            return defer.maybeDeferred(f, *args)
+        return threads.deferToThreadPool(self.reactor, self.threadPool, f, *args)
+
+    def _openHello(self, data):
         serverExtension, clientExtension, clientShortPubkey, nonce, encrypted = _helloStruct.unpack(data)
         serverLongClientShort = Box(self.serverKey.key, PublicKey(clientShortPubkey))
         try:
             serverLongClientShort.decrypt(encrypted, 'CurveCP-client-H' + nonce)
         except CryptoError:
-            return
-        serverShortKey = PrivateKey.generate()
+            return None
+        return serverExtension, clientExtension, clientShortPubkey, serverLongClientShort
+
+    def _makeCookiePacket(self, hello, cookieNonce, serverShortKey):
+        serverExtension, clientExtension, clientShortPubkey, serverLongClientShort = hello
         unencryptedCookie = clientShortPubkey + str(serverShortKey)
-        cookieNonce = self.serverKey.nonce(longterm=True)
-        cookie = cookieNonce + self._secretBox.encrypt(unencryptedCookie, 'c' * 8 + cookieNonce).ciphertext
+        cookie = cookieNonce + self.cookieKeys.encrypt(unencryptedCookie, 'c' * 8 + cookieNonce)
         boxData = str(serverShortKey.public_key) + cookie
-        cookiePacket = (
+        return (
             'RL3aNMXK'
             + clientExtension
             + serverExtension
             + cookieNonce
             + serverLongClientShort.encrypt(boxData, 'CurveCPK' + cookieNonce).ciphertext)
-        self.transport.write(cookiePacket, host_port)
 
-    def _checkInitiate(self, clientID, data, host_port):
+    def _replyWithCookie(self, data, host_port):
+        if len(data) != _helloStruct.size:
+            return
+        if self._pendingHandshakes() >= self.maxPendingHandshakes:
+            self.admission.drop('helloBacklog')
+            return
+        self._pendingHellos += 1
+        d = self._runCrypto(self._openHello, data)
+        d.addBoth(self._helloFinished)
+        d.addCallback(self._cookieForHello)
+        d.addCallback(self._sendCookie, host_port)
+        d.addErrback(log.err, 'error replying to hello')
+
+    def _cookieForHello(self, hello):
+        if hello is None:
+            return None
+        # Key nonces come from disk and the key pool refills itself using the
+        # reactor, so both are taken on the reactor thread, and only once the
+        # Hello is known to be genuine.
+        return self._makeCookiePacket(
+            hello, self.serverKey.nonce(longterm=True), self.keyPool.get())
+
+    def _helloFinished(self, result):
+        self._pendingHellos -= 1
+        return result
+
+    def _sendCookie(self, cookiePacket, host_port):
+        if cookiePacket is None:
+            self.metrics.decryptFailures.inc()
+        elif self.transport is not None:
+            self.metrics.cookies.inc()
+            self.metrics.packetsOut.inc()
+            self.metrics.bytesOut.inc(len(cookiePacket))
+            self.transport.write(cookiePacket, host_port)
+
+    def _openInitiate(self, data):
         cookieNonce, encryptedCookie, nonce = _initiateStruct.unpack_from(data)
         try:
-            decryptedCookie = self._secretBox.decrypt(encryptedCookie, 'c' * 8 + cookieNonce)
+            decryptedCookie = self.cookieKeys.decrypt(encryptedCookie, 'c' * 8 + cookieNonce)
         except CryptoError:
-            return
+            return None
         clientShortPubkey = PublicKey(decryptedCookie[:32])
         serverShortKey = PrivateKey(decryptedCookie[32:])
         serverShortClientShort = Box(serverShortKey, clientShortPubkey)
         try:
             decrypted = serverShortClientShort.decrypt(data[176:], 'CurveCP-client-I' + nonce)
         except CryptoError:
-            return
+            return None
         clientPubkeyString, vouchNonce, encryptedVouch, serverDomain = _initiateInnerStruct.unpack_from(decrypted)
         clientPubkey = PublicKey(clientPubkeyString)
-        serverLongClientLong = Box(self.serverKey.key, clientPubkey)
+        serverLongClientLong = self.keyCache.box(self.serverKey.key, clientPubkey)
         try:
             vouchKey = serverLongClientLong.decrypt(encryptedVouch, 'CurveCPV' + vouchNonce)
         except CryptoError:
-            return
+            return None
         if vouchKey != str(clientShortPubkey):
+            return None
+        return clientPubkey, serverShortClientShort, serverDomain, decrypted[352:]
+
+    def _checkInitiate(self, clientID, data, host_port):
+        if clientID in self._pendingInitiates:
+            # The first copy is still being checked; if it turns out to be
+            # bad, the client will send the Initiate again.
+            self.admission.drop('initiatePending')
+            return
+        if self._pendingHandshakes() >= self.maxPendingHandshakes:
+            self.admission.drop('initiateBacklog')
             return
+        self._pendingInitiates.add(clientID)
+        d = self._runCrypto(self._openInitiate, data)
+        d.addBoth(self._initiateFinished, clientID)
+        d.addCallback(self._startTransport, clientID, host_port, self.reactor.seconds())
+        d.addErrback(log.err, 'error checking initiate')
+
+    def _initiateFinished(self, result, clientID):
+        self._pendingInitiates.discard(clientID)
+        return result
+
+    def _startTransport(self, result, clientID, host_port, receivedAt):
+        if result is None:
+            self.metrics.decryptFailures.inc()
+            return
+        if self.transport is None or clientID in self.transports:
+            return
+        clientPubkey, serverShortClientShort, serverDomain, message = result
+        log.msg('new client: %s' % clientID.encode('hex'), category='success')
         transport = CurveCPServerTransport(
             self.reactor, self.serverKey, self.factory, clientID,
-            clientPubkey, host_port, serverShortClientShort, dnsToName(serverDomain))
-        return transport, decrypted[352:]
+            clientPubkey, host_port, serverShortClientShort, dnsToName(serverDomain),
+            self.metrics, self.congestion, self.traceSize)
+        self.transports.add(clientID, transport)
+        transport.transport = self.transport
+        transport._handshakeStartedAt = receivedAt
+        transport.startProtocol()
+        transport._parseMessage(transport._now(), message)
+        transport.notifyFinish().addCallback(self._clientFinished, clientID)
+
+    def datagramsReceived(self, datagrams):
+        """
+        Handle a batch of ``(data, host_port)`` datagrams read all at once.
+        Datagrams for established sessions are grouped by client ID and each
+        session gets all of its datagrams in one go; everything else is handled
+        in order.
+        """
+        bySession = collections.OrderedDict()
+        transports = self.transports
+        for datagram in datagrams:
+            data = datagram[0]
+            clientID = data[8:72]
+            if (data[:8] != 'QvnQ5XlH' and clientID in transports
+                    and _validLength(len(data))):
+                session = bySession.get(clientID)
+                if session is None:
+                    session = bySession[clientID] = []
+                session.append(datagram)
+            else:
+                self.datagramReceived(*datagram)
+        for clientID, session in bySession.iteritems():
+            transports.deliver(clientID, session)
 
     def datagramReceived(self, data, host_port):
         l = len(data)
-        if l < 80 or l > 1184 or l & 0xf:
+        if not _validLength(l):
             return
 
         if data[:8] == 'QvnQ5XlH':
-            self._replyWithCookie(data, host_port)
+            self.metrics.packetsIn.inc()
+            self.metrics.bytesIn.inc(l)
+            self.metrics.hellos.inc()
+            if self.admission.admitHello(host_port[0]):
+                self._replyWithCookie(data, host_port)
             return
 
         clientID = data[8:72]
-        if clientID in self.transports:
-            self.transports[clientID].datagramReceived(data, host_port)
+        if self.transports.deliver(clientID, [(data, host_port)]):
             return
 
+        self.metrics.packetsIn.inc()
+        self.metrics.bytesIn.inc(l)
         if data[:8] != 'QvnQ5XlI':
             return
-        result = self._checkInitiate(clientID, data, host_port)
-        if result is None:
+        self.metrics.initiates.inc()
+        if not self.admission.admitInitiate(host_port[0]):
             return
-        log.msg('new client: %s' % clientID.encode('hex'), category='success')
-        transport, message = result
-        self.transports[clientID] = transport
-        transport.transport = self.transport
-        transport.startProtocol()
-        transport._parseMessage(transport._now(), message)
-        transport.notifyFinish().addCallback(self._clientFinished, clientID)
+        self._checkInitiate(clientID, data, host_port)
 
     def _clientFinished(self, ign, clientID):
-        del self.transports[clientID]
+        self.transports.remove(clientID)
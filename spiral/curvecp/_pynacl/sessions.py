@@ -0,0 +1,111 @@
+import collections
+
+from spiral.curvecp import errors as e
+from spiral.curvecp._pynacl.metrics import defaultMetrics
+
+
+class SessionTable(object):
+    """
+    The established sessions of a server dispatcher, keyed by client ID.
+
+    Sessions are kept in order of when they last received a valid message.
+    Every ``reapInterval`` seconds, sessions idle for longer than
+    ``idleTimeout`` are evicted, and then the least recently used sessions are
+    evicted until the estimated memory used by all of them is under
+    ``maxMemory``. Adding a session when there are already ``maxSessions``
+    evicts the least recently used one first. Evicted transports lose their
+    connections with ``CurveCPConnectionEvicted``.
+
+    The number of sessions evicted for each reason is kept in ``evicted`` and
+    exported as ``curvecp_sessions_evicted_total``.
+
+    :param reactor: An `IReactorTime`_ provider.
+    :param metrics: The ``CurveCPMetrics`` to count evictions in. Defaults to
+        ``defaultMetrics``.
+
+    .. _IReactorTime: http://twistedmatrix.com/documents/current/api/twisted.internet.interfaces.IReactorTime.html
+    """
+
+    maxSessions = 10000
+    idleTimeout = 600
+    maxMemory = 256 * 1024 * 1024
+    reapInterval = 5
+
+    def __init__(self, reactor, metrics=None):
+        if self.maxSessions < 1:
+            raise ValueError('maxSessions must be at least 1', self.maxSessions)
+        self.reactor = reactor
+        if metrics is None:
+            metrics = defaultMetrics
+        self.metrics = metrics
+        self.evicted = collections.Counter()
+        self._sessions = collections.OrderedDict()
+        self._reapCall = None
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __contains__(self, clientID):
+        return clientID in self._sessions
+
+    def __getitem__(self, clientID):
+        return self._sessions[clientID]
+
+    def start(self):
+        if self._reapCall is None:
+            self._reapCall = self.reactor.callLater(self.reapInterval, self._reap)
+
+    def stop(self):
+        if self._reapCall is not None:
+            self._reapCall.cancel()
+            self._reapCall = None
+
+    def add(self, clientID, transport):
+        while self._sessions and len(self._sessions) >= self.maxSessions:
+            self._evictOldest('sessions')
+        self._sessions[clientID] = transport
+
+    def remove(self, clientID):
+        self._sessions.pop(clientID, None)
+
+    def deliver(self, clientID, datagrams):
+        """
+        Pass a list of ``(data, host_port)`` datagrams on to the session for
+        *clientID*, if there is one.
+
+        :returns: True if there was a session.
+        """
+        transport = self._sessions.get(clientID)
+        if transport is None:
+            return False
+        lastActivity = transport._lastActivity
+        for data, host_port in datagrams:
+            transport.datagramReceived(data, host_port)
+        if transport._lastActivity != lastActivity and clientID in self._sessions:
+            self._sessions[clientID] = self._sessions.pop(clientID)
+        return True
+
+    def memoryEstimate(self):
+        """
+        Return roughly how many bytes all of the sessions are using.
+        """
+        return sum(t._memoryEstimate() for t in self._sessions.itervalues())
+
+    def _evictOldest(self, reason):
+        clientID, transport = self._sessions.popitem(last=False)
+        self.evicted[reason] += 1
+        self.metrics.evictions.inc(reason)
+        transport._abort(e.CurveCPConnectionEvicted(reason))
+
+    def _reap(self):
+        self._reapCall = self.reactor.callLater(self.reapInterval, self._reap)
+        idleSince = self.reactor.seconds() - self.idleTimeout
+        while self._sessions:
+            transport = next(self._sessions.itervalues())
+            if transport._lastActivity > idleSince:
+                break
+            self._evictOldest('idle')
+        memory = self.memoryEstimate()
+        while self._sessions and memory > self.maxMemory:
+            memory -= next(self._sessions.itervalues())._memoryEstimate()
+            self._evictOldest('memory')
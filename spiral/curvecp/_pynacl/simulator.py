@@ -0,0 +1,402 @@
+"""
+A deterministic, in-memory network for measuring CurveCP transports.
+
+A client transport and a server dispatcher are connected through a pair of
+simulated links, one in each direction, and everything runs on a virtual
+clock. Every random decision, both the links' and the congestion
+controllers', comes from one ``random.Random`` seeded per run, so a scenario
+run twice with the same seed behaves identically.
+"""
+
+from __future__ import division
+
+import functools
+import heapq
+import itertools
+import math
+import os
+import random
+
+from twisted.internet.address import IPv4Address
+from twisted.internet.base import DelayedCall
+from twisted.internet.protocol import Factory, Protocol
+
+from spiral.curvecp._pynacl.chicago import Chicago
+from spiral.curvecp._pynacl.keypool import KeyPool
+from spiral.curvecp._pynacl.metrics import CurveCPMetrics, Histogram, MetricsRegistry
+from spiral.curvecp._pynacl.server import CurveCPServerDispatcher
+from spiral.curvecp._pynacl.transport import CurveCPClientTransport
+from spiral.keys import EphemeralKey
+
+
+class VirtualClock(object):
+    """
+    An `IReactorTime`_ provider whose time only moves when it's told to.
+
+    Unlike ``twisted.internet.task.Clock``, calls are kept in a heap, so
+    scheduling stays cheap with thousands of packets in flight.
+
+    :param resolution: Optionally, the granularity of timers in seconds. Calls
+        are made at the next multiple of it at or after their time, the way a
+        real reactor's timers fire late. Calls made with ``callExactlyLater``,
+        which stand in for I/O waking the reactor up, aren't delayed.
+
+    .. _IReactorTime: http://twistedmatrix.com/documents/current/api/twisted.internet.interfaces.IReactorTime.html
+    """
+
+    def __init__(self, resolution=0):
+        self.now = 0
+        self.resolution = resolution
+        self._calls = []
+        self._counter = itertools.count()
+
+    def seconds(self):
+        return self.now
+
+    def _schedule(self, delay, exact, f, args, kwargs):
+        call = DelayedCall(
+            self.now + delay, f, args, kwargs, lambda call: None, self._push,
+            seconds=self.seconds)
+        call.exact = exact
+        self._push(call)
+        return call
+
+    def callLater(self, delay, f, *args, **kwargs):
+        return self._schedule(delay, False, f, args, kwargs)
+
+    def callExactlyLater(self, delay, f, *args, **kwargs):
+        return self._schedule(delay, True, f, args, kwargs)
+
+    def _due(self, call):
+        if call.exact or not self.resolution:
+            return call.time
+        return math.ceil(call.time / self.resolution) * self.resolution
+
+    def _push(self, call):
+        heapq.heappush(self._calls, (self._due(call), next(self._counter), call))
+
+    def getDelayedCalls(self):
+        return [call for _, _, call in self._calls if call.active()]
+
+    def runNext(self, until):
+        """
+        Move time forward to the next call and make it, unless there are no
+        calls before *until*.
+
+        :returns: True if a call was made.
+        """
+        calls = self._calls
+        while calls:
+            time, _, call = calls[0]
+            if time > until:
+                return False
+            heapq.heappop(calls)
+            if call.cancelled or call.called or self._due(call) != time:
+                # Superseded by a reset to an earlier time.
+                continue
+            if call.delayed_time:
+                call.activate_delay()
+                self._push(call)
+                continue
+            self.now = max(self.now, time)
+            call.called = 1
+            call.func(*call.args, **call.kw)
+            return True
+        return False
+
+
+class Link(object):
+    """
+    One direction of a simulated path.
+
+    Packets are serialized onto the link at *bandwidth* bytes per second,
+    waiting in a queue of at most *queueSize* bytes while the link is busy;
+    packets that don't fit are dropped. Each packet then takes *delay*
+    seconds, plus up to *jitter* more, to arrive. A fraction *loss* of the
+    packets are lost on the way, and a fraction *reorder* are held back by an
+    extra *delay* so that they arrive after packets sent later. Jitter can
+    reorder packets as well.
+
+    :param clock: An `IReactorTime`_ provider.
+    :param random: The ``random.Random`` to make decisions with.
+    :param receive: Called with ``(data, source)`` when a packet arrives.
+    :param source: The address packets appear to come from.
+
+    .. _IReactorTime: http://twistedmatrix.com/documents/current/api/twisted.internet.interfaces.IReactorTime.html
+    """
+
+    def __init__(self, clock, random, receive, source, bandwidth=None, delay=0,
+                 jitter=0, loss=0, reorder=0, queueSize=None):
+        self.clock = clock
+        self.random = random
+        self.receive = receive
+        self.source = source
+        self.bandwidth = bandwidth
+        self.delay = delay
+        self.jitter = jitter
+        self.loss = loss
+        self.reorder = reorder
+        self.queueSize = queueSize
+        self.sent = self.delivered = self.lost = self.queueDrops = 0
+        self.bytesDelivered = 0
+        self._busyUntil = 0
+
+    def send(self, data):
+        self.sent += 1
+        now = self.clock.seconds()
+        departure = now
+        if self.bandwidth is not None:
+            start = max(now, self._busyUntil)
+            queued = (start - now) * self.bandwidth
+            if self.queueSize is not None and queued + len(data) > self.queueSize:
+                self.queueDrops += 1
+                return
+            departure = self._busyUntil = start + len(data) / self.bandwidth
+        if self.loss and self.random.random() < self.loss:
+            self.lost += 1
+            return
+        arrival = departure + self.delay
+        if self.jitter:
+            arrival += self.random.random() * self.jitter
+        if self.reorder and self.random.random() < self.reorder:
+            arrival += self.delay
+        self.clock.callExactlyLater(arrival - now, self._arrived, data)
+
+    def _arrived(self, data):
+        self.delivered += 1
+        self.bytesDelivered += len(data)
+        self.receive(data, self.source)
+
+
+class _SimulatedPort(object):
+    def __init__(self, address, links):
+        self.address = address
+        self.links = links
+
+    def write(self, data, addr):
+        link = self.links.get(addr)
+        if link is not None:
+            link.send(data)
+
+    def getHost(self):
+        return IPv4Address('UDP', *self.address)
+
+
+class _SampledHistogram(Histogram):
+    def __init__(self, name, help, buckets):
+        Histogram.__init__(self, name, help, buckets)
+        self.values = []
+
+    def observe(self, value):
+        Histogram.observe(self, value)
+        self.values.append(value)
+
+
+class _SamplingRegistry(MetricsRegistry):
+    def histogram(self, name, help, buckets):
+        return self.register(_SampledHistogram(name, help, buckets))
+
+
+class _Source(Protocol):
+    def connectionMade(self):
+        self.factory.simulation._clientConnected()
+        self.transport.write(self.factory.payload)
+        self.transport.loseConnection()
+
+    def readConnectionLost(self):
+        pass
+
+    def connectionLost(self, reason):
+        self.factory.simulation._clientDone = True
+
+
+class _Sink(Protocol):
+    def connectionMade(self):
+        self.received = 0
+
+    def dataReceived(self, data):
+        self.received += len(data)
+        self.factory.simulation._serverReceived(len(data))
+
+    def readConnectionLost(self):
+        self.transport.loseConnection()
+
+    def connectionLost(self, reason):
+        self.factory.simulation._serverDone = True
+
+
+def percentile(values, fraction):
+    """
+    Return the value *fraction* of the way through the sorted *values*.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+class SimulationResult(object):
+    """
+    What happened during one run of a ``Simulation``.
+
+    Times are virtual seconds, except for ``cpuTime``, which is the real
+    processor time the run took.
+    """
+
+    def __init__(self, size, received, establishedAt, finishedAt, elapsed,
+                 cpuTime, metrics, forward, reverse, trace=None):
+        self.size = size
+        self.received = received
+        self.establishedAt = establishedAt
+        self.finishedAt = finishedAt
+        self.elapsed = elapsed
+        self.cpuTime = cpuTime
+        self.retransmits = metrics.retransmits.value
+        self.fastRetransmits = metrics.fastRetransmits.value
+        self.rtts = metrics.rtt.values
+        self.forward = forward
+        self.reverse = reverse
+        self.trace = trace
+
+    @property
+    def completed(self):
+        return self.finishedAt is not None
+
+    @property
+    def goodput(self):
+        """
+        Bytes per second delivered to the server, from the connection being
+        established until the last byte arrived.
+        """
+        if not self.completed or self.finishedAt <= self.establishedAt:
+            return None
+        return self.received / (self.finishedAt - self.establishedAt)
+
+    @property
+    def cpuPerMB(self):
+        if not self.received:
+            return None
+        return self.cpuTime / (self.received / 1e6)
+
+    def summary(self):
+        """
+        Describe the run in a few lines of text.
+        """
+        lines = []
+        if self.completed:
+            lines.append('transferred %d bytes in %.3fs: %.0f bytes/s goodput' % (
+                self.received, self.finishedAt - self.establishedAt, self.goodput))
+        else:
+            lines.append('only transferred %d of %d bytes in %.3fs' % (
+                self.received, self.size, self.elapsed))
+        lines.append('%d retransmits, %d queued fast' % (
+            self.retransmits, self.fastRetransmits))
+        lines.append('%d packets lost, %d dropped by queues' % (
+            self.forward.lost + self.reverse.lost,
+            self.forward.queueDrops + self.reverse.queueDrops))
+        if self.rtts:
+            lines.append('rtt min %.4f p50 %.4f p90 %.4f p99 %.4f max %.4f' % (
+                min(self.rtts), percentile(self.rtts, 0.5), percentile(self.rtts, 0.9),
+                percentile(self.rtts, 0.99), max(self.rtts)))
+        if self.received:
+            lines.append('%.3f cpu seconds per MB' % (self.cpuPerMB,))
+        return '\n'.join(lines)
+
+
+def _cpuTime():
+    times = os.times()
+    return times[0] + times[1]
+
+
+class Simulation(object):
+    """
+    A scenario sending data from a CurveCP client to a server over a
+    simulated path. The keyword arguments describe both directions of the
+    path, as for ``Link``; settings in ``forwardOverrides`` and
+    ``reverseOverrides`` apply to only the client-to-server or
+    server-to-client direction.
+
+    :param congestion: Optionally, the congestion controller class to use on
+        both ends. It's called with the clock and the run's ``random.Random``
+        as *random*. Defaults to ``Chicago``.
+    :param traceSize: Optionally, how many records of the client's congestion
+        controller state to keep, as ``SimulationResult.trace``.
+    :param timerResolution: Optionally, the granularity of the clock's timers,
+        as for ``VirtualClock``. Packet arrivals aren't affected.
+    """
+
+    clientAddress = '10.0.0.1', 10001
+    serverAddress = '10.0.0.2', 10002
+    serverExtension = '\0' * 16
+
+    def __init__(self, congestion=Chicago, traceSize=0, timerResolution=0, **link):
+        self.congestion = congestion
+        self.traceSize = traceSize
+        self.timerResolution = timerResolution
+        self.link = link
+        self.forwardOverrides = {}
+        self.reverseOverrides = {}
+
+    def _clientConnected(self):
+        self._establishedAt = self.clock.seconds()
+
+    def _serverReceived(self, count):
+        self._received += count
+        if self._received >= self._size:
+            self._finishedAt = self.clock.seconds()
+
+    def run(self, size, seed=0, timeLimit=600):
+        """
+        Send *size* bytes from the client to the server and close the
+        connection, stopping once both ends are closed or after *timeLimit*
+        virtual seconds.
+
+        :returns: A ``SimulationResult``.
+        """
+        self.clock = clock = VirtualClock(self.timerResolution)
+        rng = random.Random(seed)
+        metrics = CurveCPMetrics(_SamplingRegistry())
+        congestion = functools.partial(self.congestion, random=rng)
+        self._size = size
+        self._received = 0
+        self._establishedAt = self._finishedAt = None
+        self._clientDone = self._serverDone = False
+
+        serverFactory = Factory()
+        serverFactory.protocol = _Sink
+        serverFactory.simulation = self
+        # Without a pool, short-term keys are generated as they're needed,
+        # so background refills don't count towards the run's processor time.
+        dispatcher = CurveCPServerDispatcher(
+            clock, EphemeralKey(), serverFactory, keyPool=KeyPool(clock, 0, 0),
+            metrics=metrics, congestion=congestion)
+        clientFactory = Factory()
+        clientFactory.protocol = _Source
+        clientFactory.simulation = self
+        clientFactory.payload = '\0' * size
+        client = CurveCPClientTransport(
+            clock, dispatcher.serverKey.key.public_key, clientFactory,
+            self.serverAddress[0], self.serverAddress[1], self.serverExtension,
+            metrics=metrics, congestion=congestion, traceSize=self.traceSize)
+
+        forward = Link(
+            clock, rng, dispatcher.datagramReceived, self.clientAddress,
+            **dict(self.link, **self.forwardOverrides))
+        reverse = Link(
+            clock, rng, client.datagramReceived, self.serverAddress,
+            **dict(self.link, **self.reverseOverrides))
+        dispatcher.makeConnection(
+            _SimulatedPort(self.serverAddress, {self.clientAddress: reverse}))
+
+        startedAt = _cpuTime()
+        client.makeConnection(
+            _SimulatedPort(self.clientAddress, {self.serverAddress: forward}))
+        while not (self._clientDone and self._serverDone):
+            if not clock.runNext(timeLimit):
+                break
+        cpuTime = _cpuTime() - startedAt
+        dispatcher.doStop()
+
+        return SimulationResult(
+            size, self._received, self._establishedAt, self._finishedAt,
+            clock.seconds(), cpuTime, metrics, forward, reverse, client.trace)
@@ -0,0 +1,81 @@
+from twisted.internet.task import Clock
+
+from spiral.curvecp._pynacl.admission import AdmissionControl, TokenBucket, sourcePrefix
+from spiral.curvecp._pynacl.metrics import CurveCPMetrics, MetricsRegistry
+
+
+def test_tokenBucketRefills():
+    bucket = TokenBucket(2, 2, 0)
+    assert bucket.take(0)
+    assert bucket.take(0)
+    assert not bucket.take(0)
+    assert bucket.take(0.5)
+    assert not bucket.take(0.5)
+
+def test_tokenBucketCapsAtBurst():
+    bucket = TokenBucket(2, 2, 0)
+    assert bucket.isFull(100)
+    assert [bucket.take(100) for x in xrange(3)] == [True, True, False]
+
+def test_sourcePrefix():
+    assert sourcePrefix('10.0.0.1') == sourcePrefix('10.0.0.200')
+    assert sourcePrefix('10.0.0.1') != sourcePrefix('10.0.1.1')
+    assert sourcePrefix('2001:db8::1') == sourcePrefix('2001:db8::ffff:1')
+    assert sourcePrefix('2001:db8::1') != sourcePrefix('2001:db8:0:1::1')
+
+def makeAdmission():
+    clock = Clock()
+    metrics = CurveCPMetrics(MetricsRegistry())
+    admission = AdmissionControl(clock, metrics)
+    admission.prefixBurst = admission.prefixRate = 2
+    admission.helloBurst = admission.helloRate = 3
+    admission.__init__(clock, metrics)
+    admission.start()
+    return clock, admission
+
+def test_perPrefixLimit():
+    clock, admission = makeAdmission()
+    results = [admission.admitHello('10.0.0.%d' % x) for x in xrange(3)]
+    assert results == [True, True, False]
+    assert admission.admitHello('10.0.1.1')
+    assert admission.dropped == {'helloPrefix': 1}
+
+def test_globalLimit():
+    clock, admission = makeAdmission()
+    results = [admission.admitHello('10.0.%d.1' % x) for x in xrange(4)]
+    assert results == [True, True, True, False]
+    assert admission.dropped == {'helloGlobal': 1}
+
+def test_idlePrefixesArePruned():
+    clock, admission = makeAdmission()
+    admission.admitHello('10.0.0.1')
+    clock.advance(admission.lagCheckInterval)
+    assert admission._prefixBuckets
+    clock.advance(1)
+    assert not admission._prefixBuckets
+
+def test_lagShedsHellosBeforeInitiates():
+    clock, admission = makeAdmission()
+    clock.advance(admission.lagCheckInterval + admission.helloLagThreshold * 2)
+    assert not admission.admitHello('10.0.0.1')
+    assert admission.admitInitiate('10.0.0.1')
+    clock.advance(admission.lagCheckInterval + admission.initiateLagThreshold * 2)
+    assert not admission.admitInitiate('10.0.0.1')
+    clock.advance(admission.lagCheckInterval)
+    assert admission.lag == 0
+    assert admission.admitHello('10.0.0.1')
+    assert admission.dropped == {'helloLag': 1, 'initiateLag': 1}
+
+def test_stop():
+    clock, admission = makeAdmission()
+    admission.stop()
+    assert not clock.getDelayedCalls()
+
+def test_dropsAreExported():
+    clock, admission = makeAdmission()
+    for x in xrange(3):
+        admission.admitHello('10.0.0.1')
+    admission.drop('initiateBacklog')
+    lines = admission.metrics.registry.exposition().splitlines()
+    assert 'curvecp_admission_dropped_total{reason="helloPrefix"} 1' in lines
+    assert 'curvecp_admission_dropped_total{reason="initiateBacklog"} 1' in lines
@@ -0,0 +1,73 @@
+import itertools
+import random
+
+import pytest
+from twisted.internet.task import Clock
+from zope.interface.verify import verifyObject
+
+from spiral.curvecp._pynacl.chicago import Chicago
+from spiral.curvecp._pynacl.congestion import ICongestionController, controllerNamed
+from spiral.curvecp._pynacl.simulator import Simulation
+
+
+def test_controllerNamed():
+    assert controllerNamed('chicago') is Chicago
+    with pytest.raises(ValueError):
+        controllerNamed('spam')
+
+def test_chicagoProvidesInterface():
+    assert verifyObject(ICongestionController, Chicago(Clock()))
+
+def test_chicagoStartsAtClockTime():
+    clock = Clock()
+    clock.advance(5)
+    assert Chicago(clock).rttLastSpeedAdjustment == 5
+
+
+@pytest.fixture
+def Remy():
+    pytest.importorskip('google.protobuf')
+    return controllerNamed('remy')
+
+def test_remyProvidesInterface(Remy):
+    assert verifyObject(ICongestionController, Remy(Clock()))
+
+def test_remyFollowsWhiskers(Remy):
+    remy = Remy(Clock())
+    remy.processDelta(1, 0.1)
+    remy.processDelta(1.01, 0.1)
+    assert remy.window > 0
+    assert remy.secPerMessage > 0
+    assert remy.rttTimeout >= 0.2
+
+def test_remyTransfers(Remy):
+    result = Simulation(congestion=Remy, bandwidth=1e6, delay=0.01).run(50000)
+    assert result.completed
+    assert result.retransmits == 0
+
+def test_compiledWhiskersMatchTreeWalk(Remy):
+    from spiral.curvecp._pynacl import remy
+    tree = remy.loadWhiskerTree(remy.defaultWhiskersPath)
+    # The shipped leaves all have the same whisker; make them distinguishable,
+    # and nest a copy of the tree under one of them.
+    for i, child in enumerate(tree.children):
+        child.leaf.intersend = i
+    nested = tree.children[0]
+    nested.children.extend(tree.children[1:9])
+    for i, child in enumerate(nested.children):
+        child.leaf.intersend = 100 + i
+    nested.ClearField('leaf')
+    compiled = remy.CompiledWhiskers(tree)
+    rng = random.Random(0)
+    cuts = [0, 1, 3.044368535143499, 3.4462319024594823, 1.1847076805040853, 163840]
+    memories = [(rng.uniform(0, 10), rng.uniform(0, 10), rng.uniform(0, 3)) for x in xrange(500)]
+    memories.extend(itertools.product(cuts, repeat=3))
+    for memory in memories:
+        whisker = remy.walkWhiskerTree(tree, *memory)
+        assert compiled.find(*memory) == (
+            whisker.window_increment, whisker.window_multiple, whisker.intersend)
+    with pytest.raises(ValueError):
+        compiled.find(-1, 0, 0)
+
+def test_whiskersAreShared(Remy):
+    assert Remy(Clock())._whiskers is Remy(Clock())._whiskers
@@ -0,0 +1,28 @@
+from spiral.curvecp._pynacl.inflight import InFlightIndex
+
+
+class FakeBlock(object):
+    def __init__(self, lowerBound):
+        self.lowerBound = lowerBound
+
+
+def test_overlappingFindsOnlyTouchedBlocks():
+    blocks = [FakeBlock(x) for x in [0, 1024, 2048, 3072]]
+    index = InFlightIndex()
+    for block in reversed(blocks):
+        index.add(block)
+    assert list(index) == blocks
+    assert index.overlapping(1500, 2049) == blocks[1:3]
+    assert index.overlapping(0, 1) == blocks[:1]
+    assert index.overlapping(5000, 6000) == blocks[3:]
+
+def test_discard():
+    block, other = FakeBlock(0), FakeBlock(0)
+    index = InFlightIndex()
+    index.add(block)
+    index.discard(other)
+    assert block in index
+    assert other not in index
+    index.discard(block)
+    assert not index
+    assert index.overlapping(0, 10) == []
@@ -0,0 +1,37 @@
+from nacl.public import PrivateKey
+
+from spiral.curvecp._pynacl.keycache import SharedKeyCache
+from spiral.curvecp._pynacl.metrics import CurveCPMetrics, MetricsRegistry
+
+
+ourKey = PrivateKey.generate()
+theirKeys = [PrivateKey.generate().public_key for x in xrange(3)]
+
+def test_hitsAndMisses():
+    cache = SharedKeyCache(metrics=CurveCPMetrics(MetricsRegistry()))
+    box = cache.box(ourKey, theirKeys[0])
+    assert cache.box(ourKey, theirKeys[0]) is box
+    assert cache.box(ourKey, theirKeys[0]) is box
+    assert (cache.hits, cache.misses) == (2, 1)
+    lines = cache.metrics.registry.exposition().splitlines()
+    assert 'curvecp_key_cache_hits_total 2' in lines
+    assert 'curvecp_key_cache_misses_total 1' in lines
+
+def test_boxesMatchUncached():
+    cache = SharedKeyCache()
+    theirPrivate = PrivateKey.generate()
+    box = cache.box(ourKey, theirPrivate.public_key)
+    other = cache.box(theirPrivate, ourKey.public_key)
+    assert box.shared_key() == other.shared_key()
+
+def test_leastRecentlyUsedIsEvicted():
+    cache = SharedKeyCache(maxSize=2)
+    first = cache.box(ourKey, theirKeys[0])
+    cache.box(ourKey, theirKeys[1])
+    cache.box(ourKey, theirKeys[0])
+    cache.box(ourKey, theirKeys[2])
+    assert len(cache) == 2
+    assert cache.box(ourKey, theirKeys[0]) is first
+    assert cache.misses == 3
+    cache.box(ourKey, theirKeys[1])
+    assert cache.misses == 4
@@ -0,0 +1,62 @@
+from nacl.public import PrivateKey
+from twisted.internet.task import Clock
+
+from spiral.curvecp._pynacl.keypool import KeyPool
+from spiral.curvecp._pynacl.metrics import CurveCPMetrics, MetricsRegistry
+from spiral.curvecp._pynacl.test.test_server import FakeThreadPool, ThreadedClock
+
+
+def drain(clock):
+    while clock.getDelayedCalls():
+        clock.advance(0)
+
+def test_fillsToHighWaterInBatches():
+    clock = Clock()
+    pool = KeyPool(clock, lowWater=4, highWater=20)
+    pool.start()
+    pool._generateBatch()
+    assert len(pool) == pool.batchSize
+    drain(clock)
+    assert len(pool) == 20
+
+def test_refillsBelowLowWater():
+    clock = Clock()
+    pool = KeyPool(clock, lowWater=4, highWater=8)
+    pool.start()
+    drain(clock)
+    keys = [pool.get() for x in xrange(4)]
+    assert all(isinstance(k, PrivateKey) for k in keys)
+    assert not clock.getDelayedCalls()
+    pool.get()
+    assert clock.getDelayedCalls()
+    drain(clock)
+    assert len(pool) == 8
+    assert (pool.hits, pool.misses) == (5, 0)
+
+def test_emptyPoolGeneratesKeys():
+    pool = KeyPool(Clock(), metrics=CurveCPMetrics(MetricsRegistry()))
+    assert isinstance(pool.get(), PrivateKey)
+    assert (pool.hits, pool.misses) == (0, 1)
+    lines = pool.metrics.registry.exposition().splitlines()
+    assert 'curvecp_key_pool_hits_total 0' in lines
+    assert 'curvecp_key_pool_misses_total 1' in lines
+
+def test_stop():
+    clock = Clock()
+    pool = KeyPool(clock)
+    pool.start()
+    pool.stop()
+    assert not clock.getDelayedCalls()
+    pool.get()
+    assert not clock.getDelayedCalls()
+    pool.start()
+    assert clock.getDelayedCalls()
+
+def test_refillsInThreadPool():
+    threadPool = FakeThreadPool()
+    pool = KeyPool(ThreadedClock(), lowWater=4, highWater=8, threadPool=threadPool)
+    pool.start()
+    pool.start()
+    assert len(threadPool.calls) == 1
+    threadPool.runAll()
+    assert len(pool) == 8
@@ -1,6 +1,6 @@
 import pytest
 
-from spiral.curvecp._pynacl.message import Message
+from spiral.curvecp._pynacl.message import Message, MessageView, parseMessage
 from spiral.curvecp._pynacl.interval import halfOpen
 
 
@@ -56,3 +56,14 @@ messagePackRangesPairs = [
 @pytest.mark.parametrize(('input', 'expected'), messagePackRangesPairs)
 def test_messagePackRanges(input, expected):
     assert Message(0, 0, input, None, 0, '').pack_ranges().encode('hex') == expected.encode('hex')
+
+def test_parseMessageRoundTrips():
+    m = Message(
+        1, 2, [halfOpen(0, 256), halfOpen(300, 400), halfOpen(70000, 70001)],
+        'failure', 400, 'spam')
+    assert parseMessage(m.pack()) == m
+
+def test_messageViewDecodesRangesAsPairs():
+    view = MessageView(Message(1, 2, [halfOpen(10, 20), halfOpen(30, 40)], None, 7, 'eggs').pack())
+    assert (view.id, view.previousID, view.resolution, view.dataPos, view.data) == (1, 2, None, 7, 'eggs')
+    assert list(view.iterRanges()) == [(10, 20), (30, 40)]
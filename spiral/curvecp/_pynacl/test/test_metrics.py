@@ -0,0 +1,81 @@
+from twisted.web.test.requesthelper import DummyRequest
+
+from spiral.curvecp._pynacl.metrics import CurveCPMetrics, MetricsRegistry, MetricsResource
+
+
+def test_exposition():
+    registry = MetricsRegistry()
+    counter = registry.counter('things_total', 'Things.')
+    gauge = registry.gauge('level', 'The level.')
+    registry.gauge('answer', 'The answer.', lambda: 42)
+    counter.inc()
+    counter.inc(2)
+    gauge.inc(5)
+    gauge.dec(0.5)
+    assert registry.exposition() == '\n'.join([
+        '# HELP things_total Things.',
+        '# TYPE things_total counter',
+        'things_total 3',
+        '# HELP level The level.',
+        '# TYPE level gauge',
+        'level 4.5',
+        '# HELP answer The answer.',
+        '# TYPE answer gauge',
+        'answer 42',
+        '',
+    ])
+
+def test_histogram():
+    registry = MetricsRegistry()
+    histogram = registry.histogram('latency_seconds', 'Latency.', [0.5, 1])
+    for value in [0.25, 0.5, 0.75, 2]:
+        histogram.observe(value)
+    assert registry.exposition().splitlines()[2:] == [
+        'latency_seconds_bucket{le="0.5"} 2',
+        'latency_seconds_bucket{le="1"} 3',
+        'latency_seconds_bucket{le="+Inf"} 4',
+        'latency_seconds_sum 3.5',
+        'latency_seconds_count 4',
+    ]
+
+def test_labelledCounter():
+    registry = MetricsRegistry()
+    counter = registry.labelledCounter('drops_total', 'Drops.', 'reason')
+    counter.inc('lag')
+    counter.inc('backlog', 2)
+    counter.inc('lag')
+    assert registry.exposition().splitlines()[2:] == [
+        'drops_total{reason="backlog"} 2',
+        'drops_total{reason="lag"} 2',
+    ]
+
+class FakeTransport(object):
+    def __init__(self, unacked, queued):
+        self.unacked = unacked
+        self._messageQueue = [None] * queued
+
+    def _unackedBytes(self):
+        return self.unacked
+
+def test_transportGauges():
+    metrics = CurveCPMetrics(MetricsRegistry())
+    transports = [FakeTransport(100, 1), FakeTransport(50, 2)]
+    for t in transports:
+        metrics.track(t)
+    metrics.untrack(FakeTransport(0, 0))
+    lines = metrics.registry.exposition().splitlines()
+    assert 'curvecp_active_sessions 2' in lines
+    assert 'curvecp_bytes_in_flight 150' in lines
+    assert 'curvecp_queue_depth 3' in lines
+    metrics.untrack(transports.pop())
+    del transports[:]
+    assert 'curvecp_active_sessions 0' in metrics.registry.exposition().splitlines()
+
+def test_resource():
+    registry = MetricsRegistry()
+    registry.counter('things_total', 'Things.')
+    request = DummyRequest([''])
+    body = MetricsResource(registry).render_GET(request)
+    assert body == registry.exposition()
+    assert request.responseHeaders.getRawHeaders('content-type') == [
+        'text/plain; version=0.0.4']
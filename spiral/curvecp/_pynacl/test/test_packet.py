@@ -0,0 +1,30 @@
+import struct
+
+from nacl.public import Box, PrivateKey
+import pytest
+
+from spiral.curvecp._pynacl.interval import halfOpen
+from spiral.curvecp._pynacl.message import Message
+from spiral.curvecp._pynacl.packet import PacketBuilder
+
+
+nonceStruct = struct.Struct('<Q')
+box = Box(PrivateKey('\1' * 32), PrivateKey('\2' * 32).public_key)
+header = 'RL3aNMXM' + '\3' * 32
+
+messages = [
+    Message(0, 0, [], None, 0, ''),
+    Message(1, 7, [halfOpen(0, 300), halfOpen(400, 500)], None, 300, 'x' * 193),
+    Message(2, 0, [], 'success', 1024, '\1' * 1024),
+    Message(3, 0, [halfOpen(0, 18446744073709551616)], None, 0, 'spam'),
+]
+
+@pytest.mark.parametrize('message', messages)
+def test_buildMatchesMessagePack(message):
+    builder = PacketBuilder(header, 'CurveCP-server-M', box)
+    builder.build(1, Message(9, 9, [halfOpen(0, 9)], None, 9, '\xff' * 1024))
+    packet = builder.build(2, message)
+    nonce = nonceStruct.pack(2)
+    assert packet[:48] == header + nonce
+    expected = box.encrypt(message.pack(), 'CurveCP-server-M' + nonce).ciphertext
+    assert packet[48:] == expected
@@ -0,0 +1,34 @@
+from spiral.curvecp._pynacl.interval import halfOpen
+from spiral.curvecp._pynacl.reorder import ReorderBuffer
+
+
+def test_acceptClipsToTheWindow():
+    b = ReorderBuffer(8)
+    assert b.accept(4, '22223333') == halfOpen(4, 8)
+    assert b.accept(8, '3333') is None
+    assert len(b) == 4
+    assert b.read() == ''
+
+def test_readWrapsAroundTheRing():
+    b = ReorderBuffer(8)
+    assert b.accept(0, '111111') == halfOpen(0, 6)
+    assert b.read() == '111111'
+    assert b.accept(9, '3333') == halfOpen(9, 13)
+    assert b.accept(6, '222') == halfOpen(6, 9)
+    assert b.read() == '2223333'
+    assert b.base == 13
+    assert not b
+
+def test_acceptIgnoresDataAlreadyRead():
+    b = ReorderBuffer(8)
+    b.skip(4)
+    assert b.accept(0, '1111') is None
+    assert b.accept(2, '112222') == halfOpen(4, 8)
+    assert b.read() == '2222'
+
+def test_skipDropsHeldData():
+    b = ReorderBuffer(8)
+    b.accept(2, '2222')
+    b.skip(4)
+    assert b.contiguous() == 2
+    assert b.read() == '22'
@@ -0,0 +1,19 @@
+from spiral.curvecp._pynacl.sendbuffer import SendBuffer
+
+
+def test_cutSpansWrites():
+    b = SendBuffer()
+    b.append('spam')
+    b.append('eggs')
+    assert len(b) == 8
+    assert b.cut(3) == (0, 'spa')
+    assert b.cut(3) == (3, 'meg')
+    assert b.cut(3) == (6, 'gs')
+    assert not b
+    assert b.end == 8
+
+def test_cutReturnsWholeWritesUncopied():
+    data = 'x' * 100
+    b = SendBuffer()
+    b.append(data)
+    assert b.cut(1024)[1] is data
@@ -0,0 +1,307 @@
+import socket
+
+from nacl.public import PrivateKey
+import pytest
+from twisted.internet.error import CannotListenError
+from twisted.internet.protocol import Factory
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import AccumulatingProtocol, FakeDatagramTransport
+
+from spiral.curvecp._pynacl import transport, udp
+from spiral.curvecp._pynacl.endpoints import CurveCPServerEndpoint
+from spiral.curvecp._pynacl.keycache import SharedKeyCache
+from spiral.curvecp._pynacl.metrics import CurveCPMetrics, MetricsRegistry
+from spiral.curvecp._pynacl.server import CookieKeys, CurveCPServerDispatcher
+from spiral.curvecp._pynacl.test.test_transport import (
+    FakeKeydir, clientExtension, clientHostPort, clientLongKey, finishTransport,
+    serverExtension, serverLongKey)
+
+
+def makeDispatcher(clock, cookieKeys):
+    fac = Factory()
+    fac.protocol = AccumulatingProtocol
+    fac.protocolConnectionMade = None
+    dispatcher = CurveCPServerDispatcher(
+        clock, FakeKeydir(serverLongKey), fac, cookieKeys)
+    dispatcher.makeConnection(FakeDatagramTransport())
+    return dispatcher
+
+def makeClient(keyCache=None):
+    clock = Clock()
+    fac = Factory()
+    fac.protocol = AccumulatingProtocol
+    fac.protocolConnectionMade = None
+    client = transport.CurveCPClientTransport(
+        clock, serverLongKey.public_key, fac, '0.0.0.0', 1234,
+        serverExtension, FakeKeydir(clientLongKey), clientExtension, keyCache)
+    return finishTransport(clock, client, PrivateKey.generate())
+
+def handshake(helloDispatcher, initiateDispatcher, rotations=0, keyCache=None):
+    client = makeClient(keyCache)
+    helloDispatcher.datagramReceived(client.transport.written[-1][0], clientHostPort)
+    cookie = helloDispatcher.transport.written[-1][0]
+    for x in xrange(rotations):
+        helloDispatcher.cookieKeys.rotate()
+    client.datagramReceived(cookie, ('0.0.0.0', 1234))
+    initiateDispatcher.datagramReceived(client.transport.written[-1][0], clientHostPort)
+    return initiateDispatcher.transports
+
+def test_sharedCookieKeys():
+    clock = Clock()
+    keys = CookieKeys()
+    a, b = makeDispatcher(clock, keys), makeDispatcher(clock, keys)
+    assert len(handshake(a, b)) == 1
+
+def test_unsharedCookieKeys():
+    clock = Clock()
+    a, b = makeDispatcher(clock, CookieKeys()), makeDispatcher(clock, CookieKeys())
+    assert not handshake(a, b)
+
+def test_cookieSurvivesOneRotation():
+    dispatcher = makeDispatcher(Clock(), CookieKeys())
+    assert len(handshake(dispatcher, dispatcher, rotations=1)) == 1
+
+def test_cookieExpiresAfterTwoRotations():
+    dispatcher = makeDispatcher(Clock(), CookieKeys())
+    assert not handshake(dispatcher, dispatcher, rotations=2)
+
+def test_helloDroppedWhileLagging():
+    clock = Clock()
+    dispatcher = makeDispatcher(clock, CookieKeys())
+    clock.advance(1)
+    client = makeClient()
+    dispatcher.datagramReceived(client.transport.written[-1][0], clientHostPort)
+    assert not dispatcher.transport.written
+    assert dispatcher.admission.dropped == {'helloLag': 1}
+
+
+class ThreadedClock(Clock):
+    def callFromThread(self, f, *args, **kwargs):
+        f(*args, **kwargs)
+
+
+class FakeThreadPool(object):
+    def __init__(self):
+        self.calls = []
+
+    def callInThreadWithCallback(self, onResult, f, *args, **kwargs):
+        self.calls.append((onResult, f, args, kwargs))
+
+    def runAll(self):
+        calls, self.calls = self.calls, []
+        for onResult, f, args, kwargs in calls:
+            onResult(True, f(*args, **kwargs))
+
+def makeThreadedDispatcher():
+    dispatcher = makeDispatcher(ThreadedClock(), CookieKeys())
+    dispatcher.threadPool = FakeThreadPool()
+    return dispatcher
+
+def test_threadedHandshake():
+    dispatcher = makeThreadedDispatcher()
+    client = makeClient()
+    dispatcher.datagramReceived(client.transport.written[-1][0], clientHostPort)
+    assert not dispatcher.transport.written
+    dispatcher.threadPool.runAll()
+    client.datagramReceived(dispatcher.transport.written[-1][0], ('0.0.0.0', 1234))
+    initiate = client.transport.written[-1][0]
+    dispatcher.datagramReceived(initiate, clientHostPort)
+    dispatcher.datagramReceived(initiate, clientHostPort)
+    assert len(dispatcher.threadPool.calls) == 1
+    assert dispatcher.admission.dropped == {'initiatePending': 1}
+    assert not dispatcher.transports
+    dispatcher.threadPool.runAll()
+    assert len(dispatcher.transports) == 1
+    assert not dispatcher._pendingInitiates
+
+class CountingKeydir(FakeKeydir):
+    nonces = 0
+
+    def nonce(self, longterm=False):
+        self.nonces += 1
+        return FakeKeydir.nonce(self, longterm)
+
+def test_forgedHelloTakesNoNonce():
+    dispatcher = makeThreadedDispatcher()
+    dispatcher.serverKey = CountingKeydir(serverLongKey)
+    hello = makeClient().transport.written[-1][0]
+    dispatcher.datagramReceived(hello[:-1] + chr(ord(hello[-1]) ^ 1), clientHostPort)
+    dispatcher.threadPool.runAll()
+    assert dispatcher.serverKey.nonces == 0
+    assert not dispatcher.transport.written
+    dispatcher.datagramReceived(hello, clientHostPort)
+    assert dispatcher.serverKey.nonces == 0
+    dispatcher.threadPool.runAll()
+    assert dispatcher.serverKey.nonces == 1
+    assert len(dispatcher.transport.written) == 1
+
+class ThreadPoolReactor(ThreadedClock):
+    def __init__(self):
+        ThreadedClock.__init__(self)
+        self.triggers = {}
+        self.dispatchers = []
+
+    def addSystemEventTrigger(self, phase, event, f, *args, **kwargs):
+        trigger = object()
+        self.triggers[trigger] = f
+        self.dispatchers.append(f.__self__)
+        return trigger
+
+    def removeSystemEventTrigger(self, trigger):
+        del self.triggers[trigger]
+
+    def listenUDP(self, port, protocol):
+        listeningPort = FakeDatagramTransport()
+        listeningPort.stopListening = protocol.doStop
+        protocol.makeConnection(listeningPort)
+        return listeningPort
+
+class UnlistenableReactor(ThreadPoolReactor):
+    def listenUDP(self, port, protocol):
+        raise CannotListenError(None, port, None)
+
+def test_failedListenStopsHandshakeThreads():
+    reactor = UnlistenableReactor()
+    endpoint = CurveCPServerEndpoint(
+        reactor, 1234, FakeKeydir(serverLongKey), handshakeThreads=2)
+    failures = []
+    endpoint.listen(Factory()).addErrback(failures.append)
+    assert failures[0].check(CannotListenError)
+    [dispatcher] = reactor.dispatchers
+    assert not dispatcher.threadPool.started
+    assert not reactor.triggers
+
+def test_stopListeningStopsHandshakeThreads():
+    reactor = ThreadPoolReactor()
+    endpoint = CurveCPServerEndpoint(
+        reactor, 1234, FakeKeydir(serverLongKey), handshakeThreads=2)
+    ports = []
+    endpoint.listen(Factory()).addCallback(ports.append)
+    [dispatcher] = reactor.dispatchers
+    assert dispatcher.threadPool.started
+    ports[0].stopListening()
+    assert not dispatcher.threadPool.started
+    assert not reactor.triggers
+
+def test_shutdownStopsHandshakeThreadsOnce():
+    reactor = ThreadPoolReactor()
+    endpoint = CurveCPServerEndpoint(
+        reactor, 1234, FakeKeydir(serverLongKey), handshakeThreads=2)
+    ports = []
+    endpoint.listen(Factory()).addCallback(ports.append)
+    [dispatcher] = reactor.dispatchers
+    [stop] = reactor.triggers.values()
+    stop()
+    assert not dispatcher.threadPool.started
+    ports[0].stopListening()
+    assert dispatcher._threadPoolTrigger is None
+
+def test_handshakeBacklog():
+    dispatcher = makeThreadedDispatcher()
+    dispatcher.maxPendingHandshakes = 1
+    for x in xrange(2):
+        client = makeClient()
+        dispatcher.datagramReceived(client.transport.written[-1][0], clientHostPort)
+    assert len(dispatcher.threadPool.calls) == 1
+    assert dispatcher.admission.dropped == {'helloBacklog': 1}
+    assert dispatcher.admission.metrics is dispatcher.metrics
+    dispatcher.threadPool.runAll()
+    assert dispatcher._pendingHellos == 0
+    assert len(dispatcher.transport.written) == 1
+
+def test_returningClientHitsKeyCache():
+    dispatcher = makeDispatcher(Clock(), CookieKeys())
+    clientCache = SharedKeyCache()
+    handshake(dispatcher, dispatcher, keyCache=clientCache)
+    handshake(dispatcher, dispatcher, keyCache=clientCache)
+    assert len(dispatcher.transports) == 2
+    assert (dispatcher.keyCache.hits, dispatcher.keyCache.misses) == (1, 1)
+    assert (clientCache.hits, clientCache.misses) == (1, 1)
+
+def test_cookieUsesPooledKey():
+    clock = Clock()
+    dispatcher = makeDispatcher(clock, CookieKeys())
+    clock.advance(0)
+    pooled = len(dispatcher.keyPool)
+    assert len(handshake(dispatcher, dispatcher)) == 1
+    assert len(dispatcher.keyPool) == pooled - 1
+    assert dispatcher.keyPool.hits == 1
+
+def test_forgedHelloTakesNoPooledKey():
+    clock = Clock()
+    dispatcher = makeDispatcher(clock, CookieKeys())
+    clock.advance(0)
+    pooled = len(dispatcher.keyPool)
+    hello = makeClient().transport.written[-1][0]
+    dispatcher.datagramReceived(hello[:-1] + chr(ord(hello[-1]) ^ 1), clientHostPort)
+    assert len(dispatcher.keyPool) == pooled
+    assert dispatcher.keyPool.hits == dispatcher.keyPool.misses == 0
+
+def test_handshakeMetrics():
+    metrics = CurveCPMetrics(MetricsRegistry())
+    dispatcher = makeDispatcher(Clock(), CookieKeys())
+    dispatcher.metrics = metrics
+    transport, = handshake(dispatcher, dispatcher)._sessions.values()
+    assert (metrics.hellos.value, metrics.cookies.value, metrics.initiates.value) == (1, 1, 1)
+    assert metrics.packetsIn.value == 2
+    assert metrics.packetsOut.value == 1
+    assert metrics.handshakeTime.count == 1
+    assert metrics._transports
+    other = makeDispatcher(Clock(), CookieKeys())
+    other.metrics = metrics
+    handshake(dispatcher, other)
+    assert metrics.decryptFailures.value == 1
+
+
+class RecordingTransport(object):
+    _lastActivity = 0
+
+    def __init__(self, received):
+        self.received = received
+
+    def datagramReceived(self, data, host_port):
+        self.received.append(data)
+
+def messagePacket(clientID, tag):
+    return 'QvnQ5XlM' + clientID + tag * 24
+
+def test_batchesAreGroupedBySession():
+    dispatcher = makeDispatcher(Clock(), CookieKeys())
+    received = []
+    a, b = 'a' * 64, 'b' * 64
+    dispatcher.transports.add(a, RecordingTransport(received))
+    dispatcher.transports.add(b, RecordingTransport(received))
+    hello = makeClient().transport.written[-1][0]
+    dispatcher.datagramsReceived([
+        (messagePacket(a, '1'), clientHostPort),
+        (messagePacket(b, '2'), clientHostPort),
+        (hello, clientHostPort),
+        (messagePacket(a, '3'), clientHostPort),
+        (messagePacket(a, '4')[:-1], clientHostPort),
+    ])
+    assert received == [
+        messagePacket(a, '1'), messagePacket(a, '3'), messagePacket(b, '2')]
+    assert len(dispatcher.transport.written) == 1
+
+
+@pytest.mark.skipif(not hasattr(socket, 'SO_REUSEPORT'), reason='no SO_REUSEPORT')
+@pytest.mark.parametrize('batchSize', [0, 8])
+def test_reusedPortIsShared(request, batchSize):
+    from twisted.internet import reactor
+    if batchSize and not udp.available:
+        pytest.skip('recvmmsg is not available')
+    keys = CookieKeys()
+    ports = []
+    port = 0
+    for x in xrange(2):
+        endpoint = CurveCPServerEndpoint(
+            reactor, port, FakeKeydir(serverLongKey), reusePort=True,
+            cookieKeys=keys, batchSize=batchSize)
+        endpoint.listen(Factory()).addCallback(ports.append)
+        request.addfinalizer(ports[-1].stopListening)
+        port = ports[-1].getHost().port
+    assert ports[0].getHost().port == ports[1].getHost().port
+    for listeningPort in ports:
+        assert listeningPort.socket.getsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT)
+        assert listeningPort.protocol.cookieKeys is keys
+    assert isinstance(ports[0], udp.BatchedPort) == bool(batchSize)
@@ -0,0 +1,95 @@
+import pytest
+from twisted.internet.task import Clock
+
+from spiral.curvecp import errors as e
+from spiral.curvecp._pynacl.metrics import CurveCPMetrics, MetricsRegistry
+from spiral.curvecp._pynacl.server import CookieKeys
+from spiral.curvecp._pynacl.sessions import SessionTable
+from spiral.curvecp._pynacl.test.test_server import handshake, makeDispatcher
+
+
+class FakeTransport(object):
+    def __init__(self, memory=0):
+        self._lastActivity = 0
+        self.memory = memory
+        self.abortedWith = None
+
+    def datagramReceived(self, data, host_port):
+        if data == 'valid':
+            self._lastActivity += 1
+
+    def _abort(self, reason):
+        self.abortedWith = reason
+
+    def _memoryEstimate(self):
+        return self.memory
+
+def test_validMessagesRefreshSessions():
+    table = SessionTable(Clock())
+    table.maxSessions = 2
+    first, second = FakeTransport(), FakeTransport()
+    table.add('a', first)
+    table.add('b', second)
+    assert table.deliver('a', [('valid', None)])
+    assert not table.deliver('c', [('valid', None)])
+    table.add('c', FakeTransport())
+    assert 'a' in table and 'b' not in table
+    assert isinstance(second.abortedWith, e.CurveCPConnectionEvicted)
+    assert table.evicted == {'sessions': 1}
+
+def test_maxSessionsMustBePositive():
+    class EmptyTable(SessionTable):
+        maxSessions = 0
+    with pytest.raises(ValueError):
+        EmptyTable(Clock())
+
+def test_addingToAnEmptyTableNeverEvicts():
+    table = SessionTable(Clock())
+    table.maxSessions = 0
+    table.add('a', FakeTransport())
+    assert 'a' in table
+    assert not table.evicted
+
+def test_invalidMessagesDontRefreshSessions():
+    table = SessionTable(Clock())
+    table.maxSessions = 2
+    first = FakeTransport()
+    table.add('a', first)
+    table.add('b', FakeTransport())
+    table.deliver('a', [('invalid', None)])
+    table.add('c', FakeTransport())
+    assert 'a' not in table
+    assert first.abortedWith is not None
+
+def test_memoryCeiling():
+    clock = Clock()
+    table = SessionTable(clock, CurveCPMetrics(MetricsRegistry()))
+    table.maxMemory = 250
+    transports = [FakeTransport(100) for x in xrange(3)]
+    for x, t in enumerate(transports):
+        table.add(x, t)
+    assert table.memoryEstimate() == 300
+    table.start()
+    clock.advance(table.reapInterval)
+    assert len(table) == 2
+    assert transports[0].abortedWith is not None
+    assert table.evicted == {'memory': 1}
+    lines = table.metrics.registry.exposition().splitlines()
+    assert 'curvecp_sessions_evicted_total{reason="memory"} 1' in lines
+
+def test_idleSessionsAreEvicted():
+    clock = Clock()
+    dispatcher = makeDispatcher(clock, CookieKeys())
+    transport, = handshake(dispatcher, dispatcher)._sessions.values()
+    protocol = transport._protocol
+    d = protocol.transport.write('spam')
+    failures = []
+    d.addErrback(failures.append)
+    clock.advance(dispatcher.transports.idleTimeout + dispatcher.transports.reapInterval)
+    assert not dispatcher.transports
+    assert dispatcher.transports.evicted == {'idle': 1}
+    assert dispatcher.transports.metrics is dispatcher.metrics
+    assert protocol.closed
+    protocol.closedReason.trap(e.CurveCPConnectionEvicted)
+    failures[0].trap(e.CurveCPConnectionEvicted)
+    assert not transport._delayedCalls
@@ -0,0 +1,90 @@
+from spiral.curvecp._pynacl.simulator import Link, Simulation, VirtualClock, percentile
+
+
+class FakeRandom(object):
+    def __init__(self, value):
+        self.value = value
+
+    def random(self):
+        return self.value
+
+def makeLink(received, **kwargs):
+    clock = VirtualClock()
+    link = Link(clock, FakeRandom(0.5), lambda data, source: received.append(
+        (clock.seconds(), data)), ('10.0.0.1', 1), **kwargs)
+    return clock, link
+
+def runAll(clock):
+    while clock.runNext(float('inf')):
+        pass
+
+def test_virtualClockOrdersCalls():
+    clock = VirtualClock()
+    made = []
+    clock.callLater(2, made.append, 'b')
+    clock.callLater(1, made.append, 'a')
+    later = clock.callLater(1.5, made.append, 'later')
+    earlier = clock.callLater(3, made.append, 'earlier')
+    clock.callLater(1, made.append, 'cancelled').cancel()
+    later.reset(2.5)
+    earlier.reset(0.5)
+    runAll(clock)
+    assert made == ['earlier', 'a', 'b', 'later']
+    assert clock.seconds() == 2.5
+    assert not clock.getDelayedCalls()
+
+def test_virtualClockResolution():
+    clock = VirtualClock(resolution=1)
+    made = []
+    clock.callLater(0.5, lambda: made.append(('timer', clock.seconds())))
+    clock.callExactlyLater(0.75, lambda: made.append(('io', clock.seconds())))
+    runAll(clock)
+    assert made == [('io', 0.75), ('timer', 1)]
+
+def test_linkSerializesAndQueues():
+    received = []
+    clock, link = makeLink(received, bandwidth=1000, delay=0.5, queueSize=200)
+    for data in ['a' * 100, 'b' * 100, 'c' * 100]:
+        link.send(data)
+    runAll(clock)
+    assert received == [(0.6, 'a' * 100), (0.7, 'b' * 100)]
+    assert (link.sent, link.delivered, link.queueDrops) == (3, 2, 1)
+
+def test_linkJitterAndReorder():
+    received = []
+    clock, link = makeLink(received, delay=0.5, jitter=0.1, reorder=1)
+    link.send('spam')
+    runAll(clock)
+    assert received == [(1.05, 'spam')]
+
+def test_linkLoss():
+    received = []
+    clock, link = makeLink(received, loss=0.75)
+    link.send('spam')
+    runAll(clock)
+    assert not received
+    assert link.lost == 1
+
+def test_percentile():
+    assert percentile([], 0.5) is None
+    assert percentile([3, 1, 2, 4], 0.5) == 3
+    assert percentile([3, 1, 2, 4], 1) == 4
+
+def test_simulationCompletes():
+    result = Simulation(bandwidth=1e6, delay=0.01).run(20000)
+    assert result.completed
+    assert result.received == 20000
+    assert result.retransmits == 0
+    assert result.rtts and min(result.rtts) >= 0.02
+    assert 0 < result.goodput < 1e6
+    assert result.forward.lost == result.reverse.lost == 0
+
+def test_simulationIsDeterministic():
+    simulation = Simulation(bandwidth=1e6, delay=0.01, jitter=0.005, loss=0.05, reorder=0.05)
+    simulation.reverseOverrides['loss'] = 0
+    results = [simulation.run(20000, seed=3, timeLimit=60) for x in xrange(2)]
+    a, b = [(r.received, r.finishedAt, r.retransmits, r.rtts, r.forward.lost, r.reverse.lost)
+            for r in results]
+    assert a == b
+    assert results[0].forward.lost
+    assert not results[0].reverse.lost
@@ -0,0 +1,101 @@
+import io
+import math
+
+import pytest
+from twisted.internet.task import Clock
+
+from spiral.curvecp._pynacl.chicago import Chicago
+from spiral.curvecp._pynacl.simulator import Simulation
+from spiral.curvecp._pynacl.trace import TraceBuffer, dumpTraces, loadTrace, readTrace
+
+
+def fill(trace, count):
+    for x in xrange(count):
+        trace.record(x, x + 0.5, 1, 2, 3, 4, float('nan'))
+
+def test_recordsOldestFirst():
+    trace = TraceBuffer(4)
+    fill(trace, 3)
+    assert len(trace) == 3
+    assert [r[0] for r in trace.records()] == [0, 1, 2]
+
+def test_ringOverwritesOldest():
+    trace = TraceBuffer(4)
+    fill(trace, 10)
+    assert len(trace) == 4
+    assert trace.count == 10
+    assert [r[0] for r in trace.records()] == [6, 7, 8, 9]
+
+def test_dumpRoundTrips():
+    trace = TraceBuffer(4)
+    fill(trace, 6)
+    fobj = io.BytesIO()
+    trace.dump(fobj)
+    fobj.seek(0)
+    records = readTrace(fobj)
+    assert [r[:6] for r in records] == [r[:6] for r in trace.records()]
+    assert all(math.isnan(r[6]) for r in records)
+
+def test_readTraceRejectsOtherFiles():
+    with pytest.raises(ValueError):
+        readTrace(io.BytesIO('\0' * 16))
+
+def test_loadTrace(tmpdir):
+    pytest.importorskip('numpy')
+    trace = TraceBuffer(4)
+    fill(trace, 6)
+    path = tmpdir.join('trace')
+    with path.open('wb') as outfile:
+        trace.dump(outfile)
+    loaded = loadTrace(str(path))
+    assert list(loaded.time) == [2, 3, 4, 5]
+    assert list(loaded.rtt) == [2.5, 3.5, 4.5, 5.5]
+
+def test_chicagoRecords():
+    chicago = Chicago(Clock())
+    chicago.trace = TraceBuffer(4)
+    chicago.processDelta(1, 0.1)
+    chicago.timedOut(2)
+    (now, rtt, rttTimeout, _, _, _, window), timedOut = chicago.trace.records()
+    assert (now, rtt, rttTimeout) == (1, 0.1, chicago.rttTimeout)
+    assert math.isnan(window)
+    assert timedOut[0] == 2
+    assert math.isnan(timedOut[1])
+
+def test_remyRecords():
+    pytest.importorskip('google.protobuf')
+    from spiral.curvecp._pynacl.remy import Remy
+    remy = Remy(Clock())
+    remy.trace = TraceBuffer(4)
+    remy.processDelta(1, 0.1)
+    [record] = remy.trace.records()
+    assert record[0] == 1
+    assert record[6] == remy.window
+
+def test_simulatedTransportTraces():
+    result = Simulation(traceSize=64, delay=0.01).run(20000)
+    assert len(result.trace) > 0
+    assert Simulation(delay=0.01).run(20000).trace is None
+
+
+class FakeAddress(object):
+    transportHost = '10.0.0.1'
+    transportPort = 1234
+    longTermKey = '\1' * 32
+
+
+class FakeTransport(object):
+    def __init__(self, trace):
+        self.trace = trace
+
+    def getPeer(self):
+        return FakeAddress()
+
+def test_dumpTraces(tmpdir):
+    trace = TraceBuffer(4)
+    fill(trace, 2)
+    paths = dumpTraces([FakeTransport(None), FakeTransport(trace)], str(tmpdir))
+    assert len(paths) == 1
+    assert '10.0.0.1-1234-0101010101010101' in paths[0]
+    with open(paths[0], 'rb') as infile:
+        assert len(readTrace(infile)) == 2
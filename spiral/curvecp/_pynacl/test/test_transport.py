@@ -8,9 +8,10 @@ from twisted.internet.task import Clock
 from twisted.test.proto_helpers import AccumulatingProtocol, FakeDatagramTransport
 
 from spiral.curvecp import errors as e
-from spiral.curvecp._pynacl import transport
+from spiral.curvecp._pynacl import endpoints, transport, udp
 from spiral.curvecp._pynacl.interval import halfOpen
 from spiral.curvecp._pynacl.message import Message
+from spiral.curvecp._pynacl.reorder import ReorderBuffer
 from spiral.curvecp._pynacl.test.util import runUntilNext, nextCallIn
 
 
@@ -252,6 +253,79 @@ def test_sendingData(messageTransport):
     runUntilNext(t._clock)
     assert t._sendMessage.captured[0] == Message(1, 0, [], None, 0, 'hi')
 
+def test_fullWindowWaitsForAck(messageTransport):
+    t = messageTransport
+    t._congestion.window = 0
+    t.write('a' * 2048)
+    runUntilNext(t._clock)
+    runUntilNext(t._clock)
+    assert len(t._sendMessage.captured) == 1
+    assert t._delayedCalls['message'].getTime() - t._now() == 60
+    t._parseMessage(t._now(), Message(0, 1, [halfOpen(0, 1024)], None, 0, '').pack())
+    runUntilNext(t._clock)
+    assert t._sendMessage.captured[1].dataPos == 1024
+
+def test_lateWakeupSendsMessagesThatFellDue(messageTransport):
+    t = messageTransport
+    t._congestion.secPerMessage = 0.1
+    t.write('a' * 10240)
+    runUntilNext(t._clock)
+    assert len(t._sendMessage.captured) == 1
+    t._clock.advance(0.35)
+    assert len(t._sendMessage.captured) == 4
+    assert t._delayedCalls['message'].getTime() == pytest.approx(t._now() + 0.05)
+
+def test_lateWakeupBurstIsLimited(messageTransport):
+    t = messageTransport
+    t.pacingBurst = 2
+    t._congestion.secPerMessage = 0.1
+    t.write('a' * 10240)
+    runUntilNext(t._clock)
+    t._clock.advance(0.35)
+    assert len(t._sendMessage.captured) == 3
+    assert t._delayedCalls['message'].getTime() == pytest.approx(t._now() + 0.1)
+
+def sendBlocksAndAck(t, ranges):
+    t.fastRetransmitThreshold = 2048
+    t._congestion.secPerMessage = 0.001
+    t.write('a' * 5120)
+    t._clock.advance(0.0055)
+    assert len(t._sendMessage.captured) == 5
+    t._parseMessage(t._now(), Message(0, 5, ranges, None, 0, '').pack())
+    runUntilNext(t._clock)
+
+def test_ackGapFastRetransmits(messageTransport):
+    t = messageTransport
+    fastRetransmits = t._metrics.fastRetransmits.value
+    sendBlocksAndAck(t, [halfOpen(1024, 4096)])
+    assert t._metrics.fastRetransmits.value == fastRetransmits + 1
+    assert [m.dataPos for m in t._sendMessage.captured[5:]] == [0]
+
+def test_ackGapBelowThresholdWaits(messageTransport):
+    t = messageTransport
+    sendBlocksAndAck(t, [halfOpen(1024, 3072)])
+    assert len(t._sendMessage.captured) == 5
+
+def test_fastRetransmitIsNotRepeated(messageTransport):
+    t = messageTransport
+    sendBlocksAndAck(t, [halfOpen(1024, 4096)])
+    t._parseMessage(t._now(), Message(0, 6, [halfOpen(1024, 5120)], None, 0, '').pack())
+    runUntilNext(t._clock)
+    assert [m.dataPos for m in t._sendMessage.captured[5:]] == [0]
+
+def test_timeoutOfQueuedBlockIsNotDuplicated(messageTransport):
+    t = messageTransport
+    duplicates = t._metrics.duplicateRetransmits.value
+    t.fastRetransmitThreshold = 2048
+    t._congestion.secPerMessage = 0.001
+    t.write('a' * 5120)
+    t._clock.advance(0.0055)
+    t._congestion.secPerMessage = 100
+    t._parseMessage(t._now(), Message(0, 5, [halfOpen(1024, 4096)], None, 0, '').pack())
+    t._clock.advance(50)
+    assert t._metrics.duplicateRetransmits.value == duplicates + 1
+    assert sorted(qd.lowerBound for _, _, qd in t._messageQueue) == [0, 4096]
+
 def test_writeDeferredFires(messageTransport):
     t = messageTransport
     d = t.write('hi')
@@ -375,3 +449,244 @@ def test_messagesSendToLastHostWithValidPackets(serverMessageTransport):
     runUntilNext(t._clock)
     runUntilNext(t._clock)
     assert t.transport.written[1][1] == clientHostPort
+
+def test_ackWatermarkCompactsContiguousRanges(messageTransport):
+    t = messageTransport
+    t.write('x' * 3072)
+    t._clock.pump([1, 1, 1])
+    t._parseMessage(t._now(), Message(0, 1, [halfOpen(0, 0), halfOpen(1024, 2048)], None, 0, '').pack())
+    assert t._theyAckedUpTo == 0
+    assert list(t._theyAckedTail) == [halfOpen(1024, 2048)]
+    assert len(t._inFlight) == 2
+    t._parseMessage(t._now(), Message(0, 2, [halfOpen(0, 1024)], None, 0, '').pack())
+    assert t._theyAckedUpTo == 2048
+    assert not t._theyAckedTail
+    assert [qd.lowerBound for qd in t._inFlight] == [2048]
+
+def test_blocksAckedWhileAwaitingResendAreNotResent(messageTransport):
+    t = messageTransport
+    t.write('hi')
+    runUntilNext(t._clock)
+    qd, = t._inFlight
+    t._enqueue(0, qd)
+    t._parseMessage(t._now(), Message(0, 1, [halfOpen(0, 2)], None, 0, '').pack())
+    t._clock.advance(1)
+    assert len(t._sendMessage.captured) == 1
+    assert not t._inFlight
+
+def test_receivingDataPastTheReorderBufferIsNotAcked(messageTransport):
+    t = messageTransport
+    t._reorder = ReorderBuffer(8)
+    t._parseMessage(t._now(), Message(1, 0, [], None, 4, '2222').pack())
+    t._parseMessage(t._now(), Message(2, 0, [], None, 8, '3333').pack())
+    assert list(t._received) == [halfOpen(4, 8)]
+    t._parseMessage(t._now(), Message(3, 0, [], None, 0, '1111').pack())
+    assert t._protocol.data == '11112222'
+    t._parseMessage(t._now(), Message(4, 0, [], None, 8, '3333').pack())
+    assert t._protocol.data == '111122223333'
+
+def test_receivingDeliversTheContiguousPrefixPastAGap(messageTransport):
+    t = messageTransport
+    t._parseMessage(t._now(), Message(4, 0, [], None, 6, '444').pack())
+    t._parseMessage(t._now(), Message(1, 0, [], None, 0, '11').pack())
+    assert t._protocol.data == '11'
+    t._parseMessage(t._now(), Message(2, 0, [], None, 2, '22').pack())
+    assert t._protocol.data == '1122'
+    t._parseMessage(t._now(), Message(3, 0, [], None, 4, '33').pack())
+    assert t._protocol.data == '112233444'
+    assert list(t._received) == [halfOpen(0, 9)]
+
+def test_readConnectionClosesAfterTheLastGapFills(messageTransport):
+    t = messageTransport
+    t._parseMessage(t._now(), Message(1, 0, [], 'success', 4, '').pack())
+    t._parseMessage(t._now(), Message(2, 0, [], None, 2, 'am').pack())
+    t._parseMessage(t._now(), Message(3, 0, [], None, 0, 'sp').pack())
+    assert t._protocol.data == 'spam'
+    assert t._protocol.readsClosed
+
+def test_writingCutsBlocksOnlyWhenSending(messageTransport):
+    t = messageTransport
+    t.write('x' * 5000)
+    assert len(t._sendBuffer) == 5000
+    assert not t._messageQueue
+    runUntilNext(t._clock)
+    assert t._sendBuffer.offset == 1024
+    assert t._sendBuffer.cut(4000) == (1024, 'x' * 3976)
+    assert t._sendMessage.captured[0] == Message(1, 0, [], None, 0, 'x' * 1024)
+
+def test_writeDeferredWaitsForEarlierData(messageTransport):
+    t = messageTransport
+    t.write('hello')
+    d = t.write('world')
+    fired = []
+    d.addCallback(fired.append)
+    t._clock.pump([1, 1])
+    t._parseMessage(t._now(), Message(0, 2, [halfOpen(0, 0), halfOpen(5, 10)], None, 0, '').pack())
+    assert not fired
+    t._parseMessage(t._now(), Message(0, 1, [halfOpen(0, 10)], None, 0, '').pack())
+    assert fired[0] == t._now()
+
+
+class FakeProducer(object):
+    def __init__(self):
+        self.calls = []
+
+    def pauseProducing(self):
+        self.calls.append('pause')
+
+    def resumeProducing(self):
+        self.calls.append('resume')
+
+    def stopProducing(self):
+        self.calls.append('stop')
+
+def test_streamingProducerPausesAboveHighWater(messageTransport):
+    t = messageTransport
+    t.sendBufferHighWater = 2048
+    t.sendBufferLowWater = 1024
+    producer = FakeProducer()
+    t.registerProducer(producer, True)
+    t.write('x' * 2048)
+    assert producer.calls == []
+    t.write('x')
+    assert producer.calls == ['pause']
+    t._clock.pump([1, 1, 1])
+    t._parseMessage(t._now(), Message(0, 1, [halfOpen(0, 1024)], None, 0, '').pack())
+    assert producer.calls == ['pause']
+    t._parseMessage(t._now(), Message(0, 2, [halfOpen(0, 2048)], None, 0, '').pack())
+    assert producer.calls == ['pause', 'resume']
+
+def test_pullProducerIsAskedForMoreAsDataIsAcked(messageTransport):
+    t = messageTransport
+    producer = FakeProducer()
+    t.registerProducer(producer, False)
+    assert producer.calls == ['resume']
+    t.write('hi')
+    runUntilNext(t._clock)
+    t._parseMessage(t._now(), Message(0, 1, [halfOpen(0, 2)], None, 0, '').pack())
+    assert producer.calls == ['resume', 'resume']
+
+def test_pullProducerIsOnlyAskedOncePerWrite(messageTransport):
+    t = messageTransport
+    producer = FakeProducer()
+    t.registerProducer(producer, False)
+    t.write('hi')
+    t.write('there')
+    runUntilNext(t._clock)
+    t._parseMessage(t._now(), Message(0, 1, [halfOpen(0, 2)], None, 0, '').pack())
+    t._parseMessage(t._now(), Message(0, 2, [halfOpen(0, 7)], None, 0, '').pack())
+    assert producer.calls == ['resume', 'resume']
+    t.write('!')
+    runUntilNext(t._clock)
+    t._parseMessage(t._now(), Message(0, 3, [halfOpen(0, 8)], None, 0, '').pack())
+    assert producer.calls == ['resume', 'resume', 'resume']
+
+def test_registeringTwoProducersFails(messageTransport):
+    t = messageTransport
+    t.registerProducer(FakeProducer(), True)
+    with pytest.raises(RuntimeError):
+        t.registerProducer(FakeProducer(), True)
+    t.unregisterProducer()
+    t.registerProducer(FakeProducer(), True)
+
+def test_pausingHoldsReceivedData(messageTransport):
+    t = messageTransport
+    t.pauseProducing()
+    t._parseMessage(t._now(), Message(1, 0, [], None, 0, 'spam').pack())
+    t._parseMessage(t._now(), Message(2, 0, [], 'success', 4, '').pack())
+    assert t._protocol.data == ''
+    assert not t._protocol.readsClosed
+    t.resumeProducing()
+    assert t._protocol.data == 'spam'
+    assert t._protocol.readsClosed
+
+def test_retransmissionsShareOneDelayedCall(messageTransport):
+    t = messageTransport
+    t.write('x' * 4096)
+    t._clock.pump([1, 1, 1, 1])
+    assert len(t._retransmitAt) == 4
+    timeouts = [c for c in t._clock.getDelayedCalls() if c.args == ('timeout',)]
+    assert len(timeouts) == 1
+    assert timeouts[0].getTime() == 11
+    t._parseMessage(t._now(), Message(0, 1, [halfOpen(0, 1024)], None, 0, '').pack())
+    assert timeouts[0].getTime() == 11
+    t._clock.advance(7)
+    assert len(t._sendMessage.captured) == 4
+    t._clock.advance(1)
+    assert [m.dataPos for m in t._sendMessage.captured[4:]] == [1024]
+    t._parseMessage(t._now(), Message(0, 2, [halfOpen(0, 4096)], None, 0, '').pack())
+    assert not t._retransmitAt
+    assert not [c for c in t._clock.getDelayedCalls() if c.args == ('timeout',)]
+
+def test_delayedAcksAreCoalesced(messageTransport):
+    t = messageTransport
+    t.ackDelay = 0.5
+    t.ackEvery = 3
+    t._parseMessage(t._now(), Message(1, 0, [], None, 0, 'sp').pack())
+    t._parseMessage(t._now(), Message(2, 0, [], None, 2, 'am').pack())
+    t._clock.advance(0.25)
+    assert not t._sendMessage.captured
+    t._clock.advance(0.25)
+    assert t._sendMessage.captured == [Message(0, 2, [halfOpen(0, 4)], None, 0, '')]
+    t._parseMessage(t._now(), Message(3, 0, [], None, 4, 'e').pack())
+    t._parseMessage(t._now(), Message(4, 0, [], None, 5, 'g').pack())
+    t._parseMessage(t._now(), Message(5, 0, [], None, 6, 'gs').pack())
+    t._clock.advance(0)
+    assert t._sendMessage.captured[1:] == [Message(0, 5, [halfOpen(0, 8)], None, 0, '')]
+
+def test_delayedAcksRideAlongWithData(messageTransport):
+    t = messageTransport
+    t.ackDelay = 5
+    t.ackEvery = 10
+    t._parseMessage(t._now(), Message(1, 0, [], None, 0, 'spam').pack())
+    t.write('eggs')
+    t._clock.pump([1, 5])
+    assert t._sendMessage.captured == [Message(1, 1, [halfOpen(0, 4)], None, 0, 'eggs')]
+
+def test_coalescedAcksForgetEarlierMessages(messageTransport):
+    t = messageTransport
+    t.write('x' * 3072)
+    t._clock.pump([1, 1, 1])
+    assert sorted(t._sentMessageAt) == [1, 2, 3]
+    t._parseMessage(t._now(), Message(0, 2, [halfOpen(0, 2048)], None, 0, '').pack())
+    assert sorted(t._sentMessageAt) == [3]
+    assert t._congestion.rtts == [1]
+
+def test_reorderedNoncesAreAcceptedOnce(messageTransport):
+    t = messageTransport
+    t._theirLastNonce = -1
+    t._seenNonces = 0
+    latePackets = t._metrics.latePackets.value
+    nonces = [nonceStruct.pack(n) for n in [3, 1, 2, 1, 3, 2000, 976, 977, 977]]
+    assert [t._verifyNonce(n) for n in nonces] == [
+        'newest', 'late', 'late', None, None, 'newest', None, 'late', None]
+    assert t._metrics.latePackets.value == latePackets + 3
+
+def test_reorderedPacketsAreDelivered(serverMessageTransport):
+    t = serverMessageTransport
+    latePackets = t._metrics.latePackets.value
+    t.datagramReceived(clientNullMessage(2), clientHostPort)
+    t.datagramReceived(clientNullMessage(1), clientHostPort)
+    t.datagramReceived(clientNullMessage(1), clientHostPort2)
+    assert t._metrics.latePackets.value == latePackets + 1
+    assert t._peerHost == clientHostPort
+
+def test_latePacketDoesNotMovePeer(serverMessageTransport):
+    t = serverMessageTransport
+    t.datagramReceived(clientNullMessage(3), clientHostPort2)
+    t.datagramReceived(clientNullMessage(2), clientHostPort)
+    assert t._peerHost == clientHostPort2
+    t.datagramReceived(clientNullMessage(4), clientHostPort)
+    assert t._peerHost == clientHostPort
+
+def test_unavailableBatchingFailsBeforeBuildingTransport(monkeypatch):
+    built = []
+    monkeypatch.setattr(udp, 'available', False)
+    monkeypatch.setattr(
+        endpoints, 'CurveCPClientTransport', lambda *a, **kw: built.append(a))
+    endpoint = endpoints.CurveCPClientEndpoint(
+        Clock(), '127.0.0.1', 1234, serverLongKey.public_key, batchSize=8)
+    failures = []
+    endpoint.connect(Factory()).addErrback(failures.append)
+    failures[0].trap(NotImplementedError)
+    assert not built
@@ -0,0 +1,162 @@
+import socket
+import struct
+
+import pytest
+from twisted.internet import reactor
+from twisted.internet.protocol import DatagramProtocol
+
+from spiral.curvecp._pynacl import udp
+
+
+pytestmark = pytest.mark.skipif(not udp.available, reason='recvmmsg is not available')
+
+
+@pytest.fixture
+def socketPair(request):
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(('127.0.0.1', 0))
+    receiver.setblocking(False)
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sender.bind(('127.0.0.1', 0))
+    request.addfinalizer(receiver.close)
+    request.addfinalizer(sender.close)
+    return receiver, sender
+
+def test_parseSockaddr():
+    ipv4 = '\x02\x00\x04\xd2\x7f\x00\x00\x01' + '\0' * 8
+    ipv6 = (
+        '\x0a\x00\x04\xd2\x00\x00\x00\x05' + socket.inet_pton(socket.AF_INET6, '::1')
+        + struct.pack('=I', 2))
+    assert udp.parseSockaddr(ipv4) == ('127.0.0.1', 1234)
+    assert udp.parseSockaddr(ipv6) == ('::1', 1234, 5, 2)
+
+def test_readerReceivesBatches(socketPair):
+    receiver, sender = socketPair
+    for x in xrange(5):
+        sender.sendto('spam %d' % (x,), receiver.getsockname())
+    reader = udp.DatagramBatchReader(3, 64)
+    senderAddr = sender.getsockname()
+    assert reader.recv(receiver.fileno()) == [
+        ('spam 0', senderAddr), ('spam 1', senderAddr), ('spam 2', senderAddr)]
+    assert reader.recv(receiver.fileno()) == [('spam 3', senderAddr), ('spam 4', senderAddr)]
+    with pytest.raises(socket.error):
+        reader.recv(receiver.fileno())
+
+def test_readerReportsIPv6AddressesLikeRecvfrom(request):
+    receiver = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+    sender = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+    request.addfinalizer(receiver.close)
+    request.addfinalizer(sender.close)
+    try:
+        receiver.bind(('::1', 0))
+        sender.bind(('::1', 0))
+    except socket.error:
+        pytest.skip('IPv6 loopback is not available')
+    sender.sendto('spam', receiver.getsockname())
+    reader = udp.DatagramBatchReader(1, 64)
+    assert reader.recv(receiver.fileno()) == [('spam', sender.getsockname())]
+
+
+class BatchProtocol(DatagramProtocol):
+    def __init__(self):
+        self.batches = []
+
+    def datagramsReceived(self, datagrams):
+        self.batches.append(datagrams)
+
+
+class SingleProtocol(DatagramProtocol):
+    def __init__(self):
+        self.datagrams = []
+
+    def datagramReceived(self, data, host_port):
+        self.datagrams.append(data)
+
+def makePort(request, socketPair, protocol):
+    receiver, sender = socketPair
+    port = udp.BatchedPort._fromListeningDescriptor(
+        reactor, receiver.fileno(), socket.AF_INET, protocol, 2048)
+    port.batchSize = 2
+    port.startListening()
+
+    def stop():
+        reactor.removeReader(port)
+        port.socket.close()
+
+    request.addfinalizer(stop)
+    return port
+
+def test_portDeliversBatches(request, socketPair):
+    protocol = BatchProtocol()
+    port = makePort(request, socketPair, protocol)
+    receiver, sender = socketPair
+    for x in xrange(3):
+        sender.sendto('spam %d' % (x,), receiver.getsockname())
+    port.doRead()
+    assert [[data for data, addr in batch] for batch in protocol.batches] == [
+        ['spam 0', 'spam 1'], ['spam 2']]
+
+def test_portFallsBackToSingleDatagrams(request, socketPair):
+    protocol = SingleProtocol()
+    port = makePort(request, socketPair, protocol)
+    receiver, sender = socketPair
+    for x in xrange(3):
+        sender.sendto('spam %d' % (x,), receiver.getsockname())
+    port.doRead()
+    assert protocol.datagrams == ['spam 0', 'spam 1', 'spam 2']
+
+def test_packSockaddr():
+    assert udp.parseSockaddr(udp.packSockaddr(('127.0.0.1', 1234))) == ('127.0.0.1', 1234)
+    assert udp.parseSockaddr(udp.packSockaddr(('::1', 1234))) == ('::1', 1234, 0, 0)
+    assert udp.parseSockaddr(udp.packSockaddr(('::1', 1234, 5, 2))) == ('::1', 1234, 5, 2)
+    with pytest.raises(socket.error):
+        udp.packSockaddr(('localhost', 1234))
+
+def drain(receiver):
+    ret = []
+    while True:
+        try:
+            ret.append(receiver.recv(2048))
+        except socket.error:
+            return ret
+
+@pytest.mark.parametrize('gso', [True, False])
+def test_writerSendsDatagrams(socketPair, gso):
+    receiver, sender = socketPair
+    addr = receiver.getsockname()
+    writer = udp.DatagramBatchWriter(2, gso=gso)
+    datagrams = [('a' * 100, addr), ('b' * 100, addr), ('c' * 50, addr), ('d' * 100, addr)]
+    assert writer.send(sender.fileno(), datagrams) == ([], [])
+    assert drain(receiver) == [data for data, addr in datagrams]
+
+def test_writerCoalescesRunsToOnePeer():
+    writer = udp.DatagramBatchWriter(8)
+    addr = '127.0.0.1', 1234
+    other = '127.0.0.1', 1235
+    messages = writer._coalesce(
+        [('a' * 100, addr), ('b' * 100, addr), ('c' * 50, addr), ('d' * 100, addr),
+         ('e' * 100, other)], [])
+    assert [(payload, segmentSize) for payload, name, segmentSize, run in messages] == [
+        ('a' * 100 + 'b' * 100 + 'c' * 50, 100), ('d' * 100, 0), ('e' * 100, 0)]
+
+def test_writerReturnsUnsendableDatagrams(socketPair):
+    receiver, sender = socketPair
+    writer = udp.DatagramBatchWriter(2)
+    datagram = 'spam', ('localhost', receiver.getsockname()[1])
+    assert writer.send(sender.fileno(), [datagram]) == ([], [datagram])
+
+def test_portQueuesWrites(request, socketPair):
+    receiver, sender = socketPair
+    port = makePort(request, socketPair, BatchProtocol())
+    addr = sender.getsockname()
+    port.write('spam', addr)
+    assert port._flushCall is not None
+    sender.setblocking(False)
+    assert drain(sender) == []
+    port.write('eggs', addr)
+    assert port._flushCall is None
+    assert drain(sender) == ['spam', 'eggs']
+    port.write('ham', addr)
+    port.flushWrites()
+    assert port._flushCall is None
+    assert drain(sender) == ['ham']
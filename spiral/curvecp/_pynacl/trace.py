@@ -0,0 +1,117 @@
+import os
+import struct
+
+
+traceFields = (
+    'time', 'rtt', 'rttTimeout', 'secPerMessage', 'rttHighwater', 'rttLowwater',
+    'window')
+_record = struct.Struct('<%dd' % (len(traceFields),))
+_header = struct.Struct('<8sII')
+_magic = 'CCPTRACE'
+
+
+class TraceBuffer(object):
+    """
+    A fixed-size ring of a congestion controller's state, kept as packed
+    doubles. Once *size* records have been made, each new one overwrites the
+    oldest.
+
+    Each record is the fields named in ``traceFields``. State a controller
+    doesn't have is recorded as NaN.
+
+    :param size: How many records to keep.
+    """
+
+    def __init__(self, size=4096):
+        self.size = size
+        self.count = 0
+        self._buffer = bytearray(size * _record.size)
+        self._offset = 0
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def record(self, now, rtt, rttTimeout, secPerMessage, rttHighwater,
+               rttLowwater, window):
+        _record.pack_into(
+            self._buffer, self._offset, now, rtt, rttTimeout, secPerMessage,
+            rttHighwater, rttLowwater, window)
+        self._offset += _record.size
+        if self._offset == len(self._buffer):
+            self._offset = 0
+        self.count += 1
+
+    def _ordered(self):
+        if self.count <= self.size:
+            return str(self._buffer[:self._offset])
+        return str(self._buffer[self._offset:] + self._buffer[:self._offset])
+
+    def records(self):
+        """
+        Return the kept records, oldest first, as tuples of floats.
+        """
+        data = self._ordered()
+        return [_record.unpack_from(data, offset)
+                for offset in xrange(0, len(data), _record.size)]
+
+    def dump(self, fobj):
+        """
+        Write the kept records, oldest first, to the binary file *fobj*.
+        """
+        data = self._ordered()
+        fobj.write(_header.pack(_magic, len(traceFields), len(data) // _record.size))
+        fobj.write(data)
+
+
+def _readHeader(fobj):
+    magic, fields, count = _header.unpack(fobj.read(_header.size))
+    if magic != _magic or fields != len(traceFields):
+        raise ValueError('not a trace dump')
+    return count
+
+
+def readTrace(fobj):
+    """
+    Read a dump written by ``TraceBuffer.dump`` from *fobj*.
+
+    :returns: A list of tuples of floats.
+    """
+    count = _readHeader(fobj)
+    data = fobj.read(count * _record.size)
+    return [_record.unpack_from(data, offset)
+            for offset in xrange(0, len(data), _record.size)]
+
+
+def loadTrace(path):
+    """
+    Load a dump written by ``TraceBuffer.dump`` from the file at *path* for
+    analysis. Needs NumPy.
+
+    :returns: A NumPy record array with a field for each of ``traceFields``.
+    """
+    import numpy
+    with open(path, 'rb') as infile:
+        count = _readHeader(infile)
+        dtype = numpy.dtype([(name, '<f8') for name in traceFields])
+        return numpy.fromfile(infile, dtype=dtype, count=count).view(numpy.recarray)
+
+
+def dumpTraces(transports, directory):
+    """
+    Dump the trace of every one of *transports* that has one into
+    *directory*, one file per transport, named for the process and the peer.
+
+    :returns: The paths written.
+    """
+    paths = []
+    for transport in transports:
+        if transport.trace is None:
+            continue
+        peer = transport.getPeer()
+        path = os.path.join(directory, 'curvecp-%d-%s-%d-%s.trace' % (
+            os.getpid(), peer.transportHost, peer.transportPort,
+            str(peer.longTermKey).encode('hex')[:16]))
+        with open(path, 'wb') as outfile:
+            transport.trace.dump(outfile)
+        paths.append(path)
+    return paths
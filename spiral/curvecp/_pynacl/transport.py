@@ -1,23 +1,30 @@
 from __future__ import division, absolute_import
 
-import bisect
 import collections
 import heapq
+import itertools
 import struct
 
 from interval import IntervalSet
 from nacl.exceptions import CryptoError
 from nacl.public import PublicKey, PrivateKey, Box
-from twisted.internet import defer
+from twisted.internet import defer, interfaces
 from twisted.internet.protocol import DatagramProtocol
 from twisted.python.failure import Failure
+from zope.interface import implementer
 
 from spiral.curvecp import errors as e
 from spiral.curvecp.address import CurveCPAddress
 from spiral.curvecp.util import nameToDNS
 from spiral.curvecp._pynacl.chicago import Chicago
+from spiral.curvecp._pynacl.inflight import InFlightIndex
 from spiral.curvecp._pynacl.interval import halfOpen
-from spiral.curvecp._pynacl.message import Message, parseMessage
+from spiral.curvecp._pynacl.message import Message, MessageView
+from spiral.curvecp._pynacl.metrics import defaultMetrics
+from spiral.curvecp._pynacl.packet import PacketBuilder
+from spiral.curvecp._pynacl.reorder import ReorderBuffer
+from spiral.curvecp._pynacl.sendbuffer import SendBuffer
+from spiral.curvecp._pynacl.trace import TraceBuffer
 from spiral.keys import EphemeralKey
 from spiral.util import MultiTimeout
 
@@ -37,15 +44,15 @@ class QueuedData(_QueuedThingBase):
     def __hash__(self):
         return id(self)
 
-    def fillInMessage(self, message):
-        return message._replace(dataPos=self.lowerBound, data=self.data)
+    def messageFor(self, id, previousID, ranges):
+        return Message(id, previousID, ranges, None, self.lowerBound, self.data)
 
 class QueuedResolution(_QueuedThingBase):
     def __hash__(self):
         return id(self)
 
-    def fillInMessage(self, message):
-        return message._replace(dataPos=self.lowerBound, resolution=self.data)
+    def messageFor(self, id, previousID, ranges):
+        return Message(id, previousID, ranges, self.data, self.lowerBound, '')
 
 
 def showMessage(tag, message, sentAt=None):
@@ -53,30 +60,61 @@ def showMessage(tag, message, sentAt=None):
     print halfOpen(message.dataPos, message.dataPos + len(message.data)),
     print len(message.data), sentAt and len(sentAt)
 
+@implementer(interfaces.IConsumer, interfaces.IPushProducer)
 class _CurveCPBaseTransport(DatagramProtocol):
     timeouts = 1, 1, 2, 3, 5, 8, 13
+    reorderBufferSize = 131072
+    sendBufferHighWater = 262144
+    sendBufferLowWater = 65536
+    ackDelay = 0
+    ackEvery = 1
+    pacingBurst = 16
+    fastRetransmitThreshold = 3072
+    nonceWindow = 1024
+    sessionOverhead = 4096
     _generateKey = staticmethod(PrivateKey.generate)
     _generateKeydir = staticmethod(EphemeralKey)
 
-    def __init__(self, clock, serverKey, factory):
+    def __init__(self, clock, serverKey, factory, metrics=None, congestion=None,
+                 traceSize=0):
         self._clock = clock
         self._serverKey = serverKey
         self._factory = factory
         self._received = IntervalSet()
         self._weAcked = IntervalSet()
-        self._sent = IntervalSet()
-        self._theyAcked = IntervalSet()
-        self._sentMessages = set()
+        self._sendBuffer = SendBuffer()
+        self._writeDeferreds = collections.deque()
+        self._producer = None
+        self._streamingProducer = False
+        self._producerPaused = False
+        self._resumeRequested = False
+        self._readsPaused = False
+        self._theyAckedUpTo = 0
+        self._theyAckedTail = IntervalSet()
+        self._inFlight = InFlightIndex()
         self._previousID = 0
-        self._fragment = []
-        self._congestion = Chicago()
+        self._reorder = ReorderBuffer(self.reorderBufferSize)
+        if congestion is None:
+            congestion = Chicago
+        self._congestion = congestion(clock)
+        self.trace = None
+        if traceSize:
+            self.trace = self._congestion.trace = TraceBuffer(traceSize)
         self._sentMessageAt = {}
+        self._sentMessageIDs = collections.deque()
+        self._pendingAck = None
+        self._messagesSinceAck = 0
         self._delayedCalls = {}
+        self._retransmitAt = {}
+        self._sentPast = {}
+        self._deadlines = []
+        self._deadlineCounter = itertools.count()
         self._messageQueue = []
         self._enqueuedMessages = set()
         self._deferred = defer.Deferred()
         self._nonce = 0
-        self._theirLastNonce = 0
+        self._theirLastNonce = -1
+        self._seenNonces = 0
         self._counter = 1
         self._ourStreamEnd = None
         self._theirStreamEnd = None
@@ -84,6 +122,10 @@ class _CurveCPBaseTransport(DatagramProtocol):
         self._done = False
         self._outstandingMessages = 0
         self._onDone = []
+        self._lastActivity = self._handshakeStartedAt = clock.seconds()
+        if metrics is None:
+            metrics = defaultMetrics
+        self._metrics = metrics
 
     def _now(self):
         return self._clock.seconds()
@@ -92,6 +134,8 @@ class _CurveCPBaseTransport(DatagramProtocol):
         self._deferred.errback(e.HandshakeTimeout())
 
     def _write(self, data):
+        self._metrics.packetsOut.inc()
+        self._metrics.bytesOut.inc(len(data))
         self.transport.write(data, self._peerHost)
 
     def _retrySendingForHandshake(self, data):
@@ -102,6 +146,8 @@ class _CurveCPBaseTransport(DatagramProtocol):
 
     messageMap = {}
     def datagramReceived(self, data, host_port):
+        self._metrics.packetsIn.inc()
+        self._metrics.bytesIn.inc(len(data))
         if self._done:
             return
         handler = self._messageMap.get(data[:8])
@@ -118,40 +164,79 @@ class _CurveCPBaseTransport(DatagramProtocol):
         return packedNonce + box.encrypt(data, nonce).ciphertext
 
     def _verifyNonce(self, nonce):
+        # Bit n of _seenNonces is set if the nonce n below the highest one
+        # seen so far has been accepted. Anything older than the window is
+        # treated as a replay. Accepted nonces are reported as 'newest' if
+        # they're the highest seen so far, or 'late' if they arrived out of
+        # order; rejected ones as None.
         unpacked, = _nonceStruct.unpack(nonce)
-        ret = unpacked >= self._theirLastNonce
-        self._theirLastNonce = unpacked
-        return ret
-
+        offset = self._theirLastNonce - unpacked
+        if offset < 0:
+            if -offset >= self.nonceWindow:
+                self._seenNonces = 1
+            else:
+                self._seenNonces = (self._seenNonces << -offset | 1) & ((1 << self.nonceWindow) - 1)
+            self._theirLastNonce = unpacked
+            return 'newest'
+        elif offset >= self.nonceWindow or self._seenNonces & (1 << offset):
+            self._metrics.nonceRejects.inc()
+            return None
+        self._seenNonces |= 1 << offset
+        self._metrics.latePackets.inc()
+        return 'late'
+
+    _packetBuilder = None
     def _serializeMessage(self, message):
-        return ''
+        packet = self._packetBuilder.build(self._nonce, message)
+        self._nonce += 1
+        return packet
 
     def _sendMessage(self, message):
         packet = self._serializeMessage(message)
         self._write(packet)
         if message.id:
             self._sentMessageAt[message.id] = self._congestion.lastSentAt = self._now()
+            self._sentMessageIDs.append(message.id)
         self._weAcked.update(message.ranges)
 
     def _parseMessage(self, now, message):
-        message = parseMessage(message)
-
-        sentAt = self._sentMessageAt.pop(message.previousID, None)
-        if sentAt is not None:
-            self._congestion.processDelta(now, now - sentAt)
+        message = MessageView(message)
+        self._lastActivity = now
+
+        if message.previousID:
+            sentAt = self._sentMessageAt.pop(message.previousID, None)
+            if sentAt is not None:
+                self._congestion.processDelta(now, now - sentAt)
+                self._metrics.rtt.observe(now - sentAt)
+            # Acks can be coalesced, so anything sent before the message being
+            # acked won't be acked on its own anymore.
+            sentMessageIDs = self._sentMessageIDs
+            while sentMessageIDs and sentMessageIDs[0] <= message.previousID:
+                self._sentMessageAt.pop(sentMessageIDs.popleft(), None)
         if message.id:
-            self._clock.callLater(0, self._sendAMessage, ack=message.id)
-        self._theyAcked.update(message.ranges)
+            self._ackLater(message.id)
 
-        for qd in list(self._sentMessages):
-            if qd.interval & self._theyAcked:
-                qd.interval.difference_update(self._theyAcked)
+        newlyAcked = self._recordAcks(message)
+        for i in newlyAcked:
+            for qd in self._inFlight.overlapping(i.lower_bound, i.upper_bound):
+                qd.interval.discard(i)
                 if not qd.interval:
                     for d in qd.deferreds:
                         d.callback(now)
-                    self._cancel(qd)
+                    self._cancelTimeout(qd)
+                    self._sentPast.pop(qd, None)
                     self._outstandingMessages -= 1
-                    self._sentMessages.remove(qd)
+                    self._inFlight.discard(qd)
+        writeDeferreds = self._writeDeferreds
+        while writeDeferreds and writeDeferreds[0][0] <= self._theyAckedUpTo:
+            _, d = writeDeferreds.popleft()
+            d.callback(now)
+        if newlyAcked:
+            if self.fastRetransmitThreshold:
+                self._fastRetransmit()
+            if self._congestion.window is not None:
+                self._reschedule('message')
+            self._checkProducerResume()
 
         if message.resolution and self._theirStreamEnd is None:
             self._theirStreamEnd = message.dataPos
@@ -162,24 +247,68 @@ class _CurveCPBaseTransport(DatagramProtocol):
             return
         elif not message.data:
             return
-        i = halfOpen(message.dataPos, message.dataPos + len(message.data))
-        new = IntervalSet([i]) - self._received
-        if not new:
+        # The reorder buffer's base is how far the application has been given
+        # the stream. Data starting at or before it is handed over directly,
+        # along with whatever had been buffered contiguously after it.
+        delivered = self._reorder.base
+        end = message.dataPos + len(message.data)
+        if message.dataPos <= delivered < end and not self._readsPaused:
+            data = message.data[delivered - message.dataPos:]
+            self._reorder.skip(len(data))
+            self._received.add(halfOpen(delivered, end))
+            self._protocol.dataReceived(data + self._reorder.read())
+            self._checkTheirResolution()
             return
-        self._received.add(i)
-        newData = message.data[new.lower_bound() - i.lower_bound:new.upper_bound() - i.upper_bound or None]
-        bisect.insort(self._fragment, (i.lower_bound, newData))
-        if len(self._received) > 1 or self._received.lower_bound() != 0:
+        # Data that doesn't fit in the reorder buffer is neither stored nor
+        # added to _received, so it stays unacked and the peer resends it.
+        i = self._reorder.accept(message.dataPos, message.data)
+        if i is not None:
+            self._received.add(i)
+
+    def _recordAcks(self, message):
+        # Everything below _theyAckedUpTo has been acked; _theyAckedTail holds
+        # the acked ranges past it. Only the parts of the message's ranges
+        # that weren't already acked are returned. With nothing in flight,
+        # there's nothing left to ack, so the ranges aren't even decoded.
+        newlyAcked = []
+        if not self._inFlight:
+            return newlyAcked
+        for lower, upper in message.iterRanges():
+            lower = max(lower, self._theyAckedUpTo)
+            if lower >= upper:
+                continue
+            new = IntervalSet([halfOpen(lower, upper)]) - self._theyAckedTail
+            newlyAcked.extend(new)
+            self._theyAckedTail.update(new)
+        tail = self._theyAckedTail
+        if tail and tail.lower_bound() <= self._theyAckedUpTo:
+            self._theyAckedUpTo = tail[0].upper_bound
+            del tail[0]
+        return newlyAcked
+
+    def _fastRetransmit(self):
+        # A block is taken as lost, and resent without waiting for its
+        # timeout, once fastRetransmitThreshold bytes past everything that
+        # had been sent by the time it was last sent have been acked. Data
+        # sent after a resend has to be acked before the block can be resent
+        # again, so reordering or a slow resend doesn't cause duplicates.
+        tail = self._theyAckedTail
+        ackedUpTo = tail.upper_bound() if tail else self._theyAckedUpTo
+        limit = ackedUpTo - self.fastRetransmitThreshold
+        if limit <= self._theyAckedUpTo:
             return
-        newData = ''.join([d for _, d in self._fragment])
-        self._protocol.dataReceived(newData)
-        self._fragment = []
-        self._checkTheirResolution()
+        lost = [
+            qd for qd in self._inFlight.overlapping(self._theyAckedUpTo, limit)
+            if qd.interval and self._sentPast.get(qd, limit) < limit
+            and qd not in self._enqueuedMessages]
+        if lost:
+            self._metrics.fastRetransmits.inc(len(lost))
+            self._enqueue(0, *lost)
 
     def _checkTheirResolution(self):
         if self._theirStreamEnd is None:
             return
-        if len(self._received) != 1 or self._received.lower_bound() != 0:
+        if self._reorder.base < self._theirStreamEnd:
             return
         self._reads = 'closed'
         self._protocol.readConnectionLost()
@@ -194,58 +323,135 @@ class _CurveCPBaseTransport(DatagramProtocol):
 
     def _checkBothResolutions(self):
         if self._reads == self._writes == 'closed' and not self._done:
-            self._protocol.connectionLost(Failure(e.resolution_map[self._theirResolution]()))
-            self._cancel('message')
-            deferreds, self._onDone = self._onDone, None
-            for d in deferreds:
-                d.callback(None)
-            # this used to be done on a callLater, but I can't remember why
-            self._done = True
-
-    def _sendAMessage(self, ack=None):
+            self._finish(Failure(e.resolution_map[self._theirResolution]()))
+
+    def _finish(self, reason):
+        self._metrics.untrack(self)
+        self._protocol.connectionLost(reason)
+        self._cancel('message')
+        self._cancel('timeout')
+        deferreds, self._onDone = self._onDone, None
+        for d in deferreds:
+            d.callback(None)
+        # this used to be done on a callLater, but I can't remember why
+        self._done = True
+        if self._producer is not None:
+            self._producer.stopProducing()
+            self._producer = None
+
+    def _abort(self, reason):
+        """
+        Drop the connection without waiting for either stream to be resolved,
+        failing anything still waiting on a write.
+        """
+        if self._done:
+            return
+        self._cancel('ack')
+        self._reads = self._writes = 'closed'
+        failure = Failure(reason)
+        waiting = [d for _, d in self._writeDeferreds]
+        self._writeDeferreds.clear()
+        for qd in itertools.chain(self._inFlight, (q[2] for q in self._messageQueue)):
+            waiting.extend(qd.deferreds)
+        for d in waiting:
+            if not d.called:
+                d.errback(failure)
+        self._finish(failure)
+
+    def _memoryEstimate(self):
+        return (
+            self.sessionOverhead + self._unackedBytes() + self._reorder.allocated())
+
+    def _ackLater(self, messageID):
+        # The ack goes out after ackDelay seconds, or right away once ackEvery
+        # messages are waiting on it. Any data message sent in the meantime
+        # carries it instead.
+        self._pendingAck = messageID
+        self._messagesSinceAck += 1
+        delay = 0 if self._messagesSinceAck >= self.ackEvery else self.ackDelay
+        delayedCall = self._delayedCalls.get('ack')
+        if delayedCall is None or not delayedCall.active():
+            self._delayedCalls['ack'] = self._clock.callLater(
+                delay, self._scheduledAction, 'ack')
+        elif delayedCall.getTime() > self._now() + delay:
+            delayedCall.reset(delay)
+
+    def _flushAck(self):
+        if self._pendingAck is None:
+            return
+        messageCall = self._delayedCalls.get('message')
+        if (messageCall is not None and messageCall.active()
+                and messageCall.getTime() <= self._now()
+                and (self._messageQueue or self._sendBuffer)):
+            # a data message is about to go out; the ack will ride along.
+            return
+        self._sendAMessage(ackOnly=True)
+
+    def _sendAMessage(self, ackOnly=False):
         now = self._now()
         nextActionIn = None
-        message = Message(
-            id=self._counter,
-            previousID=0,
-            ranges=list(self._received)[:6],
-            resolution=None,
-            dataPos=0,
-            data='',
-        )
-
-        if ack is not None:
-            message = message._replace(id=0, previousID=ack)
-        elif self._messageQueue:
-            _, _, qd = heapq.heappop(self._messageQueue)
-            self._enqueuedMessages.remove(qd)
-            message = qd.fillInMessage(message)
-            self._counter += 1
+        qd = None if ackOnly else self._popQueued()
+        if ackOnly:
+            messageID = 0
+        elif qd is not None:
+            messageID = self._counter
             if qd.sentAt:
+                self._metrics.retransmits.inc()
                 self._congestion.timedOut(now)
                 self._sentMessageAt.pop(qd.messageIDs[-1], None)
             elif self._congestion.window is not None and self._outstandingMessages > self._congestion.window:
+                # The window is full; an ack freeing it reschedules sending.
                 self._enqueue(1, qd)
-                return
+                if self._pendingAck is not None:
+                    self._sendAMessage(ackOnly=True)
+                return 60
             else:
                 self._outstandingMessages += 1
+            self._counter += 1
             qd.sentAt.append(now)
-            qd.messageIDs.append(message.id)
-            self._sentMessages.add(qd)
-            self._reschedule(qd)
+            qd.messageIDs.append(messageID)
+            self._sentPast[qd] = self._sendBuffer.offset
+            self._inFlight.add(qd)
+            self._scheduleTimeout(qd)
         else:
             return 60
 
+        ranges = self._received.intervals[:6]
+        previousID = self._pendingAck or 0
+        if qd is None:
+            message = Message(messageID, previousID, ranges, None, 0, '')
+        else:
+            message = qd.messageFor(messageID, previousID, ranges)
+
+        if self._pendingAck is not None:
+            self._pendingAck = None
+            self._messagesSinceAck = 0
+            self._cancel('ack')
         self._sendMessage(message)
         return nextActionIn
 
+    def _popQueued(self):
+        # New blocks are cut from the send buffer only once everything queued
+        # ahead of them (resends, and blocks held back by the window) has
+        # gone out. Blocks that were acked while waiting to be resent are
+        # skipped.
+        sendBuffer = self._sendBuffer
+        while True:
+            if sendBuffer and (not self._messageQueue
+                               or self._messageQueue[0][:2] > (1, sendBuffer.offset)):
+                lowerBound, data = sendBuffer.cut(1024)
+                interval = IntervalSet([halfOpen(lowerBound, lowerBound + len(data))])
+                return QueuedData(interval, lowerBound, [], [], [], data)
+            elif not self._messageQueue:
+                return None
+            _, _, qd = heapq.heappop(self._messageQueue)
+            self._enqueuedMessages.remove(qd)
+            if qd.interval:
+                return qd
+
     def _reschedule(self, what, nextActionIn=None):
-        now = self._now()
         if nextActionIn is None:
-            if what == 'message':
-                nextActionIn = self._congestion.nextMessageIn(now)
-            else:
-                nextActionIn = self._congestion.nextTimeoutIn(now, what)
+            nextActionIn = self._congestion.nextMessageIn(self._now())
         delayedCall = self._delayedCalls.get(what)
         if delayedCall is not None and delayedCall.active():
             delayedCall.reset(nextActionIn)
@@ -258,15 +464,74 @@ class _CurveCPBaseTransport(DatagramProtocol):
         if delayedCall is not None and delayedCall.active():
             delayedCall.cancel()
 
+    def _scheduleTimeout(self, qd):
+        # Every in-flight block's retransmission deadline goes into one heap,
+        # and only the earliest is scheduled with the clock. Entries that were
+        # superseded by a resend or an ack are skipped when they're popped.
+        now = self._now()
+        deadline = now + self._congestion.nextTimeoutIn(now, qd)
+        self._retransmitAt[qd] = deadline
+        heapq.heappush(self._deadlines, (deadline, next(self._deadlineCounter), qd))
+        if len(self._deadlines) > 2 * len(self._retransmitAt) + 64:
+            self._deadlines = [
+                entry for entry in self._deadlines
+                if self._retransmitAt.get(entry[2]) == entry[0]]
+            heapq.heapify(self._deadlines)
+        delayedCall = self._delayedCalls.get('timeout')
+        if delayedCall is None or not delayedCall.active():
+            self._delayedCalls['timeout'] = self._clock.callLater(
+                deadline - now, self._scheduledAction, 'timeout')
+        elif delayedCall.getTime() > deadline:
+            delayedCall.reset(deadline - now)
+
+    def _cancelTimeout(self, qd):
+        self._retransmitAt.pop(qd, None)
+        if not self._retransmitAt:
+            self._cancel('timeout')
+            del self._deadlines[:]
+
+    def _timedOut(self):
+        now = self._now()
+        deadlines = self._deadlines
+        retransmitAt = self._retransmitAt
+        while deadlines and deadlines[0][0] <= now:
+            deadline, _, qd = heapq.heappop(deadlines)
+            if retransmitAt.get(qd) != deadline:
+                continue
+            del retransmitAt[qd]
+            if qd in self._enqueuedMessages:
+                # Already waiting to be resent after a fast retransmit.
+                self._metrics.duplicateRetransmits.inc()
+            elif qd.interval:
+                self._enqueue(0, qd)
+        while deadlines and retransmitAt.get(deadlines[0][2]) != deadlines[0][0]:
+            heapq.heappop(deadlines)
+        if deadlines:
+            self._delayedCalls['timeout'] = self._clock.callLater(
+                deadlines[0][0] - now, self._scheduledAction, 'timeout')
+
     def _scheduledAction(self, what):
         nextActionIn = None
         if what == 'message':
-            nextActionIn = self._sendAMessage()
+            # Once the congestion controller's send rate is faster than the
+            # timer can fire, every message that fell due while waiting goes
+            # out on this wakeup, up to pacingBurst of them. A longer backlog
+            # is dropped rather than caught up on later.
+            due = self._delayedCalls[what].getTime()
+            now = self._now()
+            for _ in xrange(self.pacingBurst):
+                nextActionIn = self._sendAMessage()
+                if nextActionIn is not None:
+                    break
+                due += self._congestion.nextMessageIn(now)
+                if due > now:
+                    nextActionIn = due - now
+                    break
             self._reschedule(what, nextActionIn=nextActionIn)
-        else:
-            self._sentMessages.remove(what)
-            if what.interval:
-                self._enqueue(0, what)
+        elif what == 'timeout':
+            self._timedOut()
+        elif what == 'ack':
+            self._flushAck()
 
     def _enqueue(self, priority, *data):
         self._reschedule('message')
@@ -283,23 +548,80 @@ class _CurveCPBaseTransport(DatagramProtocol):
                 'attempted a write after closing writes'))
 
         d = defer.Deferred()
-        qds = []
-        lowerBound = self._sent.upper_bound() if self._sent else 0
-        while data:
-            ds = []
-            queueableData = data[:1024]
-            dataRange = halfOpen(lowerBound, lowerBound + len(queueableData))
-            qd = QueuedData(
-                IntervalSet([dataRange]), lowerBound, ds, [], [], queueableData)
-            self._sent.add(dataRange)
-            lowerBound += len(queueableData)
-            data = data[1024:]
-            qds.append(qd)
-        ds.append(d)
-        self._enqueue(1, *qds)
+        self._sendBuffer.append(data)
+        self._writeDeferreds.append((self._sendBuffer.end, d))
+        self._resumeRequested = False
+        self._reschedule('message')
+        if (self._streamingProducer and not self._producerPaused
+                and self._unackedBytes() > self.sendBufferHighWater):
+            self._producerPaused = True
+            self._producer.pauseProducing()
         return d
 
+    def _unackedBytes(self):
+        return self._sendBuffer.end - self._theyAckedUpTo
+
+    def _checkProducerResume(self):
+        producer = self._producer
+        if producer is None or self._unackedBytes() > self.sendBufferLowWater:
+            return
+        if not self._streamingProducer:
+            # A pull producer is asked for one write at a time; it isn't asked
+            # again until that write has arrived.
+            if not self._resumeRequested:
+                self._resumeRequested = True
+                producer.resumeProducing()
+        elif self._producerPaused:
+            self._producerPaused = False
+            producer.resumeProducing()
+
+    def registerProducer(self, producer, streaming):
+        if self._producer is not None:
+            raise RuntimeError(
+                'Cannot register producer %s, because producer %s was never '
+                'unregistered.' % (producer, self._producer))
+        if self._done:
+            producer.stopProducing()
+            return
+        self._producer = producer
+        self._streamingProducer = streaming
+        self._producerPaused = False
+        if not streaming:
+            self._resumeRequested = True
+            producer.resumeProducing()
+        elif self._unackedBytes() > self.sendBufferHighWater:
+            self._producerPaused = True
+            producer.pauseProducing()
+
+    def unregisterProducer(self):
+        self._producer = None
+        self._streamingProducer = self._producerPaused = self._resumeRequested = False
+
+    def pauseProducing(self):
+        # Incoming data keeps landing in the reorder buffer while reads are
+        # paused; once that fills up, it goes unacked and the peer backs off.
+        self._readsPaused = True
+
+    def resumeProducing(self):
+        if not self._readsPaused:
+            return
+        self._readsPaused = False
+        if self._reads not in ('open', 'closing'):
+            return
+        data = self._reorder.read()
+        if data:
+            self._protocol.dataReceived(data)
+        if self._reads == 'closing':
+            self._checkTheirResolution()
+
+    def stopProducing(self):
+        # Whatever was consuming our reads has gone away. Writes are left
+        # alone, since the other half of the connection may still be in use.
+        self._readsPaused = True
+
     def _peerEstablished(self):
+        self._metrics.handshakeTime.observe(self._now() - self._handshakeStartedAt)
+        self._metrics.track(self)
         self._protocol = self._factory.buildProtocol(self.getPeer())
         self._protocol.makeConnection(self)
         self._deferred.callback(self._protocol)
@@ -314,7 +636,7 @@ class _CurveCPBaseTransport(DatagramProtocol):
     def loseConnection(self, success=True):
         d = defer.Deferred()
         d.addCallback(self._doneWritingAcked)
-        streamEnd = self._ourStreamEnd = self._sent.upper_bound() if self._sent else 0
+        streamEnd = self._ourStreamEnd = self._sendBuffer.end
         resolution = self._ourResolution = 'success' if success else 'failure'
         interval = IntervalSet([halfOpen(streamEnd, streamEnd + 1)])
         self._enqueue(1, QueuedResolution(interval, streamEnd, [d], [], [], resolution))
@@ -324,8 +646,11 @@ class _CurveCPBaseTransport(DatagramProtocol):
 
 class CurveCPClientTransport(_CurveCPBaseTransport):
     def __init__(self, clock, serverKey, factory, host, port,
-                 serverExtension, clientKey=None, clientExtension='\x00' * 16):
-        _CurveCPBaseTransport.__init__(self, clock, serverKey, factory)
+                 serverExtension, clientKey=None, clientExtension='\x00' * 16,
+                 keyCache=None, keyPool=None, metrics=None, congestion=None,
+                 traceSize=0):
+        _CurveCPBaseTransport.__init__(
+            self, clock, serverKey, factory, metrics, congestion, traceSize)
         self._peerHost = host, port
         self._serverDomain = host
         self._serverExtension = serverExtension
@@ -333,6 +658,9 @@ class CurveCPClientTransport(_CurveCPBaseTransport):
             clientKey = self._generateKeydir()
         self._clientKey = clientKey
         self._clientExtension = clientExtension
+        self._keyCache = keyCache
+        if keyPool is not None:
+            self._generateKey = keyPool.get
         self._awaiting = 'cookie'
 
     _messageMap = {
@@ -341,15 +669,8 @@ class CurveCPClientTransport(_CurveCPBaseTransport):
     }
     _nonceInfix = 'client'
 
-    def _serializeMessage(self, message):
-        return (
-            'QvnQ5XlM'
-            + self._serverExtension
-            + self._clientExtension
-            + str(self._clientShortKey.public_key)
-            + self._encryptForNonce('M', self._shortShortBox, message.pack()))
-
     def startProtocol(self):
+        self._handshakeStartedAt = self._now()
         self._clientShortKey = self._generateKey()
         self._shortLongBox = Box(self._clientShortKey, self._serverKey)
         packet = (
@@ -372,6 +693,7 @@ class CurveCPClientTransport(_CurveCPBaseTransport):
         try:
             decrypted = self._shortLongBox.decrypt(encrypted, 'CurveCPK' + nonce)
         except CryptoError:
+            self._metrics.decryptFailures.inc()
             return
         serverShortKeyString, cookie = _cookieInnerStruct.unpack(decrypted)
         serverShortKey = PublicKey(serverShortKeyString)
@@ -383,9 +705,18 @@ class CurveCPClientTransport(_CurveCPBaseTransport):
             self._cookie = cookie
             self._serverShortKey = serverShortKey
             self._shortShortBox = Box(self._clientShortKey, self._serverShortKey)
+            self._packetBuilder = PacketBuilder(
+                'QvnQ5XlM'
+                + self._serverExtension
+                + self._clientExtension
+                + str(self._clientShortKey.public_key),
+                'CurveCP-client-M', self._shortShortBox)
             message = '\1\0\0\0\0\0\0\0' + '\0' * 184
             longLongNonce = self._clientKey.nonce()
-            longLongBox = Box(self._clientKey.key, self._serverKey)
+            if self._keyCache is None:
+                longLongBox = Box(self._clientKey.key, self._serverKey)
+            else:
+                longLongBox = self._keyCache.box(self._clientKey.key, self._serverKey)
             initiatePacketContent = (
                 str(self._clientKey.key.public_key)
                 + longLongNonce
@@ -414,6 +745,7 @@ class CurveCPClientTransport(_CurveCPBaseTransport):
         try:
             decrypted = self._shortShortBox.decrypt(data[48:], 'CurveCP-server-M' + nonce)
         except CryptoError:
+            self._metrics.decryptFailures.inc()
             return
         if not self._verifyNonce(nonce):
             return
@@ -440,8 +772,10 @@ class CurveCPClientTransport(_CurveCPBaseTransport):
 
 class CurveCPServerTransport(_CurveCPBaseTransport):
     def __init__(self, clock, serverKey, factory, clientID, clientPubkey,
-                 peerHost, serverShortClientShort, serverDomain):
-        _CurveCPBaseTransport.__init__(self, clock, serverKey, factory)
+                 peerHost, serverShortClientShort, serverDomain, metrics=None,
+                 congestion=None, traceSize=0):
+        _CurveCPBaseTransport.__init__(
+            self, clock, serverKey, factory, metrics, congestion, traceSize)
         self._serverExtension = clientID[:16]
         self._clientExtension = clientID[16:32]
         self._clientShortPubkey = PublicKey(clientID[32:64])
@@ -449,6 +783,9 @@ class CurveCPServerTransport(_CurveCPBaseTransport):
         self._peerHost = peerHost
         self._serverShortClientShort = serverShortClientShort
         self._serverDomain = serverDomain
+        self._packetBuilder = PacketBuilder(
+            'RL3aNMXM' + self._clientExtension + self._serverExtension,
+            'CurveCP-server-M', serverShortClientShort)
 
     _messageMap = {
         'QvnQ5XlM': 'message',
@@ -459,13 +796,6 @@ class CurveCPServerTransport(_CurveCPBaseTransport):
         self._reschedule('message')
         self._peerEstablished()
 
-    def _serializeMessage(self, message):
-        return (
-            'RL3aNMXM'
-            + self._clientExtension
-            + self._serverExtension
-            + self._encryptForNonce('M', self._serverShortClientShort, message.pack()))
-
     def _verifyPacketStart(self, data):
         return (data[8:24] == self._serverExtension
                 and data[24:40] == self._clientExtension
@@ -478,10 +808,15 @@ class CurveCPServerTransport(_CurveCPBaseTransport):
         try:
             decrypted = self._serverShortClientShort.decrypt(data[80:], 'CurveCP-client-M' + nonce)
         except CryptoError:
+            self._metrics.decryptFailures.inc()
             return
-        if not self._verifyNonce(nonce):
+        verified = self._verifyNonce(nonce)
+        if not verified:
             return
-        self._peerHost = host_port
+        if verified == 'newest':
+            # Only the client's latest packets can move it to a new address;
+            # a late one from where it used to be doesn't move it back.
+            self._peerHost = host_port
         self._parseMessage(self._now(), decrypted)
 
     def getHost(self):
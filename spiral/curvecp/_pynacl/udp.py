@@ -0,0 +1,403 @@
+import errno
+import os
+import socket
+import struct
+
+from cffi import FFI
+from twisted.internet import udp
+from twisted.python import log
+
+
+ffi = FFI()
+ffi.cdef("""
+    struct iovec {
+        void *iov_base;
+        size_t iov_len;
+    };
+
+    struct msghdr {
+        void *msg_name;
+        uint32_t msg_namelen;
+        struct iovec *msg_iov;
+        size_t msg_iovlen;
+        void *msg_control;
+        size_t msg_controllen;
+        int msg_flags;
+    };
+
+    struct mmsghdr {
+        struct msghdr msg_hdr;
+        unsigned int msg_len;
+    };
+
+    struct cmsghdr {
+        size_t cmsg_len;
+        int cmsg_level;
+        int cmsg_type;
+    };
+
+    int recvmmsg(int sockfd, struct mmsghdr *msgvec, unsigned int vlen,
+                 int flags, void *timeout);
+    int sendmmsg(int sockfd, struct mmsghdr *msgvec, unsigned int vlen,
+                 int flags);
+""")
+
+try:
+    libc = ffi.dlopen(None)
+    libc.recvmmsg
+    libc.sendmmsg
+except (OSError, AttributeError):
+    libc = None
+
+available = libc is not None
+
+_sockaddrSize = 128
+# Long enough for a sockaddr_in6; sockaddr_in is shorter.
+_sockaddrKeySize = 28
+_familyStruct = struct.Struct('=H')
+_portStruct = struct.Struct('!H')
+_flowinfoStruct = struct.Struct('!I')
+_scopeIDStruct = struct.Struct('=I')
+_mmsghdrSize = ffi.sizeof('struct mmsghdr')
+_msgLenOffset = ffi.offsetof('struct mmsghdr', 'msg_len')
+
+# From linux/udp.h. A UDP_SEGMENT control message asks the kernel to split
+# one large send into datagrams of the given size; only the last may be
+# shorter.
+SOL_UDP = 17
+UDP_SEGMENT = 103
+_maxSegments = 64
+_maxSegmentedBytes = 65000
+_cmsgHeaderSize = ffi.sizeof('struct cmsghdr')
+_segmentControlSize = _cmsgHeaderSize + ffi.sizeof('size_t')
+_segmentControl = struct.Struct(
+    '=%sii' % ('Q' if ffi.sizeof('size_t') == 8 else 'I',)
+    + 'H%dx' % (_segmentControlSize - _cmsgHeaderSize - 2,))
+_gsoErrors = {errno.EINVAL, errno.EIO, errno.ENOPROTOOPT, errno.EOPNOTSUPP}
+
+
+def parseSockaddr(name):
+    """
+    Turn the bytes of a ``struct sockaddr_in`` into a ``(host, port)`` tuple,
+    or the bytes of a ``struct sockaddr_in6`` into a ``(host, port, flowinfo,
+    scope_id)`` tuple, as ``recvfrom`` would.
+    """
+    family, = _familyStruct.unpack_from(name)
+    port, = _portStruct.unpack_from(name, 2)
+    if family == socket.AF_INET:
+        return socket.inet_ntop(socket.AF_INET, name[4:8]), port
+    flowinfo, = _flowinfoStruct.unpack_from(name, 4)
+    scopeID, = _scopeIDStruct.unpack_from(name, 24)
+    return socket.inet_ntop(socket.AF_INET6, name[8:24]), port, flowinfo, scopeID
+
+
+def packSockaddr(host_port):
+    """
+    Turn a ``(host, port)`` tuple with a numeric IPv4 or IPv6 address, or a
+    ``(host, port, flowinfo, scope_id)`` tuple with an IPv6 address, into the
+    bytes of a ``struct sockaddr_in`` or ``struct sockaddr_in6``.
+
+    :raises socket.error: If the host isn't a numeric address.
+    """
+    host, port = host_port[:2]
+    try:
+        address = socket.inet_pton(socket.AF_INET, host)
+    except socket.error:
+        flowinfo, scopeID = host_port[2:4] or (0, 0)
+        return (
+            _familyStruct.pack(socket.AF_INET6) + _portStruct.pack(port)
+            + _flowinfoStruct.pack(flowinfo) + socket.inet_pton(socket.AF_INET6, host)
+            + _scopeIDStruct.pack(scopeID))
+    return (
+        _familyStruct.pack(socket.AF_INET) + _portStruct.pack(port) + address
+        + '\0' * 8)
+
+
+class DatagramBatchReader(object):
+    """
+    Receives up to *batchSize* datagrams of up to *maxPacketSize* bytes each
+    with a single ``recvmmsg`` call, into buffers allocated once.
+
+    Keeping the per-datagram work in Python down matters more than the saved
+    syscalls: the lengths of a whole batch are unpacked with one struct, the
+    headers are reset with one copy, and parsed addresses are cached.
+    """
+
+    maxCachedAddresses = 4096
+
+    def __init__(self, batchSize, maxPacketSize):
+        self.batchSize = batchSize
+        self.maxPacketSize = maxPacketSize
+        self._messages = ffi.new('struct mmsghdr[]', batchSize)
+        self._iovecs = ffi.new('struct iovec[]', batchSize)
+        self._data = ffi.new('char[]', batchSize * maxPacketSize)
+        self._names = ffi.new('char[]', batchSize * _sockaddrSize)
+        self._messagesBuffer = ffi.buffer(self._messages)
+        self._dataBuffer = ffi.buffer(self._data)
+        self._namesBuffer = ffi.buffer(self._names)
+        for i in xrange(batchSize):
+            iovec = self._iovecs[i]
+            iovec.iov_base = self._data + i * maxPacketSize
+            iovec.iov_len = maxPacketSize
+            header = self._messages[i].msg_hdr
+            header.msg_name = self._names + i * _sockaddrSize
+            header.msg_namelen = _sockaddrSize
+            header.msg_iov = self._iovecs + i
+            header.msg_iovlen = 1
+        # recvmmsg overwrites msg_namelen, so the headers get copied back from
+        # here before each call.
+        self._template = self._messagesBuffer[:]
+        self._lengthStructs = {}
+        self._addresses = {}
+        self.bytesRead = 0
+
+    def _lengthStruct(self, count):
+        lengthStruct = self._lengthStructs.get(count)
+        if lengthStruct is None:
+            padding = _mmsghdrSize - _msgLenOffset - 4
+            lengthStruct = self._lengthStructs[count] = struct.Struct(
+                '=' + ('%dxI%dx' % (_msgLenOffset, padding)) * count)
+        return lengthStruct
+
+    def recv(self, fd):
+        """
+        Read whatever datagrams are waiting on *fd*, without blocking. The
+        total size of what was read is left in ``bytesRead``.
+
+        :returns: A list of ``(data, (host, port))`` tuples.
+        :raises socket.error: If ``recvmmsg`` fails.
+        """
+        self._messagesBuffer[:] = self._template
+        count = libc.recvmmsg(fd, self._messages, self.batchSize, 0, ffi.NULL)
+        if count < 0:
+            errno = ffi.errno
+            raise socket.error(errno, os.strerror(errno))
+        lengths = self._lengthStruct(count).unpack_from(self._messagesBuffer)
+        self.bytesRead = sum(lengths)
+        data = self._dataBuffer
+        names = self._namesBuffer
+        maxPacketSize = self.maxPacketSize
+        addresses = self._addresses
+        if len(addresses) > self.maxCachedAddresses:
+            addresses.clear()
+        ret = []
+        for i in xrange(count):
+            nameStart = i * _sockaddrSize
+            name = names[nameStart:nameStart + _sockaddrKeySize]
+            addr = addresses.get(name)
+            if addr is None:
+                addr = addresses[name] = parseSockaddr(name)
+            start = i * maxPacketSize
+            ret.append((data[start:start + lengths[i]], addr))
+        return ret
+
+
+class DatagramBatchWriter(object):
+    """
+    Sends datagrams up to *batchSize* at a time with ``sendmmsg``.
+
+    When *gso* is true, consecutive datagrams to the same peer are also
+    coalesced into single sends which the kernel segments with
+    ``UDP_SEGMENT``. If the kernel turns out not to support that, it's
+    switched off and the datagrams are sent separately.
+    """
+
+    maxCachedAddresses = 4096
+
+    def __init__(self, batchSize, gso=True):
+        self.batchSize = batchSize
+        self.gso = gso
+        self._messages = ffi.new('struct mmsghdr[]', batchSize)
+        self._iovecs = ffi.new('struct iovec[]', batchSize)
+        self._names = ffi.new('char[]', batchSize * _sockaddrSize)
+        self._controls = ffi.new('char[]', batchSize * _segmentControlSize)
+        self._namesBuffer = ffi.buffer(self._names)
+        self._controlsBuffer = ffi.buffer(self._controls)
+        for i in xrange(batchSize):
+            header = self._messages[i].msg_hdr
+            header.msg_name = self._names + i * _sockaddrSize
+            header.msg_iov = self._iovecs + i
+            header.msg_iovlen = 1
+        self._addresses = {}
+
+    def _sockaddr(self, host_port):
+        name = self._addresses.get(host_port)
+        if name is None:
+            if len(self._addresses) > self.maxCachedAddresses:
+                self._addresses.clear()
+            name = self._addresses[host_port] = packSockaddr(host_port)
+        return name
+
+    def _coalesce(self, datagrams, unsendable):
+        # Returns (payload, sockaddr, segment size or 0, datagrams) tuples.
+        messages = []
+        run = []
+        runName = runSize = None
+        runBytes = 0
+        for datagram in datagrams:
+            data = datagram[0]
+            try:
+                name = self._sockaddr(datagram[1])
+            except socket.error:
+                unsendable.append(datagram)
+                continue
+            if (self.gso and name == runName and len(data) <= runSize
+                    and len(run[-1][0]) == runSize and len(run) < _maxSegments
+                    and runBytes + len(data) <= _maxSegmentedBytes):
+                run.append(datagram)
+                runBytes += len(data)
+                continue
+            if run:
+                messages.append(self._message(run, runName, runSize))
+            run = [datagram]
+            runName = name
+            runSize = runBytes = len(data)
+        if run:
+            messages.append(self._message(run, runName, runSize))
+        return messages
+
+    def _message(self, run, name, size):
+        if len(run) == 1:
+            return run[0][0], name, 0, run
+        return ''.join([data for data, addr in run]), name, size, run
+
+    def send(self, fd, datagrams):
+        """
+        Send a list of ``(data, (host, port))`` datagrams on *fd*. Datagrams
+        which can't be sent because of a full socket buffer are dropped, as
+        they would be anywhere else along the way.
+
+        :returns: A list of ``(datagram, errno)`` tuples for the datagrams that
+            failed for other reasons, and a list of the datagrams whose
+            addresses weren't numeric and which weren't tried at all.
+        """
+        failed = []
+        unsendable = []
+        messages = self._coalesce(datagrams, unsendable)
+        position = 0
+        while position < len(messages):
+            chunk = messages[position:position + self.batchSize]
+            payloads = []
+            for i, (payload, name, segmentSize, run) in enumerate(chunk):
+                payload = ffi.from_buffer(payload)
+                payloads.append(payload)
+                iovec = self._iovecs[i]
+                iovec.iov_base = payload
+                iovec.iov_len = len(payload)
+                header = self._messages[i].msg_hdr
+                nameStart = i * _sockaddrSize
+                self._namesBuffer[nameStart:nameStart + len(name)] = name
+                header.msg_namelen = len(name)
+                if segmentSize:
+                    controlStart = i * _segmentControlSize
+                    _segmentControl.pack_into(
+                        self._controlsBuffer, controlStart,
+                        _cmsgHeaderSize + 2, SOL_UDP, UDP_SEGMENT, segmentSize)
+                    header.msg_control = self._controls + controlStart
+                    header.msg_controllen = _segmentControlSize
+                else:
+                    header.msg_control = ffi.NULL
+                    header.msg_controllen = 0
+            sent = libc.sendmmsg(fd, self._messages, len(chunk), 0)
+            if sent >= 0:
+                position += sent
+                continue
+            no = ffi.errno
+            if no == errno.EINTR:
+                continue
+            if no in (errno.EAGAIN, errno.EWOULDBLOCK):
+                break
+            run = chunk[0][3]
+            if chunk[0][2] and no in _gsoErrors:
+                self.gso = False
+                messages[position:position + 1] = [
+                    self._message([datagram], chunk[0][1], 0) for datagram in run]
+                continue
+            failed.extend((datagram, no) for datagram in run)
+            position += 1
+        return failed, unsendable
+
+
+class BatchedPort(udp.Port):
+    """
+    A UDP port which drains its socket ``batchSize`` datagrams at a time with
+    ``recvmmsg``. Each batch is handed to the protocol's ``datagramsReceived``
+    if it has one, and otherwise to ``datagramReceived`` a datagram at a time.
+
+    Datagrams written to the port are queued until the end of the reactor
+    iteration, or until ``batchSize`` have been queued, and then sent together
+    with ``sendmmsg`` and, where the kernel supports it, ``UDP_SEGMENT``.
+
+    Only available on Linux.
+    """
+
+    batchSize = 64
+    _reader = None
+    _writer = None
+    _flushCall = None
+
+    def write(self, datagram, addr=None):
+        if self._connectedAddr:
+            return udp.Port.write(self, datagram, addr)
+        if self._writer is None:
+            self._writer = DatagramBatchWriter(self.batchSize)
+            self._writeQueue = []
+        self._writeQueue.append((datagram, addr))
+        if len(self._writeQueue) >= self.batchSize:
+            self.flushWrites()
+        elif self._flushCall is None:
+            self._flushCall = self.reactor.callLater(0, self.flushWrites)
+
+    def flushWrites(self):
+        """
+        Send every queued datagram now.
+        """
+        if self._flushCall is not None:
+            if self._flushCall.active():
+                self._flushCall.cancel()
+            self._flushCall = None
+        if self._writer is None or not self._writeQueue:
+            return
+        queue, self._writeQueue = self._writeQueue, []
+        failed, unsendable = self._writer.send(self.fileno(), queue)
+        for (datagram, addr), no in failed:
+            if no != errno.ECONNREFUSED:
+                log.msg('dropped a datagram to %r: %s' % (addr, os.strerror(no)))
+        for datagram, addr in unsendable:
+            try:
+                udp.Port.write(self, datagram, addr)
+            except Exception:
+                log.err(None, 'error writing a datagram')
+
+    def connectionLost(self, reason=None):
+        self.flushWrites()
+        udp.Port.connectionLost(self, reason)
+
+    def doRead(self):
+        if self._reader is None:
+            self._reader = DatagramBatchReader(self.batchSize, self.maxPacketSize)
+        datagramsReceived = getattr(self.protocol, 'datagramsReceived', None)
+        read = 0
+        while read < self.maxThroughput:
+            try:
+                datagrams = self._reader.recv(self.fileno())
+            except socket.error as se:
+                no = se.args[0]
+                if no in udp._sockErrReadIgnore:
+                    return
+                if no in udp._sockErrReadRefuse:
+                    if self._connectedAddr:
+                        self.protocol.connectionRefused()
+                    return
+                raise
+            read += self._reader.bytesRead
+            try:
+                if datagramsReceived is not None:
+                    datagramsReceived(datagrams)
+                else:
+                    for data, addr in datagrams:
+                        self.protocol.datagramReceived(data, addr)
+            except:
+                log.err()
+            if len(datagrams) < self.batchSize:
+                return
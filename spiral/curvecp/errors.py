@@ -8,6 +8,9 @@ class CurveCPConnectionDone(Exception):
 class CurveCPConnectionFailed(CurveCPConnectionDone):
     pass
 
+class CurveCPConnectionEvicted(CurveCPConnectionFailed):
+    pass
+
 
 resolution_map = {
     'success': CurveCPConnectionDone,
@@ -4,23 +4,35 @@ import sys
 
 from nacl.public import PublicKey
 from twisted.internet.task import react
-from twisted.internet import defer, protocol
+from twisted.internet import defer, interfaces, protocol
 from twisted.python import log
+from zope.interface import implementer
 
-from spiral.curvecp import CurveCPClientEndpoint, _curvecpm
+from spiral.curvecp import CurveCPClientEndpoint, _curvecpm, controllerNamed
 from spiral.keys import Keydir
 
 
+@implementer(interfaces.IPushProducer)
 class CurveCPMClientProcessProtocol(protocol.ProcessProtocol):
     def __init__(self, proto):
         self.proto = proto
 
+    def pauseProducing(self):
+        self.transport.pauseProducing()
+
+    def resumeProducing(self):
+        self.transport.resumeProducing()
+
+    def stopProducing(self):
+        pass
+
     def childDataReceived(self, fd, data):
         assert fd == 7
         self.proto.transport.write(data).addErrback(log.err, 'error writing data')
 
     def childConnectionLost(self, fd):
         if fd == 7:
+            self.proto.transport.unregisterProducer()
             self.proto.transport.loseConnection().addErrback(log.err, 'error closing connection')
 
     def processEnded(self, status):
@@ -39,10 +51,12 @@ class CurveCPMClientProtocol(protocol.Protocol):
         env = os.environ.copy()
         env.update(self.transport.getHost().asUCSPIEnv('client', 'client'))
         env.update(self.transport.getPeer().asUCSPIEnv('client', 'server'))
-        self.factory.reactor.spawnProcess(
+        process = self.factory.reactor.spawnProcess(
             self.processProto, self.factory.args.program, args=args,
             env=env, childFDs={
                 0: 0, 1: 1, 2: 2, 6: 'w', 7: 'r'})
+        self.transport.registerProducer(self.processProto, True)
+        process.pipes[6].registerProducer(self.transport, True)
 
     def dataReceived(self, data):
         if not self.childProcessEnded:
@@ -68,13 +82,18 @@ class CurveCPMClientFactory(protocol.ClientFactory):
 
 def twistedMain(reactor, args):
     _curvecpm.startLogging(args.verbosity)
+    _curvecpm.startMetrics(reactor, args.metrics_port)
+    _curvecpm.startTracing(reactor, args.trace_size, args.trace_dir)
     fac = CurveCPMClientFactory(reactor, args)
     e = CurveCPClientEndpoint(
         reactor, args.host, args.port,
         serverKey=PublicKey(args.key.decode('hex')),
         serverExtension=args.server_extension.decode('hex'),
         clientKey=args.client_keydir,
-        clientExtension=args.client_extension.decode('hex'))
+        clientExtension=args.client_extension.decode('hex'),
+        batchSize=args.batch_size,
+        congestion=controllerNamed(args.congestion),
+        traceSize=args.trace_size)
     d = e.connect(fac)
 
     def gotProto(proto):
@@ -87,10 +106,17 @@ def twistedMain(reactor, args):
 def main(argv=sys.argv):
     parser = argparse.ArgumentParser()
     _curvecpm.addLogArguments(parser)
+    _curvecpm.addMetricsArguments(parser)
+    _curvecpm.addCongestionArguments(parser)
+    _curvecpm.addTraceArguments(parser)
     parser.add_argument('-n', '--name')
     parser.add_argument('-e', '--server-extension', default='0' * 32)
     parser.add_argument('-k', '--client-keydir', type=Keydir)
     parser.add_argument('--client-extension', default='0' * 32)
+    parser.add_argument(
+        '-b', '--batch-size', type=int, default=0,
+        help='send and read up to this many datagrams per sendmmsg or '
+        'recvmmsg call (Linux only)')
     parser.add_argument('key')
     parser.add_argument('host')
     parser.add_argument('port', type=int)
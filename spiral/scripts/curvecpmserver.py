@@ -2,24 +2,40 @@ import argparse
 import os
 import sys
 
-from twisted.internet.task import react
-from twisted.internet import defer, protocol
+from nacl.secret import SecretBox
+from twisted.internet.task import LoopingCall, react
+from twisted.internet import defer, interfaces, process, protocol
 from twisted.python import log
+from zope.interface import implementer
 
-from spiral.curvecp import CurveCPServerEndpoint, _curvecpm
+from spiral.curvecp import CookieKeys, CurveCPServerEndpoint, _curvecpm, controllerNamed
 from spiral.keys import Keydir
 
 
+cookieKeyLifetime = 60
+
+
+@implementer(interfaces.IPushProducer)
 class CurveCPMServerProcessProtocol(protocol.ProcessProtocol):
     def __init__(self, proto):
         self.proto = proto
 
+    def pauseProducing(self):
+        self.transport.pauseProducing()
+
+    def resumeProducing(self):
+        self.transport.resumeProducing()
+
+    def stopProducing(self):
+        pass
+
     def childDataReceived(self, fd, data):
         assert fd == 1
         self.proto.transport.write(data).addErrback(log.err, 'error writing data')
 
     def childConnectionLost(self, fd):
         if fd == 1:
+            self.proto.transport.unregisterProducer()
             self.proto.transport.loseConnection().addErrback(log.err, 'error closing connection')
 
 
@@ -33,9 +49,11 @@ class CurveCPMServerProtocol(protocol.Protocol):
         env = os.environ.copy()
         env.update(self.transport.getHost().asUCSPIEnv('server', 'server'))
         env.update(self.transport.getPeer().asUCSPIEnv('server', 'client'))
-        self.factory.reactor.spawnProcess(
+        process = self.factory.reactor.spawnProcess(
             self.processProto, self.factory.args.program, args=args,
             env=env, childFDs={0: 'w', 1: 'r', 2: 2})
+        self.transport.registerProducer(self.processProto, True)
+        process.registerProducer(self.transport, True)
 
     def dataReceived(self, data):
         self.processProto.transport.writeToChild(0, data)
@@ -52,10 +70,113 @@ class CurveCPMServerFactory(protocol.Factory):
     protocol = CurveCPMServerProtocol
 
 
+class CurveCPMServerWorkerProtocol(protocol.ProcessProtocol):
+    def __init__(self):
+        self.deferred = defer.Deferred()
+
+    def processEnded(self, reason):
+        log.msg('worker %d exited' % (self.transport.pid,), category='error')
+        self.deferred.callback(None)
+
+
+class CookieKeyReceiver(object):
+    """
+    Reads the cookie keys a worker's parent writes to it. The first key starts
+    the worker listening; every later one rotates the keys.
+    """
+
+    def __init__(self):
+        self.cookieKeys = None
+        self.firstKey = defer.Deferred()
+        self.done = defer.Deferred()
+        self._buffer = ''
+
+    def childDataReceived(self, name, data):
+        self._buffer += data
+        while len(self._buffer) >= SecretBox.KEY_SIZE:
+            key = self._buffer[:SecretBox.KEY_SIZE]
+            self._buffer = self._buffer[SecretBox.KEY_SIZE:]
+            if self.cookieKeys is None:
+                self.cookieKeys = CookieKeys(key)
+                self.firstKey.callback(self.cookieKeys)
+            else:
+                self.cookieKeys.rotate(key)
+
+    def childConnectionLost(self, name, reason):
+        self.done.callback(None)
+
+
+def workerArgs(args, index):
+    verbosityFlags = {'error': '-Q', 'success': '-v', 'none': '-q'}
+    ret = [
+        sys.executable, '-m', 'spiral.scripts.curvecpmserver',
+        verbosityFlags[args.verbosity], '--worker-cookie-fd', '3',
+        '-e', args.server_extension, '-t', str(args.handshake_threads),
+        '-b', str(args.batch_size), '--congestion', args.congestion,
+        '--trace-size', str(args.trace_size), '--trace-dir', args.trace_dir,
+    ]
+    if args.name is not None:
+        ret.extend(['-n', args.name])
+    if args.metrics_port is not None:
+        ret.extend(['--metrics-port', str(args.metrics_port + index)])
+    return ret + [args.keydir.keydir, str(args.port), '--', args.program] + args.argv
+
+
+def runWorkers(reactor, args):
+    workers = []
+    for index in xrange(args.workers):
+        worker = CurveCPMServerWorkerProtocol()
+        reactor.spawnProcess(
+            worker, sys.executable, args=workerArgs(args, index), env=os.environ,
+            childFDs={1: 1, 2: 2, 3: 'w'})
+        workers.append(worker)
+
+    def sendKey():
+        key = os.urandom(SecretBox.KEY_SIZE)
+        for worker in workers:
+            if not worker.deferred.called:
+                worker.transport.writeToChild(3, key)
+
+    rotation = LoopingCall(sendKey)
+    rotation.clock = reactor
+    rotation.start(cookieKeyLifetime)
+    d = defer.gatherResults([worker.deferred for worker in workers])
+    d.addCallback(lambda ign: rotation.stop())
+    return d
+
+
+def runWorker(reactor, args, fac):
+    receiver = CookieKeyReceiver()
+    process.ProcessReader(reactor, receiver, 'cookie-keys', args.worker_cookie_fd)
+
+    def gotCookieKeys(cookieKeys):
+        e = CurveCPServerEndpoint(
+            reactor, args.port, args.keydir, reusePort=True, cookieKeys=cookieKeys,
+            batchSize=args.batch_size, handshakeThreads=args.handshake_threads,
+            congestion=controllerNamed(args.congestion),
+            traceSize=args.trace_size)
+        return e.listen(fac)
+
+    def gotListeningPort(listeningPort):
+        return receiver.done.addCallback(lambda ign: listeningPort.stopListening())
+
+    return receiver.firstKey.addCallback(gotCookieKeys).addCallback(gotListeningPort)
+
+
 def twistedMain(reactor, args):
     _curvecpm.startLogging(args.verbosity)
+    if args.workers:
+        return runWorkers(reactor, args)
+    _curvecpm.startMetrics(reactor, args.metrics_port)
+    _curvecpm.startTracing(reactor, args.trace_size, args.trace_dir)
     fac = CurveCPMServerFactory(reactor, args)
-    e = CurveCPServerEndpoint(reactor, args.port, args.keydir)
+    if args.worker_cookie_fd is not None:
+        return runWorker(reactor, args, fac)
+    e = CurveCPServerEndpoint(
+        reactor, args.port, args.keydir, batchSize=args.batch_size,
+        handshakeThreads=args.handshake_threads,
+        congestion=controllerNamed(args.congestion),
+        traceSize=args.trace_size)
     d = e.listen(fac)
 
     def gotListeningPort(listeningPort):
@@ -69,11 +190,28 @@ def twistedMain(reactor, args):
 def main(argv=sys.argv):
     parser = argparse.ArgumentParser()
     _curvecpm.addLogArguments(parser)
+    _curvecpm.addMetricsArguments(parser)
+    _curvecpm.addCongestionArguments(parser)
+    _curvecpm.addTraceArguments(parser)
     parser.add_argument('-n', '--name')
     parser.add_argument('-e', '--server-extension', default='0' * 32)
+    parser.add_argument(
+        '-w', '--workers', type=int, default=0,
+        help='run this many processes sharing the port; worker n serves '
+        'metrics on the metrics port plus n')
+    parser.add_argument('-t', '--handshake-threads', type=int, default=0)
+    parser.add_argument(
+        '-b', '--batch-size', type=int, default=0,
+        help='read and send up to this many datagrams per recvmmsg or '
+        'sendmmsg call (Linux only)')
+    parser.add_argument('--worker-cookie-fd', type=int, help=argparse.SUPPRESS)
     parser.add_argument('keydir', type=Keydir)
     parser.add_argument('port', type=int)
     parser.add_argument('program')
     parser.add_argument('argv', nargs='*')
 
     react(twistedMain, [parser.parse_args(argv[1:])])
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,19 @@
 import collections
 import os
 import pipes
+import sys
 import time
 
 import pytest
 import py.path
-from twisted.internet.error import ProcessTerminated, ProcessDone
+from twisted.internet.error import ConnectionDone, ProcessTerminated, ProcessDone
+from twisted.internet.protocol import Factory
 from twisted.internet.utils import getProcessOutput
 from twisted.internet import defer, task
+from twisted.python.failure import Failure
 from twisted.trial import unittest
 
+from spiral.curvecp import CookieKeys
 from spiral.keys import Keydir
 from spiral.scripts import curvecpmclient, curvecpmserver
 from spiral.test.util import BoringProcess
@@ -131,6 +135,137 @@ class Bag(object):
     pass
 
 
+class FakeProcessTransport(object):
+    def __init__(self, pid):
+        self.pid = pid
+        self.written = []
+
+    def writeToChild(self, fd, data):
+        self.written.append((fd, data))
+
+
+class FakeWorkerReactor(task.Clock):
+    def __init__(self):
+        task.Clock.__init__(self)
+        self.spawned = []
+        self.workers = []
+        self.readers = set()
+        self.adopted = []
+
+    def spawnProcess(self, proto, executable, args, env, childFDs):
+        self.spawned.append((executable, args, childFDs))
+        self.workers.append(proto)
+        proto.makeConnection(FakeProcessTransport(len(self.spawned)))
+        return proto.transport
+
+    def addReader(self, reader):
+        self.readers.add(reader)
+
+    def removeReader(self, reader):
+        self.readers.discard(reader)
+
+    def removeWriter(self, writer):
+        pass
+
+    def adoptDatagramPort(self, fileDescriptor, addressFamily, protocol):
+        port = Bag()
+        port.protocol = protocol
+        port.stopListening = lambda: self.adopted.remove(port)
+        self.adopted.append(port)
+        return port
+
+
+def serverArgsBag(**kwargs):
+    args = Bag()
+    args.verbosity = 'error'
+    args.server_extension = '0' * 32
+    args.handshake_threads = 0
+    args.batch_size = 0
+    args.congestion = 'chicago'
+    args.trace_size = 0
+    args.trace_dir = '.'
+    args.name = None
+    args.metrics_port = None
+    args.keydir = Bag()
+    args.keydir.keydir = '/keydir'
+    args.port = 1234
+    args.program = 'cat'
+    args.argv = ['-u']
+    args.workers = 2
+    args.worker_cookie_fd = None
+    args.__dict__.update(kwargs)
+    return args
+
+def test_workerArgs():
+    args = serverArgsBag(verbosity='success', batch_size=8, metrics_port=9000, name='spam')
+    assert curvecpmserver.workerArgs(args, 1) == [
+        sys.executable, '-m', 'spiral.scripts.curvecpmserver', '-v',
+        '--worker-cookie-fd', '3', '-e', '0' * 32, '-t', '0', '-b', '8',
+        '--congestion', 'chicago', '--trace-size', '0', '--trace-dir', '.',
+        '-n', 'spam', '--metrics-port', '9001',
+        '/keydir', '1234', '--', 'cat', '-u']
+
+def sealedWith(cookieKeys):
+    return cookieKeys.encrypt('spam', '\0' * 24)
+
+def test_cookieKeyReceiverReassemblesKeys():
+    receiver = curvecpmserver.CookieKeyReceiver()
+    first, second = 'a' * 32, 'b' * 32
+    receiver.childDataReceived('cookie-keys', first[:10])
+    assert not receiver.firstKey.called
+    receiver.childDataReceived('cookie-keys', first[10:] + second[:5])
+    cookieKeys = receiver.cookieKeys
+    assert receiver.firstKey.called
+    assert sealedWith(cookieKeys) == sealedWith(CookieKeys(first))
+    receiver.childDataReceived('cookie-keys', second[5:])
+    assert receiver.cookieKeys is cookieKeys
+    assert sealedWith(cookieKeys) == sealedWith(CookieKeys(second))
+    assert cookieKeys.decrypt(sealedWith(CookieKeys(first)), '\0' * 24) == 'spam'
+
+def test_runWorkersSendsAndRotatesKeys():
+    reactor = FakeWorkerReactor()
+    args = serverArgsBag()
+    d = curvecpmserver.runWorkers(reactor, args)
+    assert [spawned[1] for spawned in reactor.spawned] == [
+        curvecpmserver.workerArgs(args, 0), curvecpmserver.workerArgs(args, 1)]
+    assert [spawned[2] for spawned in reactor.spawned] == [{1: 1, 2: 2, 3: 'w'}] * 2
+    first, second = [proto.transport for proto in reactor.workers]
+    assert len(first.written) == 1
+    assert first.written == second.written
+    fd, key = first.written[0]
+    assert fd == 3 and len(key) == 32
+    reactor.advance(curvecpmserver.cookieKeyLifetime)
+    assert len(first.written) == 2
+    assert first.written == second.written
+    assert first.written[1] != first.written[0]
+    reactor.workers[0].processEnded(Failure(ProcessDone(0)))
+    reactor.advance(curvecpmserver.cookieKeyLifetime)
+    assert len(first.written) == 2
+    assert len(second.written) == 3
+    reactor.workers[1].processEnded(Failure(ProcessDone(0)))
+    assert d.called
+    assert not reactor.getDelayedCalls()
+
+def test_runWorkerListensOnceKeyArrives():
+    reactor = FakeWorkerReactor()
+    readFD, writeFD = os.pipe()
+    args = serverArgsBag(workers=0, worker_cookie_fd=readFD)
+    listened = curvecpmserver.runWorker(reactor, args, Factory())
+    reader, = reactor.readers
+    os.write(writeFD, 'a' * 32)
+    reader.doRead()
+    port, = reactor.adopted
+    assert sealedWith(port.protocol.cookieKeys) == sealedWith(CookieKeys('a' * 32))
+    os.write(writeFD, 'b' * 32)
+    reader.doRead()
+    assert sealedWith(port.protocol.cookieKeys) == sealedWith(CookieKeys('b' * 32))
+    os.close(writeFD)
+    reader.connectionLost(Failure(ConnectionDone()))
+    os.close(readFD)
+    assert listened.called
+    assert not reactor.adopted
+
+
 class AcceptanceTests(TestsBase, unittest.TestCase):
     @pytest.fixture(autouse=True)
     def init_tmpdir(self, tmpdir):